@@ -23,6 +23,12 @@ class NeuronModelBase:
     def setup_reorder_cache(self):
         self.decoder_lm_head.setup_reorder_cache()
 
+    def build_cache_swapper(self, max_bytes=None):
+        """
+        Build a `CacheSwapper` to preempt sequences by moving their KV cache rows to host.
+        """
+        return self.decoder_lm_head.build_cache_swapper(max_bytes)
+
     def _save_compiled_artifacts(self, directory):
         if os.path.isfile(directory):
             raise FileExistsError(
@@ -18,6 +18,7 @@ import math
 from transformers_neuronx import decoder
 from transformers_neuronx import module
 from transformers_neuronx import ops
+from transformers_neuronx import quantize
 from transformers_neuronx import sampling
 from transformers_neuronx import utils
 from transformers_neuronx import base
@@ -31,13 +32,16 @@ class BloomForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronMode
 
     def __init__(self, config, *, n_positions=2048, batch_size=1, amp='f32', tp_degree=2,
                  context_length_estimate=None, context_unroll=None,
-                 unroll=None, neuron_config=None, **kwargs):
+                 unroll=None, neuron_config=None, prompt_batch_size=None, **kwargs):
         config = BloomConfig(config, n_positions, batch_size, amp, tp_degree, **kwargs)
         super().__init__(BloomForCausalLM, config)
         self.config = config
         self.neuron_config =  neuron_config
 
         self.context_length_estimate = context_length_estimate
+        # The maximum number of unique prompts encoded before fanning out the caches
+        self.prompt_batch_size = prompt_batch_size
+        self.prompt_fanout = None
         if context_unroll is None:
             context_unroll = config.n_layer
         self.context_unroll = context_unroll
@@ -62,6 +66,8 @@ class BloomForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronMode
         # Materialize the embedding to CPU
         self.chkpt_model.transformer.word_embeddings.materialize()
         self.chkpt_model.transformer.word_embeddings_layernorm.materialize()
+        quant = self.neuron_config.quant if self.neuron_config else None
+        self.chkpt_model.transformer.word_embeddings = quantize.maybe_quantize_embedding(self.chkpt_model.transformer.word_embeddings, quant)
 
         ops.init()
 
@@ -137,11 +143,14 @@ class BloomForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronMode
                 unroll=self.context_unroll,
                 share_caches=True,
             )
+            if self.prompt_batch_size is not None:
+                self.prompt_fanout = self.decoder_lm_head.build_prompt_fanout(
+                    self.context_length_estimate, self.prompt_batch_size, unroll=self.context_unroll)
 
     def reset(self):
         self.decoder_lm_head.reset()
 
-    def context(self, hidden, cache_ids, start_ids):
+    def context(self, hidden, cache_ids, start_ids, prompts=None):
         context_length = hidden.shape[1]
         current = 0
         estimate = self.context_length_estimate
@@ -165,7 +174,9 @@ class BloomForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronMode
             else:
                 current = estimate
 
-            if current == estimate:
+            if current == estimate and prompts is not None:
+                logits = self.prompt_fanout(hidden_context, cache_context, start_ids, prompts)
+            elif current == estimate:
                 logits = self.decoder_lm_head_for_context(hidden_context, cache_context, start_ids)
 
         for i in range(current, context_length):
@@ -188,7 +199,11 @@ class BloomForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronMode
         hidden = hidden.transpose(0, -1).contiguous()
 
         if context_length > 1:
-            logits = self.context(hidden, cache_ids, start_ids)
+            # Identical prompts are encoded once when the model is built with `prompt_batch_size`
+            prompts = None
+            if self.prompt_fanout is not None:
+                prompts = self.prompt_fanout.unique_prompts(input_ids, start_ids)
+            logits = self.context(hidden, cache_ids, start_ids, prompts=prompts)
         else:
             logits = self.decoder_lm_head(hidden, cache_ids, start_ids)
 
@@ -13,7 +13,8 @@
 # limitations under the License.
 # ==============================================================================
 import bisect
-from typing import List, Union, Optional
+import itertools
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Tuple, Union
 
 from transformers_neuronx import utils
 
@@ -73,6 +74,24 @@ def context_sizes(
     raise NotImplementedError(f'Prompt bucket config {buckets_or_size} not supported')
 
 
+def batch_sizes(batch_size: Union[List[int], int]) -> List[int]:
+    """
+    Compute the batch sizes to build networks for.
+
+    Networks for every batch size share weights and KV caches. Smaller batch
+    sizes run on a prefix of the rows of the largest batch size caches.
+
+    Arguments:
+        batch_size: A list of batch sizes or a single batch size.
+
+    Returns
+        batch_sizes: The sorted list of batch sizes.
+    """
+    if isinstance(batch_size, list):
+        return sorted(batch_size)
+    return [batch_size]
+
+
 def find(buckets: Optional[List[int]], size: int) -> Optional[int]:
     """
     Find the smallest bucket with that fits the given `size` input.
@@ -91,3 +110,360 @@ def find(buckets: Optional[List[int]], size: int) -> Optional[int]:
         return None
     index = bisect.bisect_left(buckets, size, hi=len(buckets) - 1)
     return buckets[index]
+
+
+def linear_cost(fixed: float, per_position: float) -> Callable[[int], float]:
+    """
+    Build a latency estimate for a bucket which grows linearly with its size.
+
+    This is intended as a stand-in when measured per-bucket latencies are not
+    available. Measured latencies can be passed to `tune` directly as a dict
+    mapping bucket size to latency.
+
+    Arguments:
+        fixed: The size-independent latency of a single network execution.
+        per_position: The additional latency per position in the bucket.
+
+    Returns:
+        cost: A function mapping a bucket size to an estimated latency.
+    """
+    def cost(size: int) -> float:
+        return fixed + per_position * size
+    return cost
+
+
+def default_cost_models(n_positions: int) -> Tuple[Callable[[int], float], Callable[[int], float]]:
+    """
+    Relative token/context latency estimates used when no measurements exist.
+
+    These follow the heuristic in `utils.get_closest_pow2_bucket_size`: a
+    context encoding of 2048 tokens costs roughly 40 token generation steps.
+    A token generation step is dominated by fixed costs (weight loads) with a
+    small attention term that grows with the bucket size.
+
+    Arguments:
+        n_positions: The maximum sequence length the model supports.
+
+    Returns:
+        token_cost: The estimated latency of one token step per bucket size.
+        context_cost: The estimated latency of one context encoding per bucket size.
+    """
+    token_cost = linear_cost(1.0, 0.25 / n_positions)
+    context_cost = linear_cost(0.0, 40.0 / 2048)
+    return token_cost, context_cost
+
+
+def tune(
+        prompt_lengths: Union[Mapping[int, int], Sequence[int]],
+        generation_lengths: Union[Mapping[int, int], Sequence[int]],
+        n_positions: int,
+        max_token_buckets: int = 4,
+        max_context_buckets: int = 4,
+        token_cost: Optional[Union[Callable[[int], float], Mapping[int, float]]] = None,
+        context_cost: Optional[Union[Callable[[int], float], Mapping[int, float]]] = None,
+        granularity: int = 128,
+        token_compile_cost: Optional[Union[Callable[[int], float], Mapping[int, float]]] = None,
+        context_compile_cost: Optional[Union[Callable[[int], float], Mapping[int, float]]] = None,
+        compile_budget: Optional[float] = None,
+    ) -> Tuple[List[int], List[int]]:
+    """
+    Choose token and context buckets which minimize expected latency for a traffic profile.
+
+    Each bucket is a separately compiled network, so the buckets are bounded
+    by a maximum count and optionally by a compile budget. Within those
+    bounds, this selects the bucket sizes which minimize the total expected
+    latency of the observed traffic, following `<Family>ForSampling.sample`:
+    - A prompt of length `L` is left-padded to the smallest context bucket
+      that fits and generation starts at the end of that bucket. Prompts
+      which exceed the largest context bucket encode the remainder one token
+      at a time with the token generation network.
+    - A token generation step which writes to cache position `i` runs on the
+      smallest token bucket with more than `i` positions.
+
+    Prompt and generation lengths are treated as independent distributions.
+    Token buckets depend on where generation starts and context buckets on
+    the cost of encoding overflowing prompts, so the two selections are
+    alternated until they no longer change. Each selection is exact dynamic
+    programming over the candidate sizes which are multiples of
+    `granularity`. Candidates which no prompt or step would use are pruned,
+    which assumes that latency does not decrease with the bucket size.
+
+    The compile budget is an explicit cost per network, e.g. the compile
+    time or the device bytes of each bucket (see `memory.io_bytes` and
+    `memory.scratch_bytes`). The sum over the selected token and context
+    buckets is kept within `compile_budget` by adding the smallest
+    sufficient multiple of the compile cost to the latency objective.
+
+    Cost tables only need entries for measured sizes. Other sizes are
+    linearly interpolated (and extrapolated from the nearest two entries).
+
+    The results can be passed directly to `token_sizes` and `context_sizes`
+    (e.g. as the `n_positions` and `context_length_estimate` model arguments).
+
+    Arguments:
+        prompt_lengths: A histogram (length -> count) or list of prompt lengths.
+        generation_lengths: A histogram (length -> count) or list of the
+            number of generated tokens per request.
+        n_positions: The maximum sequence length. This is always the largest
+            token bucket.
+        max_token_buckets: The maximum number of token generation buckets.
+        max_context_buckets: The maximum number of context encoding buckets.
+            Set to 0 to disable context encoding.
+        token_cost: The latency of a token generation step per bucket size.
+            May be a function or a dict of measured sizes.
+        context_cost: The latency of a context encoding per bucket size.
+            May be a function or a dict of measured sizes.
+        granularity: The step between candidate bucket sizes.
+        token_compile_cost: The compile cost of a token generation network
+            per bucket size. May be a function or a dict of measured sizes.
+        context_compile_cost: The compile cost of a context encoding network
+            per bucket size. May be a function or a dict of measured sizes.
+        compile_budget: The maximum total compile cost of every bucket.
+
+    Returns:
+        token_buckets: The sorted token generation bucket sizes.
+        context_buckets: The sorted context encoding bucket sizes.
+    """
+    if max_token_buckets < 1:
+        raise ValueError(f'max_token_buckets={max_token_buckets} must be at least 1')
+    if compile_budget is not None and token_compile_cost is None and context_compile_cost is None:
+        raise ValueError('compile_budget requires token_compile_cost or context_compile_cost')
+    default_token_cost, default_context_cost = default_cost_models(n_positions)
+    token_cost = _as_cost_function(token_cost, default_token_cost)
+    context_cost = _as_cost_function(context_cost, default_context_cost)
+    token_compile_cost = _as_cost_function(token_compile_cost, lambda size: 0.0)
+    context_compile_cost = _as_cost_function(context_compile_cost, lambda size: 0.0)
+    traffic = _Traffic(_as_histogram(prompt_lengths), _as_histogram(generation_lengths), n_positions)
+
+    candidates = list(range(granularity, n_positions, granularity))
+    candidates.append(n_positions)
+    token_costs = [token_cost(size) for size in candidates]
+    context_costs = [context_cost(size) for size in candidates]
+    token_compile_costs = [token_compile_cost(size) for size in candidates]
+    context_compile_costs = [context_compile_cost(size) for size in candidates]
+    # The latency of one token step for each token bucket candidate
+    step_costs = dict(zip(candidates, token_costs))
+
+    def select(penalty):
+        context_buckets = []
+        token_buckets = [n_positions]
+        for _ in range(_MAX_ROUNDS):
+            if max_context_buckets > 0:
+                context_buckets = _select_context_buckets(
+                    traffic, candidates, context_costs, context_compile_costs, penalty, max_context_buckets,
+                    [step_costs[find(token_buckets, position + 1)] for position in range(n_positions)])
+            selected = _select_token_buckets(
+                traffic, candidates, token_costs, token_compile_costs, penalty, max_token_buckets, context_buckets)
+            if selected == token_buckets:
+                break
+            token_buckets = selected
+        return token_buckets, context_buckets
+
+    def compile_cost(selection):
+        token_buckets, context_buckets = selection
+        return (sum(token_compile_cost(size) for size in token_buckets)
+                + sum(context_compile_cost(size) for size in context_buckets))
+
+    selection = select(0.0)
+    if compile_budget is None or compile_cost(selection) <= compile_budget:
+        return selection
+
+    # Find the smallest compile cost penalty which satisfies the budget
+    lower, upper = 0.0, 1.0
+    for _ in range(_MAX_PENALTY_STEPS):
+        selection = select(upper)
+        if compile_cost(selection) <= compile_budget:
+            break
+        lower, upper = upper, upper * 16
+    else:
+        raise ValueError(f'No bucket selection fits compile_budget={compile_budget}. The smallest '
+                         f'selection {selection} costs {compile_cost(selection)}')
+    for _ in range(_MAX_PENALTY_STEPS):
+        middle = (lower + upper) / 2
+        candidate = select(middle)
+        if compile_cost(candidate) <= compile_budget:
+            upper, selection = middle, candidate
+        else:
+            lower = middle
+    return selection
+
+
+# The maximum number of alternations between token and context bucket selection
+_MAX_ROUNDS = 4
+
+# The number of steps searching for the compile cost penalty
+_MAX_PENALTY_STEPS = 24
+
+
+class _Traffic:
+    """
+    Prompt and generation length distributions in the form used by the bucket selection.
+    """
+
+    def __init__(self, prompts, generations, n_positions):
+        self.n_positions = n_positions
+        self.prompts = {}
+        for length, count in prompts.items():
+            length = min(length, n_positions)
+            self.prompts[length] = self.prompts.get(length, 0) + count
+        # prompts_upto[i] is the number of prompts with length <= i
+        counts = [0] * (n_positions + 1)
+        for length, count in self.prompts.items():
+            counts[length] += count
+        self.prompts_upto = list(itertools.accumulate(counts))
+        # generated_within[d] is the expected number of steps in the first d positions after the start
+        total = sum(generations.values())
+        survival = [0.0] * (n_positions + 1)
+        for generated, count in generations.items():
+            survival[min(generated, n_positions)] += count / total
+        survival = [1.0 - value for value in itertools.accumulate(survival)]
+        self.generated_within = [0.0, *itertools.accumulate(survival[:n_positions])]
+
+    def starts(self, context_buckets):
+        """
+        The number of sequences which start generating at each position.
+        """
+        starts = {}
+        for length, count in self.prompts.items():
+            start = length
+            if context_buckets and length <= context_buckets[-1]:
+                start = find(context_buckets, length)
+            starts[start] = starts.get(start, 0) + count
+        return starts
+
+    def steps_before(self, position, starts):
+        """
+        The expected number of token steps which write to cache positions below `position`.
+        """
+        return sum(count * self.generated_within[position - start]
+                   for start, count in starts.items() if start < position)
+
+
+def _select_token_buckets(traffic, candidates, costs, compile_costs, penalty, max_buckets, context_buckets):
+    starts = traffic.starts(context_buckets)
+    steps = [traffic.steps_before(size, starts) for size in candidates]
+    selected = _partition(steps, costs, [penalty * cost for cost in compile_costs], max_buckets,
+                          [0.0] * len(candidates), require_last=True)
+    return [candidates[index] for index in selected]
+
+
+def _select_context_buckets(traffic, candidates, costs, compile_costs, penalty, max_buckets, step_costs):
+    n_positions = traffic.n_positions
+    # serial[i] is the latency of encoding positions [0, i) one token at a time
+    serial = [0.0, *itertools.accumulate(step_costs)]
+    # Prompts longer than a bucket encode that bucket and then the remainder serially
+    serial_after = [0.0] * (n_positions + 1)
+    for length, count in traffic.prompts.items():
+        serial_after[length] += count * serial[length]
+    serial_after = list(itertools.accumulate(reversed(serial_after)))[::-1]
+    total = traffic.prompts_upto[-1]
+    final_costs = []
+    for size, cost in zip(candidates, costs):
+        overflow = total - traffic.prompts_upto[size]
+        remainder = serial_after[size + 1] if size < n_positions else 0.0
+        final_costs.append(overflow * (cost - serial[size]) + remainder)
+    prompts = [traffic.prompts_upto[size] for size in candidates]
+    selected = _partition(prompts, costs, [penalty * cost for cost in compile_costs], max_buckets, final_costs)
+    return [candidates[index] for index in selected]
+
+
+def _as_histogram(lengths: Union[Mapping[int, int], Sequence[int]]) -> Dict[int, int]:
+    if isinstance(lengths, Mapping):
+        histogram = {int(length): count for length, count in lengths.items() if count}
+    else:
+        histogram = {}
+        for length in lengths:
+            histogram[int(length)] = histogram.get(int(length), 0) + 1
+    if not histogram:
+        raise ValueError('Cannot tune buckets with an empty length histogram')
+    return histogram
+
+
+def _as_cost_function(cost, default):
+    if cost is None:
+        return default
+    if isinstance(cost, Mapping):
+        return _interpolate(cost)
+    return cost
+
+
+def _interpolate(table: Mapping[int, float]) -> Callable[[int], float]:
+    """
+    Linearly interpolate a table of measured costs between (and beyond) its sizes.
+    """
+    if not table:
+        raise ValueError('Cannot interpolate an empty cost table')
+    sizes = sorted(table)
+    values = [table[size] for size in sizes]
+
+    def cost(size: int) -> float:
+        if len(sizes) == 1:
+            return values[0]
+        index = bisect.bisect_left(sizes, size)
+        if index < len(sizes) and sizes[index] == size:
+            return values[index]
+        index = min(max(index, 1), len(sizes) - 1)
+        lower, upper = sizes[index - 1], sizes[index]
+        slope = (values[index] - values[index - 1]) / (upper - lower)
+        return values[index - 1] + slope * (size - lower)
+
+    return cost
+
+
+def _partition(cumulative, unit_costs, bucket_costs, max_buckets, final_costs, require_last=False):
+    """
+    Select up to `max_buckets` sorted candidates minimizing the total cost.
+
+    The values between two selected candidates run on the larger one, so a
+    selected candidate `i` following candidate `j` costs
+    `(cumulative[i] - cumulative[j]) * unit_costs[i] + bucket_costs[i]`.
+    The largest selected candidate `i` adds `final_costs[i]` (e.g. for the
+    values which do not fit). Candidates which no value runs on and which do
+    not reduce the final cost are dominated by the preceding candidate and
+    are pruned.
+
+    Returns:
+        selected: The sorted indices of the selected candidates.
+    """
+    inf = float('inf')
+    count = len(cumulative)
+    useful = [i for i in range(count)
+              if (i == 0 and cumulative[i] > 0)
+              or (i > 0 and (cumulative[i] > cumulative[i - 1] or final_costs[i] < final_costs[i - 1]))
+              or (require_last and i == count - 1)]
+    if not useful:
+        useful = [count - 1]
+    # best[k][i]: cost of k + 1 buckets whose largest is useful[i]; parents for backtracking
+    best = [[cumulative[i] * unit_costs[i] + bucket_costs[i] for i in useful]]
+    parents = [[None] * len(useful)]
+    for _ in range(1, max_buckets):
+        previous = best[-1]
+        current = []
+        links = []
+        for position, i in enumerate(useful):
+            unit = unit_costs[i]
+            choice, parent = inf, None
+            for j in range(position):
+                value = previous[j] - cumulative[useful[j]] * unit
+                if value < choice:
+                    choice, parent = value, j
+            current.append(choice + cumulative[i] * unit + bucket_costs[i])
+            links.append(parent)
+        best.append(current)
+        parents.append(links)
+
+    result, result_k, result_i = inf, None, None
+    for k, costs in enumerate(best):
+        for position, cost in enumerate(costs):
+            i = useful[position]
+            if require_last and i != count - 1:
+                continue
+            cost += final_costs[i]
+            if cost < result:
+                result, result_k, result_i = cost, k, position
+    selected = []
+    while result_i is not None:
+        selected.append(useful[result_i])
+        result_i = parents[result_k][result_i]
+        result_k -= 1
+    return selected[::-1]
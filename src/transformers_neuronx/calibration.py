@@ -0,0 +1,326 @@
+# Copyright Amazon Web Services and its Affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Offline calibration for weight quantization.
+
+A small calibration set is run through the CPU reference (Hugging Face) model
+to collect per-channel activation statistics. Activation-aware per-channel
+scales are then folded into the weights and into the operation producing
+their input (the preceding norm or linear layer), so the model computes the
+same function in full precision but quantizes with less error:
+
+    model = AutoModelForCausalLM.from_pretrained(...)
+    scales = calibration.calibrate(model, batches, quant_config, method='awq')
+    save_pretrained_split(model, save_directory)
+
+`to_neuron` consumes the folded weights and norms through the usual
+checkpoint loading and quantizes them with the same `QuantizationConfig`.
+The scales live only in the folded weights: the returned scales are for
+inspection and are not needed to load the calibrated checkpoint.
+"""
+import torch
+
+from transformers_neuronx import quantize
+from transformers_neuronx.config import QuantizationConfig
+
+
+class SmoothingGroup:
+    """
+    Linear layers sharing one input together with the operation producing it.
+
+    Arguments:
+        name: The name of the group, used as the key of its scales.
+        previous: The norm or linear layer whose output is the shared input.
+        linears: The linear layers consuming the shared input.
+    """
+
+    def __init__(self, name, previous, linears):
+        self.name = name
+        self.previous = previous
+        self.linears = linears
+
+
+def _in_dim(module):
+    # transformers Conv1D (GPT2) stores weights as [in, out]
+    return 0 if type(module).__name__ == 'Conv1D' else 1
+
+
+def _weight_in_out(module):
+    weight = module.weight.detach().to(torch.float32)
+    return weight if _in_dim(module) == 0 else weight.T
+
+
+def smoothing_groups(model):
+    """
+    Returns:
+        groups: The `SmoothingGroup`s of a Hugging Face causal LM.
+    """
+    model_type = model.config.model_type
+    groups = []
+    if model_type == 'llama':
+        for i, layer in enumerate(model.model.layers):
+            attn, mlp = layer.self_attn, layer.mlp
+            groups.append(SmoothingGroup(f'layers.{i}.attn', layer.input_layernorm,
+                                         [attn.q_proj, attn.k_proj, attn.v_proj]))
+            groups.append(SmoothingGroup(f'layers.{i}.mlp_in', layer.post_attention_layernorm,
+                                         [mlp.gate_proj, mlp.up_proj]))
+            # The SiLU gate multiplies the up projection so its output channels can be rescaled
+            groups.append(SmoothingGroup(f'layers.{i}.mlp_out', mlp.up_proj, [mlp.down_proj]))
+    elif model_type == 'opt':
+        if not model.config.do_layer_norm_before:
+            raise NotImplementedError('Calibration requires do_layer_norm_before=True')
+        for i, layer in enumerate(model.model.decoder.layers):
+            attn = layer.self_attn
+            groups.append(SmoothingGroup(f'layers.{i}.attn', layer.self_attn_layer_norm,
+                                         [attn.q_proj, attn.k_proj, attn.v_proj]))
+            groups.append(SmoothingGroup(f'layers.{i}.mlp_in', layer.final_layer_norm, [layer.fc1]))
+    elif model_type == 'bloom':
+        for i, layer in enumerate(model.transformer.h):
+            groups.append(SmoothingGroup(f'layers.{i}.attn', layer.input_layernorm,
+                                         [layer.self_attention.query_key_value]))
+            groups.append(SmoothingGroup(f'layers.{i}.mlp_in', layer.post_attention_layernorm,
+                                         [layer.mlp.dense_h_to_4h]))
+    elif model_type == 'gpt2':
+        for i, layer in enumerate(model.transformer.h):
+            groups.append(SmoothingGroup(f'layers.{i}.attn', layer.ln_1, [layer.attn.c_attn]))
+            groups.append(SmoothingGroup(f'layers.{i}.mlp_in', layer.ln_2, [layer.mlp.c_fc]))
+    else:
+        raise NotImplementedError(f'Calibration is not implemented for {model_type}')
+    return groups
+
+
+class ActivationStats:
+    """
+    Per-channel statistics of the input of a `SmoothingGroup`.
+
+    Arguments:
+        max_samples: The number of input rows (tokens) kept for searching scales.
+    """
+
+    def __init__(self, max_samples=512):
+        self.max_samples = max_samples
+        self.abs_max = None
+        self.abs_sum = None
+        self.count = 0
+        self.samples = None
+
+    def update(self, tensor):
+        tensor = tensor.detach().reshape(-1, tensor.shape[-1]).to(torch.float32)
+        abs_tensor = tensor.abs()
+        abs_max = abs_tensor.amax(dim=0)
+        abs_sum = abs_tensor.sum(dim=0)
+        if self.abs_max is None:
+            self.abs_max, self.abs_sum = abs_max, abs_sum
+            self.samples = tensor[:0]
+        else:
+            self.abs_max = torch.maximum(self.abs_max, abs_max)
+            self.abs_sum += abs_sum
+        self.count += tensor.shape[0]
+        samples = torch.cat([self.samples, tensor])
+        if samples.shape[0] > self.max_samples:
+            samples = samples[torch.randperm(samples.shape[0])[:self.max_samples]]
+        self.samples = samples
+
+    @property
+    def abs_mean(self):
+        return self.abs_sum / self.count
+
+
+@torch.no_grad()
+def collect_activation_stats(model, batches, groups=None, max_samples=512):
+    """
+    Run the calibration batches through the model and record the input
+    statistics of every smoothing group.
+
+    Arguments:
+        model: The Hugging Face model on CPU.
+        batches: An iterable of input id tensors or of keyword argument dicts.
+        groups: The smoothing groups. Defaults to `smoothing_groups(model)`.
+        max_samples: The number of input rows kept per group.
+
+    Returns:
+        stats: A dict from group name to `ActivationStats`.
+    """
+    if groups is None:
+        groups = smoothing_groups(model)
+    stats = {}
+    handles = []
+    for group in groups:
+        group_stats = stats[group.name] = ActivationStats(max_samples)
+
+        def hook(module, args, group_stats=group_stats):
+            group_stats.update(args[0])
+
+        handles.append(group.linears[0].register_forward_pre_hook(hook))
+    try:
+        for batch in batches:
+            if isinstance(batch, dict):
+                model(**batch)
+            else:
+                model(batch)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return stats
+
+
+@torch.no_grad()
+def apply_scales(group, scales):
+    """
+    Fold `scales` into a group: the input channels of the linear layers are
+    multiplied and the output of the previous operation is divided.
+    """
+    for linear in group.linears:
+        shape = [1, 1]
+        shape[_in_dim(linear)] = -1
+        linear.weight.mul_(scales.view(shape).to(linear.weight.dtype))
+    previous = group.previous
+    if isinstance(previous, torch.nn.Linear) or type(previous).__name__ == 'Conv1D':
+        shape = [1, 1]
+        shape[1 - _in_dim(previous)] = -1
+        previous.weight.div_(scales.view(shape).to(previous.weight.dtype))
+    else:
+        previous.weight.div_(scales.to(previous.weight.dtype))
+    if getattr(previous, 'bias', None) is not None:
+        previous.bias.div_(scales.to(previous.bias.dtype))
+
+
+def smooth_quant_scales(group, stats, alpha=0.5):
+    """
+    SmoothQuant scales `s = max|X| ** alpha / max|W| ** (1 - alpha)`, which
+    migrate activation outliers into the weights.
+    """
+    weight_max = torch.cat([_weight_in_out(linear) for linear in group.linears], dim=1).abs().amax(dim=1)
+    scales = stats.abs_max.clamp(min=1e-5) ** alpha / weight_max.clamp(min=1e-5) ** (1 - alpha)
+    return scales.clamp(min=1e-5)
+
+
+def fake_quantize(weight, quant_config):
+    """
+    Quantize and dequantize a [in, out] weight.
+    """
+    quantized, scales = quantize.maybe_quantize_weights(weight, quant_config)
+    return quantize.dequantize_weights(quantized, scales, quant_config)
+
+
+def awq_scales(group, stats, quant_config, n_grid=20):
+    """
+    AWQ scales `s = mean|X| ** alpha`, with `alpha` searched over a grid to
+    minimize the output error of the quantized linear layers on the sampled
+    calibration inputs.
+    """
+    inputs = stats.samples
+    weights = [_weight_in_out(linear) for linear in group.linears]
+    references = [inputs @ weight for weight in weights]
+    abs_mean = stats.abs_mean.clamp(min=1e-5)
+    best_error, best_scales = None, None
+    for step in range(n_grid):
+        alpha = step / n_grid
+        scales = abs_mean ** alpha
+        scales = scales / (scales.max() * scales.min()).sqrt()
+        scaled_inputs = inputs / scales
+        error = 0.0
+        for weight, reference in zip(weights, references):
+            quantized = fake_quantize(weight * scales[:, None], quant_config)
+            error += (scaled_inputs @ quantized - reference).pow(2).mean().item()
+        if best_error is None or error < best_error:
+            best_error, best_scales = error, scales
+    return best_scales
+
+
+@torch.no_grad()
+def clip_weights(group, stats, quant_config, n_grid=20, min_ratio=0.5):
+    """
+    Clip every quantization group (the whole input dimension for per-channel
+    scales) of the linear layers to the range which minimizes its
+    contribution to the output error on the sampled calibration inputs.
+    Clipping is folded into the weights so `to_neuron` derives the clipped
+    scales from the weight range.
+    """
+    for linear in group.linears:
+        weight = _weight_in_out(linear)
+        in_features, out_features = weight.shape
+        group_size = quant_config.group_size if quant_config.group_wise else in_features
+        n_groups = in_features // group_size
+        inputs = stats.samples.reshape(-1, n_groups, group_size)
+        grouped = weight.reshape(n_groups, group_size, out_features)
+        min_values = grouped.amin(dim=1, keepdim=True)
+        max_values = grouped.amax(dim=1, keepdim=True)
+        best_error, best_weight = None, grouped
+        for step in range(int(n_grid * (1 - min_ratio)) + 1):
+            ratio = 1 - step / n_grid
+            clipped = torch.clamp(grouped, min_values * ratio, max_values * ratio)
+            quantized = fake_quantize(clipped.reshape(in_features, out_features), quant_config)
+            delta = grouped - quantized.reshape(n_groups, group_size, out_features)
+            error = torch.einsum('ngi,gio->ngo', inputs, delta).pow(2).mean(dim=0)
+            if best_error is None:
+                best_error, best_weight = error, clipped
+            else:
+                better = (error < best_error).unsqueeze(1)
+                best_error = torch.minimum(error, best_error)
+                best_weight = torch.where(better, clipped, best_weight)
+        best_weight = best_weight.reshape(in_features, out_features)
+        if _in_dim(linear) == 1:
+            best_weight = best_weight.T
+        linear.weight.copy_(best_weight.to(linear.weight.dtype))
+
+
+@torch.no_grad()
+def calibrate(model, batches, quant_config: QuantizationConfig = None, method='awq', alpha=0.5,
+              n_grid=20, clip=True, max_samples=512):
+    """
+    Calibrate a Hugging Face model for quantization in place.
+
+    Arguments:
+        model: The Hugging Face model on CPU, in float32.
+        batches: An iterable of input id tensors or of keyword argument dicts.
+        quant_config: The quantization which the model will be compiled with.
+        method: `'smoothquant'` to migrate activation outliers into the
+            weights with a fixed `alpha`, or `'awq'` to search activation-aware
+            scales (and weight clipping when `clip` is set) against the
+            quantization error.
+        alpha: The SmoothQuant migration strength.
+        n_grid: The number of AWQ scale and clipping candidates.
+        clip: Whether AWQ also searches the weight clipping range.
+        max_samples: The number of input rows kept per group for the search.
+
+    Returns:
+        scales: A dict from group name to the per-channel scales folded into
+            the model.
+    """
+    if quant_config is None:
+        quant_config = QuantizationConfig()
+    if method not in ('smoothquant', 'awq'):
+        raise NotImplementedError(f'{method} is not implemented. Available options are smoothquant,awq')
+    model.eval()
+    groups = smoothing_groups(model)
+    if not quant_config.quantize_attn:
+        groups = [group for group in groups if not group.name.endswith('.attn')]
+    stats = collect_activation_stats(model, batches, groups, max_samples)
+
+    result = {}
+    for group in groups:
+        group_stats = stats[group.name]
+        if method == 'smoothquant':
+            scales = smooth_quant_scales(group, group_stats, alpha)
+        else:
+            scales = awq_scales(group, group_stats, quant_config, n_grid)
+        apply_scales(group, scales)
+        if method == 'awq' and clip:
+            group_stats.samples = group_stats.samples / scales
+            clip_weights(group, group_stats, quant_config, n_grid)
+        result[group.name] = scales
+    return result
+
@@ -19,6 +19,7 @@ import hashlib
 import tarfile
 import tempfile
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from textwrap import dedent
 import torch
@@ -282,11 +283,17 @@ class Executor:
           are being triggered.
         The combination of the above optimization can have a huge effect
         especially on small/fast models.
+
+        User inputs whose dtype differs from the device buffer are cast into
+        preallocated host buffers so that a step does not allocate them. Each
+        executor owns its buffers, so networks stepping concurrently (e.g.
+        ping-pong micro-batches) never share them.
         """
         self.kernel = kernel
         self.memory = memory
         self.inputs = inputs
         self.outputs = outputs
+        self.staging = [torch.zeros(buf.shape, dtype=buf.dtype) for buf in inputs]
         self.executor = torch.classes.neuron.ParallelExecutor(
             kernel.model,
             memory.inputs,  # All inputs (inputs, caches, weights)
@@ -294,6 +301,7 @@ class Executor:
             inputs,         # User provided inputs
             outputs,        # Returned outputs
         )
+        self.pool = None
 
     def __call__(self, inputs, return_ranks: int = -1):
         """
@@ -313,9 +321,9 @@ class Executor:
             result: The output tensors from each rank concatenated along dim 0.
         """
         casted = []
-        for cpu, buf in zip(inputs, self.inputs):
-            if cpu.dtype != buf.dtype:
-                cpu = cpu.to(buf.dtype)
+        for cpu, staging in zip(inputs, self.staging):
+            if cpu.dtype != staging.dtype:
+                cpu = staging.copy_(cpu)
             casted.append(cpu)
 
         if self.kernel.snapshot is not None:
@@ -334,6 +342,24 @@ class Executor:
             return result[0]
         return result
 
+    def submit(self, inputs, return_ranks: int = -1):
+        """
+        Execute the kernel in the background.
+
+        Submissions to the same executor run in order. The `inputs` must not
+        be modified until the returned future has completed.
+
+        Returns:
+            future: A `concurrent.futures.Future` for the `__call__` result.
+        """
+        return submit_executor(self, inputs, return_ranks)
+
+
+def submit_executor(executor, inputs, return_ranks):
+    if executor.pool is None:
+        executor.pool = ThreadPoolExecutor(1)
+    return executor.pool.submit(executor, inputs, return_ranks)
+
 
 def write_tensors(tensors, folder):
     os.makedirs(folder, exist_ok=True)
@@ -21,9 +21,11 @@ class QuantizationConfig:
     """ The config class that contains all quantization related settings """
 
     def __init__(self, quant_dtype='s8', dequant_dtype='f16', quantize_method='vector_dynamic',
-                 quantize_attn=True):
-        QUANT_DTYPE_LIST = ['s8',]
-        QUANTIZE_METHOD_LIST = ['vector_dynamic',]
+                 quantize_attn=True, group_size=128, zero_point=False, quantize_activations=(),
+                 quantize_lm_head=False, quantize_embedding=False):
+        QUANT_DTYPE_LIST = ['s8', 's4']
+        QUANTIZE_METHOD_LIST = ['vector_dynamic', 'group_dynamic']
+        ACTIVATION_LAYER_LIST = ['attn', 'mlp']
 
         # The data type that the parameter is quantized into
         self.quant_dtype = quant_dtype
@@ -43,6 +45,69 @@ class QuantizationConfig:
         # Decide whether the attention layer needs be quantized
         self.quantize_attn = quantize_attn
 
+        # Group-wise quantization: the number of consecutive input features
+        # which share a scale (and a zero-point when `zero_point` is set)
+        self.group_size = group_size
+        self.zero_point = zero_point
+        if self.quant_dtype == 's4' and self.quantize_method != 'group_dynamic':
+            raise NotImplementedError(f"{self.quant_dtype} is only implemented for group_dynamic")
+        if self.quantize_method == 'group_dynamic' and (self.group_size <= 0 or self.group_size % 2):
+            raise ValueError(f"group_size must be a positive even number, but got {self.group_size}")
+
+        # The layer types whose activations are dynamically quantized per token
+        # so that their matmuls run as s8 x s8 with s32 accumulation (W8A8)
+        self.quantize_activations = tuple(quantize_activations)
+        for layer_type in self.quantize_activations:
+            if layer_type not in ACTIVATION_LAYER_LIST:
+                raise NotImplementedError(f"Activation quantization of {layer_type} is not implemented. \
+                                          Available options are {','.join(ACTIVATION_LAYER_LIST)}")
+        if self.quantize_activations and (self.quant_dtype != 's8' or self.quantize_method != 'vector_dynamic'):
+            raise NotImplementedError("Activation quantization requires s8 vector_dynamic weights")
+        if 'attn' in self.quantize_activations and not self.quantize_attn:
+            raise ValueError("Activation quantization of attn requires quantize_attn=True")
+
+        # Decide whether the lm_head (with vocab-sharded scales) and the
+        # embedding table are quantized with the same method as the layers
+        self.quantize_lm_head = quantize_lm_head
+        self.quantize_embedding = quantize_embedding
+
+    @property
+    def group_wise(self):
+        return self.quantize_method == 'group_dynamic'
+
+    def quantizes_activations(self, layer_type):
+        return layer_type is not None and layer_type in self.quantize_activations
+
+class U8EncodingConfig:
+    """ The config class for the ranges of `-u8-` amp weight encoding """
+
+    def __init__(self, granularity='tensor', group_size=128):
+        GRANULARITY_LIST = ['tensor', 'channel', 'group']
+
+        # One range per weight, per output channel or per group of input features
+        self.granularity = granularity
+        if self.granularity not in GRANULARITY_LIST:
+            raise NotImplementedError(f"{self.granularity} is not implemented. \
+                                      Available options are {','.join(GRANULARITY_LIST)}")
+
+        # The number of input features sharing a range for the group granularity
+        self.group_size = group_size
+
+
+class WeightStreamingConfig:
+    """ The config class for streaming layer weights from host memory in multi-layer mode """
+
+    def __init__(self, window=2, directory=None):
+        # The number of layer groups whose weights are resident on device. The
+        # weights of the next group are written while the current group executes.
+        self.window = window
+        if self.window < 1:
+            raise ValueError(f"window={self.window} must be at least 1")
+
+        # When set, host weights are saved to this directory and memory-mapped
+        self.directory = directory
+
+
 class SparseAttnConfig:
     """ The config class that contains sparse attention related settings """
     def __init__(self, attn_type='blk_sparse', causal=False,
@@ -124,13 +189,47 @@ class SparseAttnConfig:
         return dense_mask.detach()
 
 
+class LogitsConfig:
+    """ The config class that controls how logits are returned to the host """
+
+    def __init__(self, dtype=None, top_k=None):
+        # The data type that logits are returned in. Default: The model amp dtype
+        self.dtype = dtype
+
+        # When set, only the top-k candidates are returned instead of the full vocabulary
+        self.top_k = top_k
+        if self.top_k is not None and (not isinstance(self.top_k, int) or self.top_k <= 0):
+            raise ValueError(f"top_k has to be a strictly positive int, got {self.top_k}")
+
+
+class LogitsProcessorConfig:
+    """ The config class that enables on-device logits processing before sampling """
+
+    def __init__(self, max_logit_bias=0, token_mask=False):
+        # The maximum number of biased token ids per row. Default: No logit bias
+        self.max_logit_bias = max_logit_bias
+        if not isinstance(self.max_logit_bias, int) or self.max_logit_bias < 0:
+            raise ValueError(f"max_logit_bias has to be a non-negative int, got {self.max_logit_bias}")
+
+        # Whether a packed per-row mask of allowed tokens is applied (e.g. for constrained decoding)
+        self.token_mask = token_mask
+
+
 class NeuronConfig():
     """ The class contains all Neuron related configs """
     def __init__(self, **kargs):
         # Quantization related configurations
         self.quant = kargs.pop('quant', None)
+        # Logits output related configurations
+        self.logits = kargs.pop('logits', None)
+        # On-device penalties and logit bias configurations
+        self.logits_processors = kargs.pop('logits_processors', None)
         # Sparse attention related configurations
         self.sparse_attn = kargs.pop('sparse_attn', None)
+        # Range granularity of -u8- amp weight encoding
+        self.u8_encoding = kargs.pop('u8_encoding', None)
+        # Layer-wise weight streaming from host memory
+        self.weight_streaming = kargs.pop('weight_streaming', None)
 
 class GenerationConfig:
 
@@ -141,6 +240,7 @@ class GenerationConfig:
         eos_token_id = None,    # Default: Ignore EOS token
         early_stopping = None,  # Default: Open-ended generation
         temperature = None,     # Default: No temperature application
+        top_p = None,           # Default: No nucleus filtering
     ):
         self.max_length = max_length
         self.do_sample = do_sample
@@ -148,4 +248,5 @@ class GenerationConfig:
         self.eos_token_id = eos_token_id
         self.early_stopping = early_stopping
         self.temperature = temperature
+        self.top_p = top_p
 
@@ -0,0 +1,622 @@
+# Copyright Amazon Web Services and its Affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Constrained decoding with token masks.
+
+A regular expression (or a JSON schema converted to one) is compiled into a
+character level automaton which is lazily determinized. Given a tokenizer
+vocabulary, the set of tokens which keep the automaton alive is computed once
+per automaton state by walking a trie of the token strings and then cached, so
+masks are only computed for states that generation actually reaches and are
+shared by every request which uses the same pattern.
+
+Masks are applied to host logits (`ConstrainedBatch.apply`) or packed into
+32-bit words (`pack_token_mask`) to be applied on device.
+"""
+import json
+import re
+import torch
+
+
+DEAD = -1
+
+
+class CharSet:
+    """
+    A set of characters given by inclusive code point ranges.
+    """
+
+    def __init__(self, ranges, negated=False):
+        self.ranges = tuple(ranges)
+        self.negated = negated
+
+    def __contains__(self, char):
+        code = ord(char)
+        found = any(low <= code <= high for low, high in self.ranges)
+        return found != self.negated
+
+
+ANY = CharSet([(ord('\n'), ord('\n'))], negated=True)
+CLASS_ESCAPES = {
+    'd': [(ord('0'), ord('9'))],
+    'w': [(ord('0'), ord('9')), (ord('A'), ord('Z')), (ord('a'), ord('z')), (ord('_'), ord('_'))],
+    's': [(ord(char), ord(char)) for char in ' \t\n\r\f\v'],
+}
+CHAR_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'f': '\f', 'v': '\v', '0': '\0'}
+
+
+class RegexParser:
+    """
+    Parse a regular expression into a small syntax tree.
+
+    Supports literals, `.`, character classes (including `\\d`, `\\w`, `\\s`
+    and their negations), groups, alternation and the `*`, `+`, `?` and
+    `{m}`, `{m,}`, `{m,n}` quantifiers. Patterns always match the full text.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.pos = 0
+
+    def parse(self):
+        node = self._alternation()
+        if self.pos != len(self.pattern):
+            raise ValueError(f'Unexpected {self.pattern[self.pos]!r} at position {self.pos} of {self.pattern!r}')
+        return node
+
+    def _peek(self):
+        if self.pos < len(self.pattern):
+            return self.pattern[self.pos]
+        return None
+
+    def _next(self):
+        char = self._peek()
+        if char is None:
+            raise ValueError(f'Unexpected end of pattern {self.pattern!r}')
+        self.pos += 1
+        return char
+
+    def _alternation(self):
+        options = [self._concatenation()]
+        while self._peek() == '|':
+            self.pos += 1
+            options.append(self._concatenation())
+        if len(options) == 1:
+            return options[0]
+        return ('alt', options)
+
+    def _concatenation(self):
+        items = []
+        while self._peek() not in (None, '|', ')'):
+            items.append(self._repetition())
+        return ('cat', items)
+
+    def _repetition(self):
+        node = self._atom()
+        while True:
+            char = self._peek()
+            if char == '*':
+                bounds = 0, None
+            elif char == '+':
+                bounds = 1, None
+            elif char == '?':
+                bounds = 0, 1
+            elif char == '{' and re.match(r'\{\d+(,\d*)?\}', self.pattern[self.pos:]):
+                end = self.pattern.index('}', self.pos)
+                low, _, high = self.pattern[self.pos + 1:end].partition(',')
+                if ',' not in self.pattern[self.pos:end]:
+                    high = low
+                bounds = int(low), int(high) if high else None
+                self.pos = end
+            else:
+                return node
+            self.pos += 1
+            node = ('rep', node, *bounds)
+
+    def _atom(self):
+        char = self._next()
+        if char == '(':
+            if self.pattern.startswith('?:', self.pos):
+                self.pos += 2
+            node = self._alternation()
+            if self._next() != ')':
+                raise ValueError(f'Unbalanced parenthesis in {self.pattern!r}')
+            return node
+        if char == '[':
+            return ('set', self._class())
+        if char == '.':
+            return ('set', ANY)
+        if char == '\\':
+            return ('set', self._escape())
+        if char in '*+?)':
+            raise ValueError(f'Unexpected {char!r} at position {self.pos - 1} of {self.pattern!r}')
+        return ('set', CharSet([(ord(char), ord(char))]))
+
+    def _escape_char(self):
+        char = self._next()
+        if char == 'x':
+            code = int(self.pattern[self.pos:self.pos + 2], 16)
+            self.pos += 2
+            return chr(code)
+        if char == 'u':
+            code = int(self.pattern[self.pos:self.pos + 4], 16)
+            self.pos += 4
+            return chr(code)
+        return CHAR_ESCAPES.get(char, char)
+
+    def _escape(self):
+        char = self._peek()
+        if char is not None and char.lower() in CLASS_ESCAPES:
+            self.pos += 1
+            return CharSet(CLASS_ESCAPES[char.lower()], negated=char.isupper())
+        char = self._escape_char()
+        return CharSet([(ord(char), ord(char))])
+
+    def _class(self):
+        negated = self._peek() == '^'
+        if negated:
+            self.pos += 1
+        ranges = []
+        first = True
+        while first or self._peek() != ']':
+            first = False
+            char = self._next()
+            if char == '\\':
+                if self._peek() is not None and self._peek() in CLASS_ESCAPES:
+                    ranges.extend(CLASS_ESCAPES[self._next()])
+                    continue
+                char = self._escape_char()
+            low = high = ord(char)
+            if self._peek() == '-' and self.pattern[self.pos + 1:self.pos + 2] not in ('', ']'):
+                self.pos += 1
+                end = self._next()
+                if end == '\\':
+                    end = self._escape_char()
+                high = ord(end)
+            ranges.append((low, high))
+        self.pos += 1
+        return CharSet(ranges, negated)
+
+
+class RegexFSM:
+    """
+    A lazily determinized automaton which matches a regular expression.
+
+    The expression is compiled into a nondeterministic automaton. Deterministic
+    states (sets of nondeterministic states) and their transitions are created
+    on first use, so only the part of the automaton reached during generation
+    is ever built.
+
+    Arguments:
+        pattern: The regular expression which the complete text must match.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.edges = []
+        self.epsilons = []
+        start, self.final = self._build(RegexParser(pattern).parse())
+        self.state_sets = []
+        self.state_ids = {}
+        self.transitions = {}
+        self.initial = self._state_id(self._closure([start]))
+
+    def _new(self):
+        self.edges.append([])
+        self.epsilons.append([])
+        return len(self.edges) - 1
+
+    def _build(self, node):
+        kind = node[0]
+        start = self._new()
+        if kind == 'set':
+            end = self._new()
+            self.edges[start].append((node[1], end))
+            return start, end
+        if kind == 'cat':
+            end = start
+            for item in node[1]:
+                item_start, item_end = self._build(item)
+                self.epsilons[end].append(item_start)
+                end = item_end
+            return start, end
+        if kind == 'alt':
+            end = self._new()
+            for option in node[1]:
+                option_start, option_end = self._build(option)
+                self.epsilons[start].append(option_start)
+                self.epsilons[option_end].append(end)
+            return start, end
+        _, item, low, high = node
+        end = start
+        for _ in range(low):
+            item_start, item_end = self._build(item)
+            self.epsilons[end].append(item_start)
+            end = item_end
+        if high is None:
+            item_start, item_end = self._build(item)
+            self.epsilons[end].append(item_start)
+            self.epsilons[item_end].append(item_start)
+            self.epsilons[item_end].append(end)
+            final = self._new()
+            self.epsilons[end].append(final)
+            self.epsilons[item_end].append(final)
+            return start, final
+        final = self._new()
+        self.epsilons[end].append(final)
+        for _ in range(high - low):
+            item_start, item_end = self._build(item)
+            self.epsilons[end].append(item_start)
+            self.epsilons[item_end].append(final)
+            end = item_end
+        return start, final
+
+    def _closure(self, states):
+        stack = list(states)
+        closure = set(stack)
+        while stack:
+            for target in self.epsilons[stack.pop()]:
+                if target not in closure:
+                    closure.add(target)
+                    stack.append(target)
+        return frozenset(closure)
+
+    def _state_id(self, state_set):
+        if not state_set:
+            return DEAD
+        state = self.state_ids.get(state_set)
+        if state is None:
+            state = len(self.state_sets)
+            self.state_ids[state_set] = state
+            self.state_sets.append(state_set)
+        return state
+
+    def next_state(self, state, char):
+        key = state, char
+        result = self.transitions.get(key)
+        if result is None:
+            targets = []
+            if state != DEAD:
+                for source in self.state_sets[state]:
+                    targets.extend(target for charset, target in self.edges[source] if char in charset)
+            result = self._state_id(self._closure(targets))
+            self.transitions[key] = result
+        return result
+
+    def walk(self, state, text):
+        for char in text:
+            state = self.next_state(state, char)
+            if state == DEAD:
+                break
+        return state
+
+    def is_accepting(self, state):
+        return state != DEAD and self.final in self.state_sets[state]
+
+    def matches(self, text):
+        return self.is_accepting(self.walk(self.initial, text))
+
+
+class TokenIndex:
+    """
+    An index of the token strings of a vocabulary used to compute token masks.
+
+    Token strings are stored in a trie so that computing the allowed tokens of
+    a state only visits prefixes which keep the automaton alive. Compiled
+    automata and their masks are cached per pattern so that requests which
+    share a schema share every computed mask.
+
+    Arguments:
+        tokens: The decoded string of each token id. None (or an empty string)
+            for tokens which may never be generated under a constraint.
+        vocab_size: The size of the masks (e.g. the model vocabulary size).
+        eos_token_id: The token allowed once the pattern has been matched.
+    """
+
+    def __init__(self, tokens, vocab_size=None, eos_token_id=None):
+        self.tokens = tokens
+        self.vocab_size = len(tokens) if vocab_size is None else vocab_size
+        self.eos_token_id = eos_token_id
+        self.trie = {}
+        for token_id, text in enumerate(tokens):
+            if not text or token_id == eos_token_id:
+                continue
+            node = self.trie
+            for char in text:
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append(token_id)
+        self.fsms = {}
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, vocab_size=None):
+        """
+        Build an index from a HuggingFace tokenizer.
+
+        Each token is decoded after a fixed prefix token so that tokenizers
+        which strip leading spaces when decoding a single token (e.g.
+        sentencepiece) still report the text that the token appends.
+        """
+        special_ids = set(tokenizer.all_special_ids)
+        prefix_ids = tokenizer.encode('a', add_special_tokens=False)
+        prefix = tokenizer.decode(prefix_ids)
+        tokens = []
+        for token_id in range(len(tokenizer)):
+            if token_id in special_ids:
+                tokens.append(None)
+                continue
+            text = tokenizer.decode(prefix_ids + [token_id])
+            # Partial multi-byte characters cannot be matched against a pattern
+            if not text.startswith(prefix) or '�' in text:
+                tokens.append(None)
+                continue
+            tokens.append(text[len(prefix):])
+        return cls(tokens, vocab_size, tokenizer.eos_token_id)
+
+    def compile(self, pattern):
+        """
+        Get the (cached) token automaton for a regular expression.
+        """
+        fsm = self.fsms.get(pattern)
+        if fsm is None:
+            fsm = TokenFSM(self, RegexFSM(pattern))
+            self.fsms[pattern] = fsm
+        return fsm
+
+    def compile_json_schema(self, schema):
+        """
+        Get the (cached) token automaton for a JSON schema (see `json_schema_to_regex`).
+        """
+        return self.compile(json_schema_to_regex(schema))
+
+
+class TokenFSM:
+    """
+    A character automaton lifted to tokens, with per-state masks cached on first use.
+    """
+
+    def __init__(self, index, fsm):
+        self.index = index
+        self.fsm = fsm
+        self.masks = {}
+        self.token_transitions = {}
+
+    @property
+    def initial(self):
+        return self.fsm.initial
+
+    def mask(self, state):
+        """
+        Get the boolean mask of shape [vocab_size] of tokens allowed from `state`.
+        """
+        mask = self.masks.get(state)
+        if mask is None:
+            mask = torch.zeros(self.index.vocab_size, dtype=torch.bool)
+            allowed = []
+            if state != DEAD:
+                self._collect(self.index.trie, state, allowed)
+            mask[allowed] = True
+            eos_token_id = self.index.eos_token_id
+            # Finished (or impossible) constraints may only end the sequence
+            if eos_token_id is not None and (self.fsm.is_accepting(state) or not allowed):
+                mask[eos_token_id] = True
+            self.masks[state] = mask
+        return mask
+
+    def _collect(self, node, state, allowed):
+        for char, child in node.items():
+            if char is None:
+                continue
+            next_state = self.fsm.next_state(state, char)
+            if next_state == DEAD:
+                continue
+            allowed.extend(child.get(None, []))
+            self._collect(child, next_state, allowed)
+
+    def advance(self, state, token_id):
+        key = state, token_id
+        result = self.token_transitions.get(key)
+        if result is None:
+            text = None
+            if token_id < len(self.index.tokens):
+                text = self.index.tokens[token_id]
+            if token_id == self.index.eos_token_id or not text:
+                result = DEAD
+            else:
+                result = self.fsm.walk(state, text)
+            self.token_transitions[key] = result
+        return result
+
+
+class ConstrainedBatch:
+    """
+    The constraint state of every row of a batch.
+
+    Arguments:
+        fsms: A `TokenFSM` per row, or None for unconstrained rows.
+    """
+
+    def __init__(self, fsms):
+        self.fsms = list(fsms)
+        self.states = [None if fsm is None else fsm.initial for fsm in self.fsms]
+
+    def mask(self, vocab_size=None):
+        """
+        Get the boolean mask of shape [batch_size, vocab_size] of the allowed tokens.
+        """
+        masks = []
+        for fsm, state in zip(self.fsms, self.states):
+            if fsm is None:
+                size = vocab_size
+                if size is None:
+                    size = next(fsm.index.vocab_size for fsm in self.fsms if fsm is not None)
+                masks.append(torch.ones(size, dtype=torch.bool))
+            else:
+                masks.append(fsm.mask(state))
+        return torch.stack(masks)
+
+    def apply(self, scores):
+        """
+        Set the scores of disallowed tokens to -inf.
+
+        Arguments:
+            scores: The scores of shape [batch_size, vocab_size], or a tuple of
+                [batch_size, k] candidate scores and their token ids.
+        """
+        if isinstance(scores, tuple):
+            values, token_ids = scores
+            if all(fsm is None for fsm in self.fsms):
+                return scores
+            batch_size, _ = values.shape
+            mask = self.mask()[:batch_size]
+            _, vocab_size = mask.shape
+            allowed = mask.gather(1, token_ids.clamp(max=vocab_size - 1)) & (token_ids < vocab_size)
+            return values.masked_fill(~allowed, float('-inf')), token_ids
+        batch_size, vocab_size = scores.shape
+        mask = self.mask(vocab_size)[:batch_size, :vocab_size]
+        return scores.masked_fill(~mask, float('-inf'))
+
+    def advance(self, token_ids):
+        """
+        Advance every constrained row by its sampled token.
+
+        Arguments:
+            token_ids: The sampled tokens of shape [batch_size, 1].
+        """
+        for row, token_id in enumerate(token_ids.flatten().tolist()):
+            fsm = self.fsms[row]
+            if fsm is not None:
+                self.states[row] = fsm.advance(self.states[row], token_id)
+
+
+def pack_token_mask(mask):
+    """
+    Pack a boolean token mask into 32-bit words for on-device masking.
+
+    Bit `v % 32` of word `v // 32` holds the mask of token `v`.
+
+    Arguments:
+        mask: The boolean mask of shape [batch_size, vocab_size].
+
+    Returns:
+        packed: An int32 tensor of shape [ceil(vocab_size / 32), batch_size].
+    """
+    batch_size, vocab_size = mask.shape
+    words = (vocab_size + 31) // 32
+    mask = torch.nn.functional.pad(mask, (0, words * 32 - vocab_size))
+    bits = mask.reshape(batch_size, words, 32).to(torch.int64) << torch.arange(32)
+    packed = bits.sum(dim=-1)
+    packed = torch.where(packed >= 2 ** 31, packed - 2 ** 32, packed)
+    return packed.to(torch.int32).transpose(0, 1).contiguous()
+
+
+WHITESPACE = r'[ ]?'
+STRING = r'"(?:[^"\\\x00-\x1f]|\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4}))*"'
+INTEGER = r'-?(?:0|[1-9][0-9]*)'
+NUMBER = INTEGER + r'(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?'
+BOOLEAN = r'(?:true|false)'
+NULL = r'null'
+# Regular expressions cannot match arbitrarily nested values, so unconstrained values nest up to this depth
+VALUE_DEPTH = 2
+
+
+def escape(text):
+    return ''.join('\\' + char if char in '\\.^$|?*+()[]{}' else char for char in text)
+
+
+def json_value_regex(depth=VALUE_DEPTH, kind=None):
+    """
+    Get a regular expression which matches any JSON value (or any value of `kind` object or array).
+
+    Arrays and objects nest up to `depth` levels.
+    """
+    separator = WHITESPACE + ',' + WHITESPACE
+    value = json_value_regex(depth - 1) if depth > 0 else None
+    kinds = {'scalar': '(?:' + '|'.join([STRING, NUMBER, BOOLEAN, NULL]) + ')'}
+    if value is not None:
+        member = STRING + WHITESPACE + ':' + WHITESPACE + value
+        kinds['array'] = r'\[' + WHITESPACE + f'(?:{value}(?:{separator}{value})*)?' + WHITESPACE + r'\]'
+        kinds['object'] = r'\{' + WHITESPACE + f'(?:{member}(?:{separator}{member})*)?' + WHITESPACE + r'\}'
+    else:
+        kinds['array'] = r'\[' + WHITESPACE + r'\]'
+        kinds['object'] = r'\{' + WHITESPACE + r'\}'
+    if kind is not None:
+        return kinds[kind]
+    return '(?:' + '|'.join(kinds.values()) + ')'
+
+
+def json_schema_to_regex(schema):
+    """
+    Convert a JSON schema into a regular expression which matches its instances.
+
+    Supports `type` (object, array, string, integer, number, boolean, null or a
+    list of types), `properties`, `items`, `enum`, `const`, `anyOf`, `oneOf`,
+    `pattern` and `minItems`/`maxItems`. Object properties are emitted in
+    schema order and every property is generated. A schema without a type
+    (e.g. `{}` or `true`), an object without `properties` and array items
+    without a schema match any JSON value (see `json_value_regex`).
+    """
+    if isinstance(schema, str):
+        schema = json.loads(schema)
+    if schema is True:
+        return json_value_regex()
+    if not isinstance(schema, dict):
+        raise ValueError(f'Unsupported JSON schema: {schema}')
+    if 'const' in schema:
+        return escape(json.dumps(schema['const']))
+    if 'enum' in schema:
+        return '(?:' + '|'.join(escape(json.dumps(value)) for value in schema['enum']) + ')'
+    for key in 'anyOf', 'oneOf':
+        if key in schema:
+            return '(?:' + '|'.join(json_schema_to_regex(option) for option in schema[key]) + ')'
+    kind = schema.get('type')
+    if kind is None and 'properties' not in schema:
+        return json_value_regex()
+    if isinstance(kind, list):
+        return '(?:' + '|'.join(json_schema_to_regex({**schema, 'type': option}) for option in kind) + ')'
+    if kind == 'object' and 'properties' not in schema:
+        return json_value_regex(kind='object')
+    if kind == 'object' or 'properties' in schema:
+        members = []
+        for name, value in schema.get('properties', {}).items():
+            members.append(escape(json.dumps(name)) + WHITESPACE + ':' + WHITESPACE + json_schema_to_regex(value))
+        separator = WHITESPACE + ',' + WHITESPACE
+        return r'\{' + WHITESPACE + separator.join(members) + WHITESPACE + r'\}'
+    if kind == 'array':
+        item = json_schema_to_regex(schema.get('items', {}))
+        low = schema.get('minItems', 0)
+        high = schema.get('maxItems')
+        rest = f'(?:{WHITESPACE},{WHITESPACE}{item})'
+        if high == 0:
+            items = ''
+        elif low == 0:
+            bounds = '*' if high is None else f'{{0,{high - 1}}}'
+            items = f'(?:{item}{rest}{bounds})?'
+        else:
+            bounds = f'{{{low - 1},}}' if high is None else f'{{{low - 1},{high - 1}}}'
+            items = f'{item}{rest}{bounds}'
+        return r'\[' + WHITESPACE + items + WHITESPACE + r'\]'
+    if kind == 'string':
+        if 'pattern' in schema:
+            return '"' + schema['pattern'].lstrip('^').rstrip('$') + '"'
+        return STRING
+    if kind == 'integer':
+        return INTEGER
+    if kind == 'number':
+        return NUMBER
+    if kind == 'boolean':
+        return BOOLEAN
+    if kind == 'null':
+        return NULL
+    raise ValueError(f'Unsupported JSON schema: {schema}')
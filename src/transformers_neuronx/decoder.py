@@ -14,7 +14,9 @@
 # ==============================================================================
 import pickle
 import os
+import threading
 import torch
+from transformers_neuronx import bucket
 from transformers_neuronx import compiler
 from transformers_neuronx import dtypes
 from transformers_neuronx import hlo
@@ -22,7 +24,8 @@ from transformers_neuronx import ops
 from transformers_neuronx import parallel
 from transformers_neuronx import utils
 from transformers_neuronx import quantize
-from concurrent.futures import ProcessPoolExecutor
+from transformers_neuronx.config import U8EncodingConfig
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 
 
 class DecoderLmHeadForSamplingNoEmbedding(torch.nn.Module):
@@ -48,6 +51,7 @@ class DecoderLmHeadForSamplingNoEmbedding(torch.nn.Module):
         self.ln_f_bias = None
         self.lm_head_weight = None
         self.lm_head_bias = None
+        self.lm_head_scales = None
         self.inputs_sdim = None
         self.inputs_builder = None
         self.layer_builder = None
@@ -59,12 +63,114 @@ class DecoderLmHeadForSamplingNoEmbedding(torch.nn.Module):
         self.allow_pad = allow_pad
         self.use_executor = False
         self.return_ranks = -1
+        self.input_slices = {}
+        self.vocab_size = None
+        self.num_beams = None
+        self.logits_processors = None
+        self.weight_stream = None
+        # Whether the caller samples from top-k candidates (see `decode_logits`)
+        self.return_candidates = False
+        # The first row of this network in caches shared with a larger batch (see `build_weight_shared`)
+        self.batch_offset = 0
+        # The network whose program holds the pending reorder of the caches (see `build_weight_shared`)
+        self.caches_owner = self
+        # Whether the network reorders the caches at the start of the step (see `setup_reorder_cache`)
+        self.fused_reorder = False
+        self.reorder_network = None
 
     def enable_executor(self, return_ranks=-1):
         self.use_executor = True
         self.return_ranks = return_ranks
+        if self.replicated_logits:
+            # Compacted logits and beam candidates are replicated on every rank
+            self.return_ranks = 1
         self.program.enable_executor()
 
+    def enable_beam_search(self, num_beams):
+        """
+        Run a beam search step inside the token generation network.
+
+        The network takes two extra inputs, the f32 running beam scores and
+        the s64 source rows of each beam of shape [batch_size]. The KV caches
+        are reordered by the source rows before attention. Instead of logits
+        the network returns the best `2 * num_beams` candidates of each batch
+        line (see `hlo.beam_search_step`).
+
+        Must be called prior to `to_neuron`. Only supported for fully unrolled
+        single token networks.
+        """
+        if self.batch_size % num_beams:
+            raise ValueError(f'batch_size={self.batch_size} is not a multiple of num_beams={num_beams}')
+        self.num_beams = num_beams
+
+    @property
+    def replicated_logits(self):
+        return self.logits_config is not None or self.num_beams is not None
+
+    @property
+    def sparse_logits(self):
+        # Beam networks return candidates instead of logits and never compact them
+        return self.num_beams is None and self.logits_config is not None and self.logits_config.top_k is not None
+
+    @property
+    def logits_config(self):
+        if self.neuron_config is None:
+            return None
+        return self.neuron_config.logits
+
+    @property
+    def logits_processor_config(self):
+        if self.neuron_config is None:
+            return None
+        return self.neuron_config.logits_processors
+
+    def set_logits_processors(self, repetition_penalty=1.0, presence_penalty=0.0, frequency_penalty=0.0,
+                              logit_bias=None):
+        """
+        Set the penalties and logit bias applied on device before the logits are returned.
+
+        Each penalty is either a single value or one value per row. The
+        `logit_bias` is either a single {token_id: bias} dict or one dict per
+        row. Values persist until they are set again and are shared by every
+        network which shares the caches of this network.
+
+        Requires `NeuronConfig(logits_processors=LogitsProcessorConfig(...))`.
+        """
+        if self.logits_processors is None:
+            raise ValueError('set_logits_processors requires NeuronConfig.logits_processors to be set')
+        self.logits_processors.set(repetition_penalty, presence_penalty, frequency_penalty, logit_bias)
+
+    def set_token_mask(self, token_mask=None):
+        """
+        Set the packed mask of allowed tokens of each row (see `constraints.pack_token_mask`).
+
+        The mask persists until it is set again. None allows every token.
+        Requires `LogitsProcessorConfig(token_mask=True)`.
+        """
+        if self.logits_processors is None or self.logits_processors.token_mask is None:
+            raise ValueError('set_token_mask requires LogitsProcessorConfig.token_mask to be set')
+        self.logits_processors.set_token_mask(token_mask)
+
+    def decode_logits(self, logits):
+        """
+        Split top-k logits candidates into their values and vocabulary indices.
+
+        When `LogitsConfig.top_k` is set, the network returns the top-k values
+        followed by their vocabulary indices. This returns the tuple
+        (values, indices), each of shape [k, n_active_tokens, batch_size], so
+        that the sampler selects from the candidates without building full
+        vocabulary logits on the host. Candidates from vocab padding have a
+        value of -inf. Any other output (including beam candidates) is
+        returned unmodified.
+        """
+        if not self.sparse_logits:
+            return logits
+        values, indices = logits.chunk(2, dim=0)
+        indices = indices.to(torch.int64)
+        padding = indices >= self.vocab_size
+        values = values.masked_fill(padding, float('-inf'))
+        return values, indices.masked_fill(padding, 0)
+
     def add_inputs_builder(self, inputs_builder):
         self.inputs_builder = inputs_builder
 
@@ -97,6 +203,8 @@ class DecoderLmHeadForSamplingNoEmbedding(torch.nn.Module):
         self.lm_head_bias = bias
 
     def to_neuron(self):
+        if self.sparse_logits and not self.return_candidates:
+            raise NotImplementedError('LogitsConfig.top_k requires a model which samples from top-k candidates')
         manipulator = MaybeParallelTensorManipulator(self.tp_degree)
 
         extras = []
@@ -111,22 +219,52 @@ class DecoderLmHeadForSamplingNoEmbedding(torch.nn.Module):
         self.ln_f_weight = manipulator.duplicate(self.ln_f_weight)
         self.ln_f_bias = manipulator.duplicate(self.ln_f_bias)
         _, vocab_size = self.lm_head_weight.shape
+        self.vocab_size = vocab_size
         # Pad vocab size such that it can be divided by the following factor
         divisor = int(os.environ.get('NEURON_VOCAB_PAD_DIVISOR', str(self.tp_degree)))
         vocab_pad = utils.pad_vocab_size(vocab_size, divisor)
         lm_head_weight = torch.nn.functional.pad(self.lm_head_weight, (0, vocab_pad, 0, 0))
+        if self.neuron_config and self.neuron_config.quant and self.neuron_config.quant.quantize_lm_head:
+            lm_head_weight, lm_head_scales = quantize.maybe_quantize_weights(lm_head_weight, self.neuron_config.quant)
+            # Per-vocab scales are a vector while group-wise scales have the layout of the weight
+            scales_dim = 1 if self.neuron_config.quant.group_wise else 0
+            self.lm_head_scales = manipulator.shard_along(lm_head_scales, dim=scales_dim)
         self.lm_head_weight = manipulator.shard_along(lm_head_weight, dim=1)
+        if self.logits_processor_config is not None:
+            self.logits_processors = LogitsProcessorState(
+                vocab_size + vocab_pad, self.batch_size, self.logits_processor_config.max_logit_bias, self.tp_degree,
+                token_mask=self.logits_processor_config.token_mask)
         ln_lm_head_params = [*self.pre_layer_parameters, self.ln_f_weight, self.ln_f_bias, self.lm_head_weight]
         ln_lm_head_params = [param for param in ln_lm_head_params if param is not None]
         if self.lm_head_bias is not None:
             self.lm_head_bias = manipulator.shard_along(self.lm_head_bias, dim=0)
             ln_lm_head_params.append(self.lm_head_bias)
+        if self.lm_head_scales is not None:
+            ln_lm_head_params.append(self.lm_head_scales)
 
         self.program = self._build_program()
         self.program.setup(self.layers, ln_lm_head_params)
+        self.program.setup_reset_cache()
 
     def build_weight_shared(self, n_positions_list=None, n_active_tokens=None, batch_size=None,
-                            unroll=None, share_caches=False):
+                            unroll=None, share_caches=False, num_beams=None, batch_offset=0,
+                            fused_reorder=False):
+        """
+        Build a new network which uses the weights of this network.
+
+        When `share_caches` is set, the new network also uses the KV caches
+        (and the logits processor state) of this network and sees reorders
+        made through any of them. A smaller `batch_size` runs on the rows
+        starting at `batch_offset` of the shared caches: the network takes
+        the full caches and slices its rows inside the graph, so no rows are
+        copied between networks when the batch size changes. Otherwise the
+        new network owns its caches.
+
+        When `num_beams` is set, the new network runs a beam search step (see
+        `enable_beam_search`). When `fused_reorder` is set, the new network
+        takes the reorder ids as an extra input (before the token ids) and
+        reorders the shared caches at the start of the step.
+        """
         if n_positions_list is None:
             n_positions_list = self.n_positions_list
         if n_active_tokens is None:
@@ -135,6 +273,13 @@ class DecoderLmHeadForSamplingNoEmbedding(torch.nn.Module):
             batch_size = self.batch_size
         if unroll is None:
             unroll = self.unroll
+        if not share_caches and batch_offset:
+            raise ValueError(f'batch_offset={batch_offset} requires share_caches=True')
+        if fused_reorder and not share_caches:
+            raise ValueError('fused_reorder requires share_caches=True')
+        if share_caches and (batch_offset < 0 or batch_offset + batch_size > self.batch_size):
+            raise ValueError(f'Rows [{batch_offset}, {batch_offset + batch_size}) do not fit in the '
+                             f'batch_size={self.batch_size} caches')
         new = DecoderLmHeadForSamplingNoEmbedding(
             self.tp_degree, n_positions_list, n_active_tokens, batch_size, self.attention_head_size,
             self.amp, self.num_layers, unroll, neuron_config=self.neuron_config, allow_pad=self.allow_pad,
@@ -144,6 +289,22 @@ class DecoderLmHeadForSamplingNoEmbedding(torch.nn.Module):
         new.add_pre_layer_builder(self.pre_layer_builder)
         new.add_layer_builder(self.layer_builder)
         new.add_ln_lm_head_builder(self.ln_lm_head_builder)
+        new.vocab_size = self.vocab_size
+        new.return_candidates = self.return_candidates
+        if num_beams is not None:
+            new.enable_beam_search(num_beams)
+        new.fused_reorder = fused_reorder
+        if share_caches:
+            new.caches_owner = self.caches_owner
+            new.batch_offset = self.batch_offset + batch_offset
+        if self.logits_processors is not None:
+            # The token counts follow the caches
+            if share_caches:
+                new.logits_processors = self.logits_processors
+            else:
+                new.logits_processors = LogitsProcessorState(
+                    self.logits_processors.vocab_size, batch_size, self.logits_processors.max_logit_bias,
+                    self.tp_degree, token_mask=self.logits_processors.token_mask is not None)
         for layer in self.layers:
             new_layer = new.new_layer()
             new_layer.assign_parameters(layer)
@@ -153,69 +314,201 @@ class DecoderLmHeadForSamplingNoEmbedding(torch.nn.Module):
                 new_layer.init_caches()
             new_layer.extra_parameters = layer.extra_parameters
         new.pre_layer_parameters = self.pre_layer_parameters
+        new.weight_stream = self.weight_stream
         new.add_final_layer_norm(self.ln_f_weight, self.ln_f_bias)
         new.add_lm_head(self.lm_head_weight, self.lm_head_bias)
+        new.lm_head_scales = self.lm_head_scales
         ln_lm_head_params = [*new.pre_layer_parameters, new.ln_f_weight, new.ln_f_bias, new.lm_head_weight]
         ln_lm_head_params = [param for param in ln_lm_head_params if param is not None]
         if new.lm_head_bias is not None:
             ln_lm_head_params.append(new.lm_head_bias)
+        if new.lm_head_scales is not None:
+            ln_lm_head_params.append(new.lm_head_scales)
         new.program = new._build_program()
         new.program.setup(new.layers, ln_lm_head_params)
         return new
 
+    def build_cache_fanout(self, source, n_positions):
+        """
+        Build a kernel which copies rows of the `source` network caches into this network's caches.
+
+        This allows a prompt to be encoded once by a small batch `source`
+        network and fanned out on device to every row that shares it (e.g.
+        identical prompts in a batch or multiple samples of one prompt). Only
+        the first `n_positions` positions are copied. Pending reorders of
+        either network must be flushed before running it (see
+        `flush_reorder_cache`).
+
+        Returns:
+            fanout: A `FastCacheFanout` which is run with the source row of each target row.
+        """
+        _, from_batch_size, n_heads_tp, d_head = source.layers[0].cache_shape
+        fanout = FastCacheFanout(n_positions, from_batch_size, self.batch_size, n_heads_tp, d_head,
+                                 self.amp, self.tp_degree, self.num_layers)
+        manipulator = parallel.ParallelTensorManipulator(self.tp_degree)
+        source_caches = []
+        for layer in source.layers:
+            for cache in layer.attn_k_cache, layer.attn_v_cache:
+                source_caches.append(manipulator.slice_on_nc(cache, 0, start=0, end=n_positions, step=1))
+        target_caches = []
+        for layer in self.layers:
+            for cache in layer.attn_k_cache, layer.attn_v_cache:
+                target_caches.append(manipulator.slice_on_nc(cache, 0, start=0, end=n_positions, step=1))
+        fanout.setup(source_caches, target_caches)
+        return fanout
+
+    def build_prompt_fanout(self, n_positions, prompt_batch_size, unroll=None):
+        """
+        Build networks which encode each unique prompt of a batch once and fan its caches out to this network.
+
+        Arguments:
+            n_positions: The context length encoded by the prompt networks.
+            prompt_batch_size: The maximum number of unique prompts (or a list of batch sizes).
+            unroll: The number of layers unrolled in the prompt networks.
+
+        Returns:
+            prompt_fanout: A `PromptFanout` into the caches of this network.
+        """
+        return PromptFanout(self, n_positions, prompt_batch_size, unroll)
+
+    def build_cache_swapper(self, max_bytes=None):
+        """
+        Build a swapper which copies the cache rows of sequences between this network and host.
+
+        Every network sharing these caches (see `build_weight_shared`) sees
+        the rows restored by the swapper.
+
+        Arguments:
+            max_bytes: The maximum host bytes held by swapped out sequences.
+
+        Returns:
+            swapper: A `CacheSwapper` over the caches of every layer.
+        """
+        return CacheSwapper(self, max_bytes)
+
     def reset(self):
+        program = self.caches_owner.program
+        if program is not None:
+            program.pending_reorder_ids = None
+        # The network owning the caches zeros them (and the state shared with
+        # them) on device for every network sharing them. Other networks
+        # (e.g. weight-shared networks with separate caches) use a host write
+        if program is not None and program.reset_cache_hlo_kernel is not None:
+            program.reset_cache()
+            return
         for layer in self.layers:
             layer.reset()
+        if self.logits_processors is not None:
+            self.logits_processors.reset()
 
-    def forward_single(self, *inputs):
+    def forward_single(self, *inputs, position=None):
         """
         Fast-path forward function which avoids as much overhead as possible.
 
         This path makes the assumption that inputs are correctly sized for a
         sequence length of 1. This allows us to avoid checking buckets, slicing,
         etc.
+
+        When the caller already knows the cache id being written, passing it as
+        `position` avoids reading it back from the `cache_ids` tensor.
         """
-        _, cache_ids, *_ = inputs
-        bucket_id = self.program.find_bucket_id(cache_ids.item())
+        if position is None:
+            _, cache_ids, *_ = inputs
+            position = cache_ids.item()
+        owner = self.caches_owner.program
+        if self.reorder_network is not None and owner.pending_reorder_ids is not None:
+            # Reorder the caches inside the step instead of running the reorder kernel first
+            reorder_ids = owner.pending_reorder_ids
+            owner.pending_reorder_ids = None
+            num_inputs = len(inputs) - (self.logits_processors is not None)
+            inputs = (*inputs[:num_inputs], reorder_ids, *inputs[num_inputs:])
+            return self.reorder_network.forward_single(*inputs, position=position)
+        bucket_id = self.program.find_bucket_id(position)
+        self.flush_reorder_cache(position)
         if self.use_executor:
-            return self.program.execute(bucket_id, *inputs, return_ranks=self.return_ranks)
+            logits = self.program.execute(bucket_id, *inputs, return_ranks=self.return_ranks)
         else:
             self.program.inputs_host_to_device(inputs)
             self.program.run(bucket_id)
-            return self.program.logits_device_to_host()
+            logits = self.program.logits_device_to_host()
+        return self.decode_logits(logits)
+
+    def forward_async(self, *inputs, position=None):
+        """
+        Submit a single token step without waiting for it to complete.
+
+        This allows host work (sampling, embedding the next tokens) for one
+        micro-batch to overlap with device execution of another. Steps
+        submitted to the same network execute in order. Requires
+        `enable_executor`.
+
+        Returns:
+            future: A `concurrent.futures.Future` for the logits.
+        """
+        if not self.use_executor:
+            raise NotImplementedError('forward_async requires enable_executor()')
+        if position is None:
+            _, cache_ids, *_ = inputs
+            position = cache_ids.item()
+        bucket_id = self.program.find_bucket_id(position)
+        self.flush_reorder_cache(position)
+        future = self.program.submit(bucket_id, *inputs, return_ranks=self.return_ranks)
+        if not self.sparse_logits:
+            return future
+
+        decoded = Future()
+
+        def decode(done):
+            try:
+                decoded.set_result(self.decode_logits(done.result()))
+            except Exception as error:
+                decoded.set_exception(error)
+
+        future.add_done_callback(decode)
+        return decoded
+
+    def forward(self, *inputs, position=None):
+        """
+        Execute the network on a sequence of one or more tokens.
 
-    def forward(self, *inputs):
+        Arguments:
+            inputs: The network inputs (hidden, cache_ids, ...).
+            position: The first cache id of the inputs if it is known by the
+                caller. The cache ids must then be contiguous. This allows
+                selecting buckets without tensor reductions on `cache_ids`.
+        """
         hidden, *_ = inputs
         sequence_dim, *_ = self.inputs_sdim
         sequence_length = hidden.shape[sequence_dim]
         if sequence_length == 1:
-            return self.forward_single(*inputs)
+            return self.forward_single(*inputs, position=position)
         if sequence_length % self.n_active_tokens:
             raise ValueError(f'sequence_length={sequence_length} cannot be divided by '
                              f'n_active_tokens={self.n_active_tokens}')
         outputs = None
         for start in range(0, sequence_length, self.n_active_tokens):
-            slicing = slice(start, start + self.n_active_tokens)
-            input_tensors = []
-            for sdim, tensor in zip(self.inputs_sdim, inputs):
-                if sdim is not None:
-                    slices = [slice(None) for _ in tensor.shape]
-                    slices[sdim] = slicing
-                    tensor = tensor[tuple(slices)].contiguous()
-                input_tensors.append(tensor)
-            _, cache_ids, *_ = input_tensors
-            max_id = cache_ids.max().item()
-            min_id = cache_ids.min().item()
-            # When context_length == m * n_active_tokens, bucket-size of n_active_tokens should be chosen.
-            # This is useful for Fusion-In-Decoder case, where 2nd n_active_tokens don't need to attend to
-            # 1st n_active_tokens.
-            if max_id - min_id > 1:
-                max_id -= min_id
-                min_id = 0
+            if sequence_length == self.n_active_tokens:
+                input_tensors = inputs
+            else:
+                input_tensors = self._slice_inputs(inputs, start)
+            if position is None:
+                _, cache_ids, *_ = input_tensors
+                max_id = cache_ids.max().item()
+                min_id = cache_ids.min().item()
+                # When context_length == m * n_active_tokens, bucket-size of n_active_tokens should be chosen.
+                # This is useful for Fusion-In-Decoder case, where 2nd n_active_tokens don't need to attend to
+                # 1st n_active_tokens.
+                if max_id - min_id > 1:
+                    max_id -= min_id
+                    min_id = 0
+            else:
+                min_id = position + start
+                max_id = min_id + self.n_active_tokens - 1
             bucket_id = self.program.find_bucket_id(max_id)
             if self.program.find_bucket_id(min_id) != bucket_id:
                 raise ValueError(f'given buckets {self.n_positions_list}, ids ranging from '
                                  f'{min_id} to {max_id} do not fall into the same bucket')
+            self.flush_reorder_cache(max_id)
             if self.use_executor:
                 outputs = self.program.execute(bucket_id, *input_tensors, return_ranks=self.return_ranks)
             else:
@@ -224,7 +517,24 @@ class DecoderLmHeadForSamplingNoEmbedding(torch.nn.Module):
 
         if not self.use_executor:
             outputs = self.program.logits_device_to_host()
-        return outputs
+        return self.decode_logits(outputs)
+
+    def _slice_inputs(self, inputs, start):
+        # Reuse the indexing tuples for each offset since they only depend on input ranks
+        indices = self.input_slices.get(start)
+        if indices is None:
+            slicing = slice(start, start + self.n_active_tokens)
+            indices = []
+            for sdim, tensor in zip(self.inputs_sdim, inputs):
+                index = None
+                if sdim is not None:
+                    index = [slice(None) for _ in tensor.shape]
+                    index[sdim] = slicing
+                    index = tuple(index)
+                indices.append(index)
+            self.input_slices[start] = indices
+        return [tensor if index is None else tensor[index].contiguous()
+                for index, tensor in zip(indices, inputs)]
 
     def embed_positions_ids(self, position_ids, start_ids=None):
         batch_size = self.batch_size
@@ -243,18 +553,46 @@ class DecoderLmHeadForSamplingNoEmbedding(torch.nn.Module):
         self.compiler_artifacts_path = path
 
     def _build_program(self):
+        weight_streaming = self.neuron_config.weight_streaming if self.neuron_config else None
+        if weight_streaming is not None:
+            if self.unroll == self.num_layers:
+                raise ValueError(f'Weight streaming requires unroll < num_layers (unroll={self.unroll}). '
+                                 f'Context encoding networks must also be partially unrolled')
+            if self.neuron_config.sparse_attn is not None:
+                raise NotImplementedError('Weight streaming does not support sparse attention')
         if self.unroll == self.num_layers:
             hlo_modules = [self._hlo_fully_unrolled(npos) for npos in self.n_positions_list]
             num_inputs = len(self.inputs_sdim)
             program = DecoderProgramFullyUnrolled(self.layers, hlo_modules, num_inputs, self.tp_degree, self.prefixed_length)
         else:
-            if utils.amp_is_u8(self.amp):
-                raise NotImplementedError(f'amp={self.amp} only supports fully unrolled decoder')
+            if self.num_beams is not None:
+                raise NotImplementedError(f'num_beams={self.num_beams} only supports fully unrolled decoder')
+            if self.fused_reorder:
+                raise NotImplementedError('fused_reorder only supports fully unrolled decoder')
             hlo_modules = [self._hlo_multi_layer(npos) for npos in self.n_positions_list]
             ln_lm_head_hlo_module = self._hlo_ln_lm_head()
             num_inputs = len(self.inputs_sdim)
-            program = DecoderProgramMultiLayer(self.layers, hlo_modules, ln_lm_head_hlo_module, num_inputs,
-                                               self.num_layers, self.unroll, self.tp_degree, self.prefixed_length)
+            num_pre_layer_params = 0
+            if self.pre_layer_builder is not None:
+                num_pre_layer_params = len([param for param in self.pre_layer_parameters if param is not None])
+            if weight_streaming is not None:
+                if self.weight_stream is None:
+                    self.weight_stream = LayerWeightStream(self.layers, self.unroll, weight_streaming)
+                if self.weight_stream.unroll != self.unroll:
+                    raise ValueError(f'Networks sharing streamed weights must use the same unroll. '
+                                     f'Found unroll={self.unroll} and unroll={self.weight_stream.unroll}')
+                program = DecoderProgramStreamedMultiLayer(self.layers, hlo_modules, ln_lm_head_hlo_module, num_inputs,
+                                                           self.num_layers, self.unroll, self.tp_degree,
+                                                           self.weight_stream, self.prefixed_length,
+                                                           num_pre_layer_params=num_pre_layer_params)
+            else:
+                program = DecoderProgramMultiLayer(self.layers, hlo_modules, ln_lm_head_hlo_module, num_inputs,
+                                                   self.num_layers, self.unroll, self.tp_degree, self.prefixed_length,
+                                                   num_pre_layer_params=num_pre_layer_params)
+        program.replicated_logits = self.replicated_logits
+        if self.logits_processors is not None:
+            program.state_buffers = self.logits_processors.inputs()
+            program.state_outputs = self.logits_processors.outputs()
         if self.compiler_artifacts_path is not None:
             with open(self.compiler_artifacts_path, 'rb') as f:
                 kernels_neff_bytes = pickle.load(f)
@@ -268,6 +606,20 @@ class DecoderLmHeadForSamplingNoEmbedding(torch.nn.Module):
             dtype = getattr(scribe, amp)
             (hidden, *tensors), self.inputs_sdim = self.inputs_builder(
                 scribe, dtype, n_positions, self.n_active_tokens, self.batch_size)
+            beam_scores = reorder_ids = None
+            if self.num_beams is not None:
+                num_inputs = len(self.inputs_sdim)
+                beam_scores = scribe.f32[self.batch_size].Parameter(parameter_number=num_inputs)
+                self.inputs_sdim = (*self.inputs_sdim, None)
+            if self.num_beams is not None or self.fused_reorder:
+                num_inputs = len(self.inputs_sdim)
+                reorder_ids = scribe.s64[self.batch_size].Parameter(parameter_number=num_inputs)
+                self.inputs_sdim = (*self.inputs_sdim, None)
+            token_ids = None
+            if self.logits_processors is not None:
+                num_inputs = len(self.inputs_sdim)
+                token_ids = scribe.s32[self.n_active_tokens, self.batch_size].Parameter(parameter_number=num_inputs)
+                self.inputs_sdim = (*self.inputs_sdim, 0)
             param_builder = DecoderParameterBuilder(scribe, len(self.inputs_sdim))
             layers_caches, layers_weights = self._hlo_layers_params(param_builder, self.layers, n_positions)
             hidden, tensors = self._hlo_pre_layer(hidden, tensors, param_builder)
@@ -275,13 +627,26 @@ class DecoderLmHeadForSamplingNoEmbedding(torch.nn.Module):
             ln_f_bias = param_builder.from_tensor(self.ln_f_bias)
             head_weight = param_builder.from_tensor(self.lm_head_weight)
             head_bias = param_builder.from_tensor(self.lm_head_bias)
-            hidden, out_caches = self._hlo_layers(hidden, tensors, self.layers, layers_caches, layers_weights)
+            head_scales = param_builder.from_tensor(self.lm_head_scales)
+            processor_params = None
+            if self.logits_processors is not None:
+                processor_params = self.logits_processors.hlo_params(param_builder)
+            hidden, out_caches = self._hlo_layers(hidden, tensors, self.layers, layers_caches, layers_weights,
+                                                  reorder_ids)
             ln_f_weight = maybe_transfer_with_static_ring(ln_f_weight)
             ln_f_bias = maybe_transfer_with_static_ring(ln_f_bias)
             head_weight = maybe_transfer_with_static_ring(head_weight)
             head_bias = maybe_transfer_with_static_ring(head_bias)
-            logits = self.ln_lm_head_builder(hidden, ln_f_weight, ln_f_bias, head_weight, head_bias)
-            outputs = [logits, *out_caches]
+            head_scales = maybe_transfer_with_static_ring(head_scales)
+            logits = self._hlo_lm_head(hidden, ln_f_weight, ln_f_bias, head_weight, head_bias, head_scales, dtype)
+            out_states = []
+            if processor_params is not None:
+                logits, out_states = self._hlo_logits_processors(logits, token_ids, processor_params, reorder_ids)
+            if self.num_beams is not None:
+                logits = hlo.beam_search_step(logits, beam_scores, self.vocab_size, self.num_beams, self.tp_degree)
+            else:
+                logits = self._hlo_compact_logits(logits)
+            outputs = [logits, *out_caches, *out_states]
             root_shapes = [shape.dtype[shape.sizes] for shape in outputs]
             return scribe.tuple(*root_shapes).Tuple(*outputs)
 
@@ -290,9 +655,15 @@ class DecoderLmHeadForSamplingNoEmbedding(torch.nn.Module):
     def _hlo_multi_layer(self, n_positions):
 
         def multi_layer(scribe):
-            dtype = getattr(scribe, self.amp)
+            amp, _, _ = utils.parse_amp(self.amp)
+            dtype = getattr(scribe, amp)
             (hidden, *tensors), self.inputs_sdim = self.inputs_builder(
                 scribe, dtype, n_positions, self.n_active_tokens, self.batch_size)
+            if self.logits_processors is not None:
+                # The token ids are only read by the language model head
+                num_inputs = len(self.inputs_sdim)
+                scribe.s32[self.n_active_tokens, self.batch_size].Parameter(parameter_number=num_inputs)
+                self.inputs_sdim = (*self.inputs_sdim, 0)
             param_builder = DecoderParameterBuilder(scribe, len(self.inputs_sdim))
             # use the first `unroll` layers to build the HLO -- assuming all layers are same
             layers = self.layers[:self.unroll]
@@ -330,23 +701,43 @@ class DecoderLmHeadForSamplingNoEmbedding(torch.nn.Module):
             layers_weights.append(layer_weights)
         return layers_caches, layers_weights
 
-    def _hlo_layers(self, hidden, tensors, layers, layers_caches, layers_weights):
+    def _hlo_layers(self, hidden, tensors, layers, layers_caches, layers_weights, reorder_ids=None):
         output_caches = []
         for layer, caches, weights in zip(layers, layers_caches, layers_weights):
-            in_caches = [hlo.transfer_with_static_ring(cache) for cache in caches]
+            in_caches = [self._hlo_rows(hlo.transfer_with_static_ring(cache)) for cache in caches]
+            if reorder_ids is not None:
+                in_caches = [hlo.index_select(cache, 1, reorder_ids) for cache in in_caches]
             weights = [maybe_transfer_with_static_ring(weight) for weight in weights]
             weights = layer.hlo_maybe_dequantize_weights(weights)
             hidden, *out_caches = self.layer_builder(hidden, *tensors, *in_caches, *weights)
             for out_cache, cache in zip(out_caches, caches):
+                out_cache = self._hlo_update_rows(cache, out_cache)
                 out_cache.set_alias_to(cache, must=True)
-            output_caches.extend(out_caches)
+                output_caches.append(out_cache)
         return hidden, output_caches
 
+    def _hlo_rows(self, buffer):
+        """
+        Slice the rows of this network out of a buffer with the shared batch in dimension 1.
+        """
+        if buffer is None or buffer.sizes[1] == self.batch_size:
+            return buffer
+        return hlo.slice_along(buffer, 1, self.batch_offset + self.batch_size, start=self.batch_offset)
+
+    def _hlo_update_rows(self, buffer, rows):
+        """
+        Write the rows of this network back into a buffer with the shared batch in dimension 1.
+        """
+        if buffer.sizes == rows.sizes:
+            return rows
+        return hlo.update_along(buffer, 1, rows, self.batch_offset)
+
     def _hlo_ln_lm_head(self):
         hidden_sizes = []
 
         def capture_hidden_sizes(scribe):
-            dtype = getattr(scribe, self.amp)
+            amp, _, _ = utils.parse_amp(self.amp)
+            dtype = getattr(scribe, amp)
             *_, n_positions = self.n_positions_list
             (hidden, *_), _ = self.inputs_builder(
                 scribe, dtype, n_positions, self.n_active_tokens, self.batch_size)
@@ -357,23 +748,125 @@ class DecoderLmHeadForSamplingNoEmbedding(torch.nn.Module):
         compiler.compile_py_func(capture_hidden_sizes)
 
         def ln_lm_head(scribe):
-            dtype = getattr(scribe, self.amp)
+            amp, _, _ = utils.parse_amp(self.amp)
+            dtype = getattr(scribe, amp)
             hidden = dtype[tuple(hidden_sizes)].Parameter(parameter_number=0)
             param_builder = DecoderParameterBuilder(scribe, 1)
+            token_ids = None
+            if self.logits_processors is not None:
+                token_ids = scribe.s32[self.n_active_tokens, self.batch_size].Parameter(parameter_number=1)
+                param_builder = DecoderParameterBuilder(scribe, 2)
             ln_f_weight = param_builder.from_tensor(self.ln_f_weight)
             ln_f_bias = param_builder.from_tensor(self.ln_f_bias)
             head_weight = param_builder.from_tensor(self.lm_head_weight)
             head_bias = param_builder.from_tensor(self.lm_head_bias)
-            return self.ln_lm_head_builder(hidden, ln_f_weight, ln_f_bias, head_weight, head_bias)
+            head_scales = param_builder.from_tensor(self.lm_head_scales)
+            logits = self._hlo_lm_head(hidden, ln_f_weight, ln_f_bias, head_weight, head_bias, head_scales, dtype)
+            if self.logits_processors is None:
+                return self._hlo_compact_logits(logits)
+            processor_params = self.logits_processors.hlo_params(param_builder)
+            logits, out_states = self._hlo_logits_processors(logits, token_ids, processor_params)
+            outputs = [self._hlo_compact_logits(logits), *out_states]
+            root_shapes = [shape.dtype[shape.sizes] for shape in outputs]
+            return scribe.tuple(*root_shapes).Tuple(*outputs)
 
         return compiler.compile_py_func(ln_lm_head)
 
+    def _hlo_lm_head(self, hidden, ln_f_weight, ln_f_bias, head_weight, head_bias, head_scales, dtype):
+        """
+        Run the family's lm_head builder on a possibly quantized lm_head weight.
+
+        Per-vocab (vector_dynamic) weights are only converted to the compute
+        dtype and the logits are rescaled per vocab column, as in `hlo.mmadd`,
+        so no f32 copy of the vocab shard is materialized. Group-wise scales
+        vary along the hidden dimension, so those weights are dequantized.
+        """
+        if head_scales is None:
+            return self.ln_lm_head_builder(hidden, ln_f_weight, ln_f_bias, head_weight, head_bias)
+        if not self.neuron_config.quant.group_wise:
+            _, vocab_shard = head_weight.sizes
+            weight = dtype[head_weight.sizes].Convert(head_weight)
+            logits = self.ln_lm_head_builder(hidden, ln_f_weight, ln_f_bias, weight, None)
+            # Builders which select tokens on device (e.g. greedy search) do not return logits
+            if logits.sizes[0] == vocab_shard:
+                logits_dtype = logits.dtype
+                logits = hlo.dequantize(logits, head_scales, self.neuron_config, 0)
+                logits = logits_dtype[logits.sizes].Convert(logits)
+                if head_bias is None:
+                    return logits
+                head_bias = logits_dtype[logits.sizes].Broadcast(head_bias, dimensions=[0])
+                return logits_dtype[logits.sizes].Add(logits, head_bias)
+        head_weight = hlo.dequantize_weight(head_weight, head_scales, self.neuron_config, 0)
+        head_weight = dtype[head_weight.sizes].Convert(head_weight)
+        return self.ln_lm_head_builder(hidden, ln_f_weight, ln_f_bias, head_weight, head_bias)
+
+    def _hlo_logits_processors(self, logits, token_ids, processor_params, reorder_ids=None):
+        vocab_ids, token_counts, *row_params = processor_params
+        penalties, bias_ids, bias_values, token_mask = [self._hlo_rows(param) for param in row_params]
+        counts = self._hlo_rows(token_counts)
+        if reorder_ids is not None:
+            counts = hlo.index_select(counts, 1, reorder_ids)
+        counts = hlo.update_token_counts(counts, vocab_ids, token_ids)
+        logits = hlo.apply_logits_processors(logits, counts, penalties, vocab_ids, bias_ids, bias_values)
+        if token_mask is not None:
+            logits = hlo.apply_token_mask(logits, token_mask, vocab_ids)
+        counts = self._hlo_update_rows(token_counts, counts)
+        counts.set_alias_to(token_counts, must=True)
+        return logits, [counts]
+
+    def _hlo_compact_logits(self, logits):
+        if self.logits_config is None:
+            return logits
+        dtype = None
+        if self.logits_config.dtype is not None:
+            dtype = getattr(logits.scribe, self.logits_config.dtype)
+        k = self.logits_config.top_k
+        if k is not None:
+            # Request extra candidates so that padding candidates cannot displace real tokens
+            vocab_shard, *_ = logits.sizes
+            k += vocab_shard * self.tp_degree - self.vocab_size
+        return hlo.compact_logits(logits, self.vocab_size, self.tp_degree, dtype=dtype, k=k)
+
     def reorder_cache(self, reorder_ids):
-        self.program.reorder_cache(reorder_ids)
+        self.caches_owner.program.reorder_cache(reorder_ids)
 
+    def flush_reorder_cache(self, position=None):
+        """
+        Apply the pending reorder of the caches before they are read.
+
+        The pending reorder is held by the network owning the caches so that
+        every network sharing them, and every copy out of or into them, sees
+        the reordered rows. Only the bucket covering `position` is reordered
+        (the whole cache when not given).
+        """
+        program = self.caches_owner.program
+        if program.pending_reorder_ids is None:
+            return
+        bucket_id = -1
+        if position is not None and position < len(program.bucket_ids):
+            bucket_id = program.bucket_ids[position]
+        program.flush_reorder_cache(bucket_id)
 
     def setup_reorder_cache(self):
-        self.program.setup_reorder_cache()
+        """
+        Prepare the caches to be reordered (see `reorder_cache`).
+
+        The reorder kernel of the caches owner applies a pending reorder
+        before any copy or context encoding reads the caches. Fully unrolled
+        token generation networks also build a weight-shared network which
+        takes the reorder ids as an input, so that `forward_single` folds a
+        pending reorder into the next token step instead of launching the
+        reorder kernel before it.
+        """
+        program = self.caches_owner.program
+        if not program.need_reorder_cache:
+            program.setup_reorder_cache()
+        fusable = (self.caches_owner is self and self.n_active_tokens == 1 and self.unroll == self.num_layers
+                   and self.num_beams is None)
+        if fusable and self.reorder_network is None:
+            self.reorder_network = self.build_weight_shared(share_caches=True, fused_reorder=True)
+            if self.use_executor:
+                self.reorder_network.enable_executor(self.return_ranks)
 
 
 def read_n_position(hlo_module, num_inputs):
@@ -401,6 +894,48 @@ class MaybePadder:
 
 class DecoderLayer(torch.nn.Module):
 
+    # The parameters returned first by `all_parameters`, in order
+    parameter_names = (
+        'pre_attn_ln_weight',
+        'pre_attn_ln_bias',
+        'attn_q_weight',
+        'attn_q_scales',
+        'attn_q_bias',
+        'attn_k_weight',
+        'attn_k_scales',
+        'attn_k_bias',
+        'attn_v_weight',
+        'attn_v_scales',
+        'attn_v_bias',
+        'attn_out_weight',
+        'attn_out_scales',
+        'attn_out_bias',
+        'post_attn_ln_weight',
+        'post_attn_ln_bias',
+        'pre_mlp_ln_weight',
+        'pre_mlp_ln_bias',
+        'mlp_in_weight',
+        'mlp_in_scales',
+        'mlp_in_bias',
+        'mlp_out_weight',
+        'mlp_out_scales',
+        'mlp_out_bias',
+        'sparse_mask',
+        'active_sparse_mask',
+        'post_mlp_ln_weight',
+        'post_mlp_ln_bias',
+    )
+
+    # The weights which may be u8 encoded, in the order of `u8_ranges`
+    u8_weight_names = (
+        'attn_q_weight',
+        'attn_k_weight',
+        'attn_v_weight',
+        'attn_out_weight',
+        'mlp_in_weight',
+        'mlp_out_weight',
+    )
+
     def __init__(self, tp_degree, n_positions, batch_size, attention_head_size, amp,
                  neuron_config=None, allow_pad=False, n_active_tokens=None):
         super().__init__()
@@ -430,18 +965,8 @@ class DecoderLayer(torch.nn.Module):
         self.mlp_out_bias = None
         self.post_mlp_ln_weight = None
         self.post_mlp_ln_bias = None
-        self.attn_q_min = None
-        self.attn_q_max = None
-        self.attn_k_min = None
-        self.attn_k_max = None
-        self.attn_v_min = None
-        self.attn_v_max = None
-        self.attn_out_min = None
-        self.attn_out_max = None
-        self.mlp_in_min = None
-        self.mlp_in_max = None
-        self.mlp_out_min = None
-        self.mlp_out_max = None
+        # The u8 ranges of the attention q, k, v, out and mlp in, out weights
+        self.u8_ranges = None
         self.attn_k_cache = None
         self.attn_v_cache = None
         self.tp_degree = tp_degree
@@ -540,20 +1065,40 @@ class DecoderLayer(torch.nn.Module):
             # Intermediate MLP layer padding
             if self.mlp_in_weight is not None:
                 _, intermediate_size = self.mlp_in_weight.shape
-                intermediate_size_padded = utils.round_up_to_divisor(intermediate_size, self.tp_degree)
+                intermediate_size_padded = utils.round_up_to_divisor(intermediate_size, self._pad_divisor())
                 maybe_pad = MaybePadder(intermediate_size_padded)
 
                 self.mlp_in_weight = maybe_pad(self.mlp_in_weight, dim=1)
                 self.mlp_in_bias = maybe_pad(self.mlp_in_bias, dim=0)
                 self.mlp_out_weight = maybe_pad(self.mlp_out_weight, dim=0)
 
+        self._check_attn_out_groups()
+
+        u8_ranges = None
         if utils.amp_is_u8(self.amp):
-            self.attn_q_weight, self.attn_q_min, self.attn_q_max = utils.u8_encode(self.attn_q_weight)
-            self.attn_k_weight, self.attn_k_min, self.attn_k_max = utils.u8_encode(self.attn_k_weight)
-            self.attn_v_weight, self.attn_v_min, self.attn_v_max = utils.u8_encode(self.attn_v_weight)
-            self.attn_out_weight, self.attn_out_min, self.attn_out_max = utils.u8_encode(self.attn_out_weight)
-            self.mlp_in_weight, self.mlp_in_min, self.mlp_in_max = utils.u8_encode(self.mlp_in_weight)
-            self.mlp_out_weight, self.mlp_out_min, self.mlp_out_max = utils.u8_encode(self.mlp_out_weight)
+            u8_encoding = self._u8_encoding()
+            attn_out_feature_dim = 1 if self.attn_out_transposed else 0
+
+            def u8_encode(weight, out_feature_dim=1):
+                if weight is None:
+                    return None, None
+                return utils.u8_encode_ranges(weight, out_feature_dim, u8_encoding.granularity,
+                                              u8_encoding.group_size)
+
+            self.attn_q_weight, attn_q_ranges = u8_encode(self.attn_q_weight)
+            self.attn_k_weight, attn_k_ranges = u8_encode(self.attn_k_weight)
+            self.attn_v_weight, attn_v_ranges = u8_encode(self.attn_v_weight)
+            self.attn_out_weight, attn_out_ranges = u8_encode(self.attn_out_weight, attn_out_feature_dim)
+            self.mlp_in_weight, mlp_in_ranges = u8_encode(self.mlp_in_weight)
+            self.mlp_out_weight, mlp_out_ranges = u8_encode(self.mlp_out_weight)
+            u8_ranges = [
+                (attn_q_ranges, 1, 1),
+                (attn_k_ranges, 1, 1),
+                (attn_v_ranges, 1, 1),
+                (attn_out_ranges, self.attn_out_sharding, attn_out_feature_dim),
+                (mlp_in_ranges, 1, 1),
+                (mlp_out_ranges, 0, 1),
+            ]
         if self.neuron_config and self.neuron_config.quant:
             self.mlp_in_weight, self.mlp_in_scales = \
                 quantize.maybe_quantize_weights(self.mlp_in_weight, self.neuron_config.quant)
@@ -572,23 +1117,27 @@ class DecoderLayer(torch.nn.Module):
                                                     out_feature_dim = 1 if self.attn_out_transposed else 0)
 
 
-        maybe_manipulator = MaybeParallelTensorManipulator(self.tp_degree)
+        # Streamed weights stay on host and are written to device slots by a `LayerWeightStream`
+        on_cpu = self.neuron_config is not None and self.neuron_config.weight_streaming is not None
+        maybe_manipulator = MaybeParallelTensorManipulator(self.tp_degree, on_cpu=on_cpu)
         maybe_duplicate = maybe_manipulator.duplicate
         maybe_shard_along = maybe_manipulator.shard_along
         maybe_primary_only = maybe_manipulator.primary_only
         self.pre_attn_ln_weight = maybe_duplicate(self.pre_attn_ln_weight)
         self.pre_attn_ln_bias = maybe_duplicate(self.pre_attn_ln_bias)
         self.attn_q_weight = maybe_shard_along(self.attn_q_weight, dim=1)
-        self.attn_q_scales = maybe_shard_along(self.attn_q_scales, dim=0)
+        self.attn_q_scales = maybe_shard_along(self.attn_q_scales, dim=self._scales_dim(1, 1))
         self.attn_q_bias = maybe_shard_along(self.attn_q_bias, dim=0)
         self.attn_k_weight = maybe_shard_along(self.attn_k_weight, dim=1)
-        self.attn_k_scales = maybe_shard_along(self.attn_k_scales, dim=0)
+        self.attn_k_scales = maybe_shard_along(self.attn_k_scales, dim=self._scales_dim(1, 1))
         self.attn_k_bias = maybe_shard_along(self.attn_k_bias, dim=0)
         self.attn_v_weight = maybe_shard_along(self.attn_v_weight, dim=1)
-        self.attn_v_scales = maybe_shard_along(self.attn_v_scales, dim=0)
+        self.attn_v_scales = maybe_shard_along(self.attn_v_scales, dim=self._scales_dim(1, 1))
         self.attn_v_bias = maybe_shard_along(self.attn_v_bias, dim=0)
         self.attn_out_weight = maybe_shard_along(self.attn_out_weight, dim=self.attn_out_sharding)
-        self.attn_out_scales = maybe_duplicate(self.attn_out_scales)
+        attn_out_feature_dim = 1 if self.attn_out_transposed else 0
+        self.attn_out_scales = maybe_manipulator.duplicate_or_shard_along(
+            self.attn_out_scales, self._scales_dim(self.attn_out_sharding, attn_out_feature_dim))
         self.attn_out_bias = maybe_primary_only(self.attn_out_bias)
         self.active_sparse_mask = maybe_duplicate(self.active_sparse_mask)
         self.sparse_mask = maybe_duplicate(self.sparse_mask)
@@ -597,24 +1146,32 @@ class DecoderLayer(torch.nn.Module):
         self.pre_mlp_ln_weight = maybe_duplicate(self.pre_mlp_ln_weight)
         self.pre_mlp_ln_bias = maybe_duplicate(self.pre_mlp_ln_bias)
         self.mlp_in_weight = maybe_shard_along(self.mlp_in_weight, dim=1)
-        self.mlp_in_scales = maybe_shard_along(self.mlp_in_scales, dim=0)
+        self.mlp_in_scales = maybe_shard_along(self.mlp_in_scales, dim=self._scales_dim(1, 1))
         self.mlp_in_bias = maybe_shard_along(self.mlp_in_bias, dim=0)
         self.mlp_out_weight = maybe_shard_along(self.mlp_out_weight, dim=0)
-        self.mlp_out_scales = maybe_duplicate(self.mlp_out_scales)
+        self.mlp_out_scales = maybe_manipulator.duplicate_or_shard_along(self.mlp_out_scales,
+                                                                         self._scales_dim(0, 1))
         self.mlp_out_bias = maybe_primary_only(self.mlp_out_bias)
         self.post_mlp_ln_weight = maybe_duplicate(self.post_mlp_ln_weight)
         self.post_mlp_ln_bias = maybe_duplicate(self.post_mlp_ln_bias)
+        if u8_ranges is not None:
+            # Ranges follow the weight sharding unless a single range spans the sharded input features
+            self.u8_ranges = [
+                maybe_manipulator.duplicate_or_shard_along(
+                    ranges, dim if dim == out_feature_dim or self._u8_encoding().granularity == 'group' else None)
+                for ranges, dim, out_feature_dim in u8_ranges
+            ]
 
         extras = []
         for param, dim, allow_pad, allow_quantize, out_feature_dim in self.extra_parameters:
             if allow_pad:
-                size = utils.round_up_to_divisor(param.shape[dim], self.tp_degree)
+                size = utils.round_up_to_divisor(param.shape[dim], self._pad_divisor())
                 param = utils.pad(param, dim, size)
 
             if allow_quantize and self.neuron_config and self.neuron_config.quant:
                 param, scales = quantize.maybe_quantize_weights(param, self.neuron_config.quant,
                                                                 out_feature_dim=out_feature_dim)
-                scales_dim = 0 if dim == out_feature_dim else None
+                scales_dim = self._scales_dim(dim, out_feature_dim)
                 extras.extend([maybe_manipulator.duplicate_or_shard_along(param, dim),
                                maybe_manipulator.duplicate_or_shard_along(scales, scales_dim)])
             elif allow_quantize:
@@ -627,6 +1184,52 @@ class DecoderLayer(torch.nn.Module):
 
         self.init_caches()
 
+    def _pad_divisor(self):
+        """
+        Padded intermediate sizes must split into whole quantization groups on every core.
+        """
+        return self.tp_degree * (self._group_size() or 1)
+
+    def _group_size(self, attn=False):
+        """
+        The quantization group size along the contracting dim of the MLP (or attention) weights, or None.
+        """
+        quant = self.neuron_config.quant if self.neuron_config else None
+        if quant and quant.group_wise and (not attn or quant.quantize_attn):
+            return quant.group_size
+        if utils.amp_is_u8(self.amp) and self._u8_encoding().granularity == 'group':
+            return self._u8_encoding().group_size
+        return None
+
+    def _check_attn_out_groups(self):
+        """
+        Each core must hold whole quantization groups of the sharded attention output weight.
+        """
+        group_size = self._group_size(attn=True)
+        if group_size is None or self.attn_out_weight is None:
+            return
+        size = self.attn_out_weight.shape[self.attn_out_sharding]
+        if size % (self.tp_degree * group_size):
+            raise ValueError(f'The attention output size={size} does not split into groups of '
+                             f'group_size={group_size} on tp_degree={self.tp_degree} cores; '
+                             f'size / tp_degree must be a multiple of group_size')
+
+    def _u8_encoding(self):
+        if self.neuron_config and self.neuron_config.u8_encoding:
+            return self.neuron_config.u8_encoding
+        return U8EncodingConfig()
+
+    def _scales_dim(self, dim, out_feature_dim):
+        """
+        The dimension along which the scales of a weight sharded along `dim` are sharded.
+
+        Per-channel scales are a vector over the output features while group-wise
+        scales have the same layout as the weight.
+        """
+        if self.neuron_config and self.neuron_config.quant and self.neuron_config.quant.group_wise:
+            return dim
+        return 0 if dim == out_feature_dim else None
+
     def init_caches(self):
 
         hidden_size, _ = self.attn_q_weight.shape
@@ -651,137 +1254,34 @@ class DecoderLayer(torch.nn.Module):
 
     def all_parameters(self):
         return [
-            self.pre_attn_ln_weight,
-            self.pre_attn_ln_bias,
-            self.attn_q_weight,
-            self.attn_q_scales,
-            self.attn_q_bias,
-            self.attn_k_weight,
-            self.attn_k_scales,
-            self.attn_k_bias,
-            self.attn_v_weight,
-            self.attn_v_scales,
-            self.attn_v_bias,
-            self.attn_out_weight,
-            self.attn_out_scales,
-            self.attn_out_bias,
-            self.post_attn_ln_weight,
-            self.post_attn_ln_bias,
-            self.pre_mlp_ln_weight,
-            self.pre_mlp_ln_bias,
-            self.mlp_in_weight,
-            self.mlp_in_scales,
-            self.mlp_in_bias,
-            self.mlp_out_weight,
-            self.mlp_out_scales,
-            self.mlp_out_bias,
-            self.sparse_mask,
-            self.active_sparse_mask,
-            self.post_mlp_ln_weight,
-            self.post_mlp_ln_bias,
+            *(getattr(self, name) for name in self.parameter_names),
             *self.extra_parameters,
+            *(self.u8_ranges or []),
         ]
 
     def valid_parameters(self):
         return [par for par in self.all_parameters() if par is not None]
 
-    def u8_bounds(self):
-        bounds = (
-            self.attn_q_min, self.attn_q_max, self.attn_k_min, self.attn_k_max,
-            self.attn_v_min, self.attn_v_max, self.attn_out_min, self.attn_out_max,
-            self.mlp_in_min, self.mlp_in_max, self.mlp_out_min, self.mlp_out_max,
-        )
-        if any(bd is None for bd in bounds):
-            return None
-        return bounds
-
     def hlo_maybe_dequantize_weights(self, hlo_weights):
-        u8_bounds = self.u8_bounds()
-        if u8_bounds is None:
+        if self.u8_ranges is None:
             return hlo_weights
+        n_ranges = len(self.u8_ranges)
+        hlo_weights, hlo_ranges = list(hlo_weights[:-n_ranges]), hlo_weights[-n_ranges:]
         first_valid_weight, *_ = [weight for weight in hlo_weights if weight is not None]
         scribe = first_valid_weight.scribe
         amp, quantized, dequantized = utils.parse_amp(self.amp)
         dtype = getattr(scribe, amp)
         dequant_dtype = None if dequantized is None else getattr(scribe, dequantized)
 
-        def attn_u8_decode(q_weight, k_weight, v_weight, out_weight, u8_bounds):
-            q_min, q_max, k_min, k_max, v_min, v_max, out_min, out_max, *_ = u8_bounds
-            q_weight = hlo.u8_decode(dtype, dequant_dtype, q_weight, q_min, q_max)
-            k_weight = hlo.u8_decode(dtype, dequant_dtype, k_weight, k_min, k_max)
-            v_weight = hlo.u8_decode(dtype, dequant_dtype, v_weight, v_min, v_max)
-            out_weight = hlo.u8_decode(dtype, dequant_dtype, out_weight, out_min, out_max)
-            return q_weight, k_weight, v_weight, out_weight
-
-        def mlp_u8_decode(in_weight, out_weight, u8_bounds):
-            *_, in_min, in_max, out_min, out_max = u8_bounds
-            in_weight = hlo.u8_decode(dtype, dequant_dtype, in_weight, in_min, in_max)
-            out_weight = hlo.u8_decode(dtype, dequant_dtype, out_weight, out_min, out_max)
-            return in_weight, out_weight
-
-        (
-            pre_attn_ln_weight,
-            pre_attn_ln_bias,
-            attn_q_weight,
-            attn_q_scales,
-            attn_q_bias,
-            attn_k_weight,
-            attn_k_scales,
-            attn_k_bias,
-            attn_v_weight,
-            attn_v_scales,
-            attn_v_bias,
-            attn_out_weight,
-            attn_out_scales,
-            attn_out_bias,
-            post_attn_ln_weight,
-            post_attn_ln_bias,
-            pre_mlp_ln_weight,
-            pre_mlp_ln_bias,
-            mlp_in_weight,
-            mlp_in_scales,
-            mlp_in_bias,
-            mlp_out_weight,
-            mlp_out_scales,
-            mlp_out_bias,
-            sparse_mask,
-            active_sparse_mask,
-            post_mlp_ln_weight,
-            post_mlp_ln_bias,
-        ) = hlo_weights
-        attn_q_weight, attn_k_weight, attn_v_weight, attn_out_weight = attn_u8_decode(
-            attn_q_weight, attn_k_weight, attn_v_weight, attn_out_weight, u8_bounds)
-        mlp_in_weight, mlp_out_weight = mlp_u8_decode(mlp_in_weight, mlp_out_weight, u8_bounds)
-        return [
-            pre_attn_ln_weight,
-            pre_attn_ln_bias,
-            attn_q_weight,
-            attn_q_scales,
-            attn_q_bias,
-            attn_k_weight,
-            attn_k_scales,
-            attn_k_bias,
-            attn_v_weight,
-            attn_v_scales,
-            attn_v_bias,
-            attn_out_weight,
-            attn_out_scales,
-            attn_out_bias,
-            post_attn_ln_weight,
-            post_attn_ln_bias,
-            pre_mlp_ln_weight,
-            pre_mlp_ln_bias,
-            mlp_in_weight,
-            mlp_in_scales,
-            mlp_in_bias,
-            mlp_out_weight,
-            mlp_out_scales,
-            mlp_out_bias,
-            sparse_mask,
-            active_sparse_mask,
-            post_mlp_ln_weight,
-            post_mlp_ln_bias,
-        ]
+        weight_indices = [self.parameter_names.index(name) for name in self.u8_weight_names]
+        contracting_dims = [0, 0, 0, 0 if self.attn_out_transposed else 1, 0, 0]
+        for index, ranges, contracting_dim in zip(weight_indices, hlo_ranges, contracting_dims):
+            weight = hlo_weights[index]
+            if weight is None:
+                continue
+            weight = hlo.dequantize_groups(weight, ranges, contracting_dim, dequant_dtype)
+            hlo_weights[index] = dtype[weight.sizes].Convert(weight)
+        return hlo_weights
 
     def reset(self):
         zero_cache = torch.zeros(self.attn_k_cache.shape, dtype=self.attn_k_cache.dtype)
@@ -816,18 +1316,8 @@ class DecoderLayer(torch.nn.Module):
         self.mlp_out_bias = layer.mlp_out_bias
         self.post_mlp_ln_weight = layer.post_mlp_ln_weight
         self.post_mlp_ln_bias = layer.post_mlp_ln_bias
-        self.attn_q_min = layer.attn_q_min
-        self.attn_q_max = layer.attn_q_max
-        self.attn_k_min = layer.attn_k_min
-        self.attn_k_max = layer.attn_k_max
-        self.attn_v_min = layer.attn_v_min
-        self.attn_v_max = layer.attn_v_max
-        self.attn_out_min = layer.attn_out_min
-        self.attn_out_max = layer.attn_out_max
-        self.mlp_in_min = layer.mlp_in_min
-        self.mlp_in_max = layer.mlp_in_max
-        self.mlp_out_min = layer.mlp_out_min
-        self.mlp_out_max = layer.mlp_out_max
+        self.u8_ranges = layer.u8_ranges
+        self.attn_out_transposed = layer.attn_out_transposed
         self.extra_parameters = layer.extra_parameters
         # Don't copy the sparse mask since the new layer's mask are already initialized
         # Copying the mask from an old layer may result in incorrect mask shape
@@ -845,24 +1335,49 @@ class DecoderLayer(torch.nn.Module):
         self.cache_shape = layer.cache_shape
 
 
+class HostShards(list):
+    """
+    The per-rank shards of a weight kept in host memory.
+
+    The `shape` and `dtype` are those of a single shard, like a tensor on
+    device, so that HLO parameters are built the same way for both.
+    """
+
+    @property
+    def shape(self):
+        return self[0].shape
+
+    @property
+    def dtype(self):
+        return self[0].dtype
+
+
 class MaybeParallelTensorManipulator:
 
-    def __init__(self, tp_degree):
+    def __init__(self, tp_degree, on_cpu=False):
         self.manipulator = parallel.ParallelTensorManipulator(tp_degree)
+        self.tp_degree = tp_degree
+        self.on_cpu = on_cpu
 
     def duplicate(self, tensor):
         if tensor is None:
             return None
+        if self.on_cpu:
+            return HostShards(self.manipulator.duplicate_on_cpu(tensor))
         return self.manipulator.duplicate(tensor)
 
     def shard_along(self, tensor, dim):
         if tensor is None:
             return None
+        if self.on_cpu:
+            return HostShards(self.manipulator.shard_along_on_cpu(tensor, dim))
         return self.manipulator.shard_along(tensor, dim)
 
     def primary_only(self, tensor):
         if tensor is None:
             return None
+        if self.on_cpu:
+            return HostShards([tensor, *(torch.zeros_like(tensor) for _ in range(1, self.tp_degree))])
         return self.manipulator.primary_only(tensor)
 
     def duplicate_or_shard_along(self, tensor, dim):
@@ -891,6 +1406,125 @@ class DecoderParameterBuilder:
         self.parameter_number += 1
         return param
 
+class LogitsProcessorState:
+
+    def __init__(self, vocab_size, batch_size, max_logit_bias, tp_degree, token_mask=False):
+        """
+        Device buffers for on-device penalties and logit bias.
+
+        The per-row token count histogram is vocab-sharded like the lm_head
+        logits and is updated by every step of the network, so the full
+        logits never need to be processed on the host. The penalties, the
+        logit bias and the token mask are only written by the host when they
+        change. Every buffer except the vocabulary ids holds the batch in
+        dimension 1 like the caches, so that networks running on a subset of
+        the rows slice them in the same way (see `build_weight_shared`).
+
+        Arguments:
+            vocab_size: The padded vocabulary size (divisible by `tp_degree`).
+            batch_size: The number of rows.
+            max_logit_bias: The maximum number of biased token ids per row.
+            tp_degree: The tensor parallel degree.
+            token_mask: Whether a packed mask of allowed tokens is applied.
+        """
+        self.vocab_size = vocab_size
+        self.batch_size = batch_size
+        self.max_logit_bias = max_logit_bias
+        self.manipulator = parallel.ParallelTensorManipulator(tp_degree)
+        self.vocab_ids = self.manipulator.shard_along(torch.arange(vocab_size, dtype=torch.int32), dim=0)
+        self.token_counts = self.manipulator.shard_along(torch.zeros([vocab_size, batch_size]), dim=0)
+        self.penalties = self.manipulator.duplicate(self._penalties(1.0, 0.0, 0.0))
+        self.bias_ids = None
+        self.bias_values = None
+        if max_logit_bias:
+            bias_ids, bias_values = self._logit_bias(None)
+            self.bias_ids = self.manipulator.duplicate(bias_ids)
+            self.bias_values = self.manipulator.duplicate(bias_values)
+        self.token_mask = None
+        if token_mask:
+            self.token_mask = self.manipulator.duplicate(self._token_mask(None))
+
+    def _per_row(self, value, default):
+        # Rows beyond the given values (e.g. batch padding) use the default
+        result = torch.full([self.batch_size], default)
+        if isinstance(value, (list, tuple, torch.Tensor)):
+            value = torch.as_tensor(value, dtype=result.dtype)
+            if len(value) > self.batch_size:
+                raise ValueError(f'Got {len(value)} rows for a batch_size={self.batch_size}')
+            result[:len(value)] = value
+        else:
+            result[:] = value
+        return result
+
+    def _penalties(self, repetition_penalty, presence_penalty, frequency_penalty):
+        return torch.stack([
+            self._per_row(repetition_penalty, 1.0),
+            self._per_row(presence_penalty, 0.0),
+            self._per_row(frequency_penalty, 0.0),
+        ])
+
+    def _logit_bias(self, logit_bias):
+        bias_ids = torch.full([self.max_logit_bias, self.batch_size], -1, dtype=torch.int32)
+        bias_values = torch.zeros([self.max_logit_bias, self.batch_size])
+        if logit_bias is None:
+            return bias_ids, bias_values
+        if isinstance(logit_bias, dict):
+            logit_bias = [logit_bias] * self.batch_size
+        for row, row_bias in enumerate(logit_bias):
+            if len(row_bias) > self.max_logit_bias:
+                raise ValueError(f'Row {row} has {len(row_bias)} biased tokens but max_logit_bias={self.max_logit_bias}')
+            for index, (token_id, bias) in enumerate(row_bias.items()):
+                bias_ids[index, row] = token_id
+                bias_values[index, row] = bias
+        return bias_ids, bias_values
+
+    def set(self, repetition_penalty=1.0, presence_penalty=0.0, frequency_penalty=0.0, logit_bias=None):
+        penalties = self._penalties(repetition_penalty, presence_penalty, frequency_penalty)
+        ops.parallel_write(self.penalties, self.manipulator.duplicate_on_cpu(penalties))
+        if logit_bias is not None and not self.max_logit_bias:
+            raise ValueError('logit_bias requires LogitsProcessorConfig.max_logit_bias to be set')
+        if self.max_logit_bias:
+            bias_ids, bias_values = self._logit_bias(logit_bias)
+            ops.parallel_write(self.bias_ids, self.manipulator.duplicate_on_cpu(bias_ids))
+            ops.parallel_write(self.bias_values, self.manipulator.duplicate_on_cpu(bias_values))
+
+    def _token_mask(self, token_mask):
+        words = (self.vocab_size + 31) // 32
+        # Rows beyond the given mask (e.g. batch padding) allow every token
+        result = torch.full([words, self.batch_size], -1, dtype=torch.int32)
+        if token_mask is not None:
+            token_mask = torch.as_tensor(token_mask, dtype=torch.int32)
+            given_words, given_rows = token_mask.shape
+            result[:given_words, :given_rows] = token_mask
+        return result
+
+    def set_token_mask(self, token_mask=None):
+        ops.parallel_write(self.token_mask, self.manipulator.duplicate_on_cpu(self._token_mask(token_mask)))
+
+    def reset(self):
+        zeros = torch.zeros([self.vocab_size, self.batch_size])
+        ops.parallel_write(self.token_counts, self.manipulator.shard_along_on_cpu(zeros, dim=0))
+
+    def inputs(self):
+        buffers = [self.vocab_ids, self.token_counts, self.penalties, self.bias_ids, self.bias_values,
+                   self.token_mask]
+        return [buffer for buffer in buffers if buffer is not None]
+
+    def outputs(self):
+        return [self.token_counts]
+
+    def row_buffers(self):
+        """
+        The buffers which hold a value per row, i.e. everything except the vocabulary ids.
+        """
+        return self.inputs()[1:]
+
+    def hlo_params(self, param_builder):
+        return [param_builder.from_tensor(buffer) for buffer in
+                (self.vocab_ids, self.token_counts, self.penalties, self.bias_ids, self.bias_values,
+                 self.token_mask)]
+
+
 class DecoderProgram:
 
     def __init__(self, layers, hlo_modules, num_inputs, tp_degree, prefixed_length=0):
@@ -904,8 +1538,21 @@ class DecoderProgram:
         self.manipulator = parallel.ParallelTensorManipulator(tp_degree)
         self.tp_degree = tp_degree
         self.need_reorder_cache = False
+        self.pending_reorder_ids = None
+        self.reset_cache_hlo_kernel = None
+        self.replicated_logits = False
+        # Extra device state read after the weights. Outputs are aliased and have the batch in dimension 1
+        self.state_buffers = []
+        self.state_outputs = []
+        # Direct lookup from a cache id to the smallest bucket that fits it
+        self.bucket_ids = []
+        for bucket_id, npos in enumerate(self.n_positions_list):
+            self.bucket_ids.extend([bucket_id] * (npos + 1 - len(self.bucket_ids)))
 
     def setup(self, layers, ln_lm_head_params, io_ring_cache_size=1):
+        # Inputs are staged through preallocated host buffers in the device dtype
+        self.input_staging = [self.manipulator.duplicate_on_cpu(torch.zeros(buf.shape, dtype=buf.dtype))
+                              for buf in self.input_buffers]
         self.input_buffers = [self.manipulator.duplicate(buf) for buf in self.input_buffers]
         self.logits_buffer = self.manipulator.duplicate(self.logits_buffer)
 
@@ -923,42 +1570,51 @@ class DecoderProgram:
 
     def setup_reorder_cache(self):
         self.need_reorder_cache = True
-        self.reorder_cache_hlo_kernel = self._create_reoder_cache_kernel()
+        # One kernel per bucket so that only the valid prefix of the cache is reordered
+        self.reorder_cache_hlo_kernels = [self._create_reoder_cache_kernel(npos) for npos in self.n_positions_list]
         self._setup_reorder_cache_kernel()
 
 
     def get_neff_bytes(self):
         neff_bytes_arr = [kernel.neff_bytes for kernel in self.kernels]
         if self.need_reorder_cache:
-            neff_bytes_arr += [self.reorder_cache_hlo_kernel.kernel.neff_bytes]
+            neff_bytes_arr += [kernel.kernel.neff_bytes for kernel in self.reorder_cache_hlo_kernels]
         return neff_bytes_arr
 
     def set_neff_bytes(self, kernels_neff_bytes):
         if self.need_reorder_cache:
-            kernels_neff_bytes, reorder_cache_kernel_bytes = kernels_neff_bytes[:-1], kernels_neff_bytes[-1]
-            self.reorder_cache_hlo_kernel.kernel.neff_bytes = reorder_cache_kernel_bytes
+            num_reorder = len(self.reorder_cache_hlo_kernels)
+            reorder_cache_kernels_bytes = kernels_neff_bytes[-num_reorder:]
+            kernels_neff_bytes = kernels_neff_bytes[:-num_reorder]
+            for kernel, neff_bytes in zip(self.reorder_cache_hlo_kernels, reorder_cache_kernels_bytes):
+                kernel.kernel.neff_bytes = neff_bytes
 
         for kernel, neff_bytes in zip(self.kernels, kernels_neff_bytes):
             kernel.neff_bytes = neff_bytes
 
 
     def find_bucket_id(self, length):
-        return next(idx for idx, npos in enumerate(self.n_positions_list) if npos >= length)
+        if length >= len(self.bucket_ids):
+            raise ValueError(f'length={length} exceeds the largest bucket {self.n_positions_list[-1]}')
+        return self.bucket_ids[length]
 
     def inputs_host_to_device(self, input_tensors):
-        for buf, tensor in zip(self.input_buffers, input_tensors):
+        for buf, replicas, tensor in zip(self.input_buffers, self.input_staging, input_tensors):
             assert buf.shape == tensor.shape, f"Copying tensor from host to device: buffer ({buf.shape}) and tensor ({tensor.shape}) have different shapes!"
-            tensor = tensor.to(buf.dtype)
-            tensor = self.manipulator.duplicate_on_cpu(tensor)
-            ops.parallel_write(buf, tensor)
+            staging, *_ = replicas
+            staging.copy_(tensor)
+            ops.parallel_write(buf, replicas)
 
     def run(self, bucket_id):
         raise NotImplementedError(DecoderProgram)
 
     def logits_device_to_host(self):
+        if self.replicated_logits:
+            logits, *_ = ops.parallel_cpu(self.logits_buffer)
+            return logits
         return self.manipulator.unshard_along(self.logits_buffer, dim=0)
 
-    def _fill_io_tensors(self, input_tensors, output_tensors, layers, npos):
+    def _fill_io_tensors(self, input_tensors, output_tensors, layers, npos, weights=None):
         end = npos
         if self.prefixed_length > 0:
             end = npos + self.prefixed_length
@@ -967,23 +1623,31 @@ class DecoderProgram:
                 cache_slice = self.manipulator.slice_on_nc(cache, 0, start=0, end=end, step=1)
                 input_tensors.append(cache_slice)
                 output_tensors.append(cache_slice)
+        if weights is not None:
+            # Streamed layers execute on the weights resident in a device slot
+            input_tensors.extend(weights)
+            return
         for layer in layers:
             input_tensors.extend(layer.valid_parameters())
 
-    def _create_reoder_cache_kernel(self):
+    def _create_reoder_cache_kernel(self, n_positions):
         # assume each layer have same size of cache
+        end = n_positions + self.prefixed_length
+
         def _reorder_cache(scribe):
             reorder_ids = scribe.s64[self.layers[0].batch_size].Parameter(parameter_number=0)
             caches = []
             param_builder = DecoderParameterBuilder(scribe, 1)
             for layer in self.layers:
                 for cache in layer.attn_k_cache, layer.attn_v_cache:
-                    cache = param_builder.from_tensor(cache)
+                    cache = param_builder.from_tensor(cache, dim_size={0: end})
                     caches.append(cache)
             outputs = []
             # TODO: concat -> reorder -> indexing?
             # cache of shape [self.n_positions, self.batch_size, n_heads_kv_cache//self.tp_degree, self.attention_head_size]
             # we want to reorder on batch dimension
+            for state in self.state_outputs:
+                caches.append(param_builder.from_tensor(state))
             for cache in caches:
                 new_cache = hlo.index_select(cache, 1, reorder_ids)
                 outputs.append(new_cache)
@@ -993,27 +1657,98 @@ class DecoderProgram:
         return compiler.HLOKernel(_reorder_cache, self.tp_degree)
 
     def _setup_reorder_cache_kernel(self):
-        self.reorder_cache_hlo_kernel.build()
-        self.reorder_cache_hlo_kernel.load()
+        # Compile modules in parallel
+        with ProcessPoolExecutor(max_workers=len(self.n_positions_list)) as executor:
+            neff_bytes_futures = []
+            for kernel, bucket_size in zip(self.reorder_cache_hlo_kernels, self.n_positions_list):
+                future = executor.submit(kernel.kernel.compile, bucket_size)
+                neff_bytes_futures.append(future)
+            for kernel, future in zip(self.reorder_cache_hlo_kernels, neff_bytes_futures):
+                kernel.kernel.neff_bytes = future.result()
 
         # setup memory buffer
-        reorder_ids = torch.zeros(self.layers[0].cache_shape, dtype=torch.int64)
-        self.reorder_ids_buffers = self.reorder_cache_hlo_kernel.manipulator.duplicate(reorder_ids)
-        input_tensors = [self.reorder_ids_buffers]
-        output_tensors = []
+        reorder_ids = torch.zeros(self.layers[0].batch_size, dtype=torch.int64)
+        self.reorder_ids_buffers = self.manipulator.duplicate(reorder_ids)
+        self.reorder_ids_replicas = self.manipulator.duplicate_on_cpu(reorder_ids)
+        for kernel, npos in zip(self.reorder_cache_hlo_kernels, self.n_positions_list):
+            kernel.load()
+            input_tensors = [self.reorder_ids_buffers]
+            output_tensors = []
+            end = npos + self.prefixed_length
+            for layer in self.layers:
+                for cache in layer.attn_k_cache, layer.attn_v_cache:
+                    cache_slice = self.manipulator.slice_on_nc(cache, 0, start=0, end=end, step=1)
+                    input_tensors.append(cache_slice)
+                    output_tensors.append(cache_slice) # aliasing
+            input_tensors.extend(self.state_outputs)
+            output_tensors.extend(self.state_outputs)
+            kernel.setup(input_tensors, output_tensors)
+
+    def setup_reset_cache(self):
+        self.reset_cache_hlo_kernel = self._create_reset_cache_kernel()
+        self.reset_cache_hlo_kernel.build()
+        self.reset_cache_hlo_kernel.load()
+        caches = []
         for layer in self.layers:
-            for cache in layer.attn_k_cache, layer.attn_v_cache:
-                input_tensors.append(cache)
-                output_tensors.append(cache) # aliasing
-        self.reorder_cache_hlo_kernel.setup(input_tensors, output_tensors)
+            caches.extend([layer.attn_k_cache, layer.attn_v_cache])
+        caches.extend(self.state_outputs)
+        self.reset_cache_hlo_kernel.setup(caches, caches) # aliasing
+
+    def _create_reset_cache_kernel(self):
+        def _reset_cache(scribe):
+            param_builder = DecoderParameterBuilder(scribe, 0)
+            outputs = []
+            for layer in self.layers:
+                for cache in layer.attn_k_cache, layer.attn_v_cache:
+                    cache = param_builder.from_tensor(cache)
+                    outputs.append(hlo.full(0, cache.dtype, cache.sizes))
+            for state in self.state_outputs:
+                state = param_builder.from_tensor(state)
+                outputs.append(hlo.full(0, state.dtype, state.sizes))
+            root_shapes = [tensor.dtype[tensor.sizes] for tensor in outputs]
+            return scribe.tuple(*root_shapes).Tuple(*outputs)
+
+        return compiler.HLOKernel(_reset_cache, self.tp_degree)
+
+    def reset_cache(self):
+        """
+        Zero the KV caches of every layer on device.
+
+        This avoids transferring full size zero caches from the host to every
+        rank between generations.
+        """
+        self.reset_cache_hlo_kernel.run()
 
     def reorder_cache(self, reorder_ids):
+        """
+        Reorder the batch rows of the KV caches.
+
+        The reorder is deferred until the next step so that it only touches
+        the valid prefix of the cache (the bucket of that step). Consecutive
+        reorders are composed into one and identity reorders are skipped.
+        """
         assert self.need_reorder_cache, "DecoderProgram is not built with reorder_cache"
-        reorder_ids_tensor = torch.tensor(reorder_ids, dtype=torch.int64)
-        # TODO: if reorder_ids == range(batch_size), don't do anything
-        reorder_ids_tensors_cpu = self.reorder_cache_hlo_kernel.manipulator.duplicate_on_cpu(reorder_ids_tensor)
-        ops.parallel_write(self.reorder_ids_buffers, reorder_ids_tensors_cpu)
-        self.reorder_cache_hlo_kernel.run()
+        reorder_ids = torch.as_tensor(reorder_ids, dtype=torch.int64)
+        if self.pending_reorder_ids is not None:
+            reorder_ids = self.pending_reorder_ids[reorder_ids]
+        if torch.equal(reorder_ids, torch.arange(len(reorder_ids))):
+            self.pending_reorder_ids = None
+        else:
+            self.pending_reorder_ids = reorder_ids
+
+    def flush_reorder_cache(self, bucket_id=-1):
+        """
+        Apply a pending reorder to the cache prefix covered by `bucket_id`.
+
+        Positions beyond the bucket have not been written by the current
+        generation and therefore do not need to be reordered.
+        """
+        if self.pending_reorder_ids is None:
+            return
+        self.reorder_ids_replicas[0].copy_(self.pending_reorder_ids)
+        ops.parallel_write(self.reorder_ids_buffers, self.reorder_ids_replicas)
+        self.reorder_cache_hlo_kernels[bucket_id].run()
+        self.pending_reorder_ids = None
 
 
 class DecoderProgramFullyUnrolled(DecoderProgram):
@@ -1032,6 +1767,8 @@ class DecoderProgramFullyUnrolled(DecoderProgram):
             output_tensors = [self.logits_buffer]
             self._fill_io_tensors(input_tensors, output_tensors, layers, npos)
             input_tensors.extend(ln_lm_head_params)
+            input_tensors.extend(self.state_buffers)
+            output_tensors.extend(self.state_outputs)
             memory.setup(input_tensors, output_tensors)
 
     def run(self, bucket_id):
@@ -1058,14 +1795,25 @@ class DecoderProgramFullyUnrolled(DecoderProgram):
         """
         return self.executors[bucket_id](inputs, return_ranks)
 
+    def submit(self, bucket_id, *inputs, return_ranks=-1):
+        return self.executors[bucket_id].submit(inputs, return_ranks)
+
 
 class DecoderProgramMultiLayer(DecoderProgram):
 
-    def __init__(self, layers, hlo_modules, ln_lm_head_hlo_module, num_inputs, num_layers, unroll, tp_degree, prefixed_length=0):
+    def __init__(self, layers, hlo_modules, ln_lm_head_hlo_module, num_inputs, num_layers, unroll, tp_degree, prefixed_length=0,
+                 num_pre_layer_params=0):
         super().__init__(layers, hlo_modules, num_inputs, tp_degree, prefixed_length)
         if num_layers % unroll:
             raise ValueError(f'unroll={unroll} does not divide num_layers={num_layers}')
-        self.logits_buffer = compiler.gen_zero_output(ln_lm_head_hlo_module)
+        self.io_ring_cache_size = num_layers // unroll
+        # Pre-layer parameters lead `ln_lm_head_params` but are consumed by every layer group
+        self.num_pre_layer_params = num_pre_layer_params
+        # The language model head returns a tuple when it also updates the logits processor state
+        index = None
+        if ln_lm_head_hlo_module.host_program_shape.result.tuple_shapes:
+            index = 0
+        self.logits_buffer = compiler.gen_zero_output(ln_lm_head_hlo_module, index)
         self.unroll = unroll
         self.multi_layers_memories = []
         for _ in range(num_layers // unroll):
@@ -1073,46 +1821,199 @@ class DecoderProgramMultiLayer(DecoderProgram):
             self.multi_layers_memories.append(memories)
         self.ln_lm_head_kernel = compiler.ParallelKernel(ln_lm_head_hlo_module, tp_degree)
         self.ln_lm_head_memory = self.ln_lm_head_kernel.build_memory()
-        self.layer_executors = list()
-        self.lm_head_executor = None
+        self.bucket_executors = list()
+        self.pool = None
 
     def setup(self, layers, ln_lm_head_params):
-        super().setup(layers, ln_lm_head_params, io_ring_cache_size=len(self.multi_layers_memories))
+        super().setup(layers, ln_lm_head_params, io_ring_cache_size=self.io_ring_cache_size)
+        pre_layer_params = ln_lm_head_params[:self.num_pre_layer_params]
+        ln_lm_head_params = ln_lm_head_params[self.num_pre_layer_params:]
         hidden_buffer, *_ = self.input_buffers
         multi_layer_starts = range(0, len(layers), self.unroll)
         multi_layers = [layers[start:start+self.unroll] for start in multi_layer_starts]
         for memories, multi_layer in zip(self.multi_layers_memories, multi_layers):
-            for npos, memory in zip(self.n_positions_list, memories):
-                input_tensors = [*self.input_buffers]
-                output_tensors = [hidden_buffer]
-                self._fill_io_tensors(input_tensors, output_tensors, multi_layer, npos)
-                memory.setup(input_tensors, output_tensors)
-        self.ln_lm_head_memory.setup([hidden_buffer, *ln_lm_head_params], [self.logits_buffer])
+            self._setup_layer_group(memories, multi_layer, pre_layer_params)
+        ln_lm_head_inputs = [hidden_buffer]
+        if self.state_outputs:
+            # The token ids of the logits processors are the last input
+            ln_lm_head_inputs.append(self.input_buffers[-1])
+        ln_lm_head_inputs.extend(ln_lm_head_params)
+        ln_lm_head_inputs.extend(self.state_buffers)
+        self.ln_lm_head_memory.setup(ln_lm_head_inputs, [self.logits_buffer, *self.state_outputs])
         self.ln_lm_head_kernel.build()
         self.ln_lm_head_kernel.load()
 
+    def _setup_layer_group(self, memories, multi_layer, pre_layer_params, weights=None):
+        hidden_buffer, *_ = self.input_buffers
+        for npos, memory in zip(self.n_positions_list, memories):
+            input_tensors = [*self.input_buffers]
+            output_tensors = [hidden_buffer]
+            self._fill_io_tensors(input_tensors, output_tensors, multi_layer, npos, weights)
+            input_tensors.extend(pre_layer_params)
+            memory.setup(input_tensors, output_tensors)
+
     def run(self, bucket_id):
         for memories in self.multi_layers_memories:
             self.kernels[bucket_id](memories[bucket_id])
         self.ln_lm_head_kernel(self.ln_lm_head_memory)
 
     def enable_executor(self):
-        for layer_memories in self.multi_layers_memories:
+        output_tensors = [self.logits_buffer]
+        lm_head_executor = self.ln_lm_head_kernel.build_executor(self.ln_lm_head_memory, [], output_tensors)
+        for bucket_id, kernel in enumerate(self.kernels):
             executors = list()
-            self.layer_executors.append(executors)
-            for kernel, memories in zip(self.kernels,layer_memories):
-                # NOTE: No input/output returns from layers. Do one-time copy
-                executor = kernel.build_executor(memories, [], [])
+            for index, layer_memories in enumerate(self.multi_layers_memories):
+                # NOTE: Inputs are copied once by the first layer group. No returns from layers.
+                input_tensors = self.input_buffers if index == 0 else []
+                executor = kernel.build_executor(layer_memories[bucket_id], input_tensors, [])
                 executors.append(executor)
-        output_tensors = [self.logits_buffer]
-        executor = self.ln_lm_head_kernel.build_executor(self.ln_lm_head_memory, [], output_tensors)
-        self.lm_head_executor = executor
+            executors.append(lm_head_executor)
+            self.bucket_executors.append(executors)
 
     def execute(self, bucket_id, *inputs, return_ranks=-1):
-        self.inputs_host_to_device(inputs) # One-time input copy
-        for layer_executor in self.layer_executors:
-            layer_executor[bucket_id]([], return_ranks=0) # No returns from intermediate layers
-        return self.lm_head_executor([], return_ranks=return_ranks)
+        """
+        Execute all layer groups and then the language model head in sequence.
+
+        Arguments:
+            bucket_id: The kernel bucket to execute
+            inputs: The set of CPU tensors to copy to each model
+            return_ranks: The number of ranks to copy back to CPU
+        """
+        first, *middle, last = self.bucket_executors[bucket_id]
+        first(inputs, return_ranks=0)
+        for executor in middle:
+            executor([], return_ranks=0)
+        return last([], return_ranks=return_ranks)
+
+    def submit(self, bucket_id, *inputs, return_ranks=-1):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(1)
+        return self.pool.submit(self.execute, bucket_id, *inputs, return_ranks=return_ranks)
+
+
+class LayerWeightStream:
+    """
+    Keep a sliding window of layer groups' weights resident on device.
+
+    The weights of every layer are kept on host as `HostShards` and `window`
+    device slots each hold the weights of one group of `unroll` layers. When a
+    group is acquired, the groups which follow it are written into the slots
+    of groups which are no longer needed on a background thread, so that the
+    host to device copies overlap with the execution of the current group.
+
+    A stream is shared by every network built with `build_weight_shared`.
+    A step holds `lock` while it acquires groups and executes on the slots so
+    that steps of different networks (e.g. ping-pong micro-batches submitted
+    from different threads) never overwrite weights in use. Submitted steps
+    of every network run in order on the shared `submit_pool`.
+
+    Arguments:
+        layers: The layers with weights on host.
+        unroll: The number of layers per group.
+        config: The `WeightStreamingConfig`.
+    """
+
+    def __init__(self, layers, unroll, config):
+        groups = [layers[start:start+unroll] for start in range(0, len(layers), unroll)]
+        self.unroll = unroll
+        self.host_weights = [[param for layer in group for param in layer.valid_parameters()] for group in groups]
+        if config.directory is not None:
+            self._memory_map(config.directory)
+        window = min(config.window, len(groups))
+        self.slots = [[ops.parallel_to_nc(list(shards)) for shards in weights]
+                      for weights in self.host_weights[:window]]
+        self.resident = list(range(window))
+        self.pending = [None] * window
+        self.write_pool = ThreadPoolExecutor(1)
+        self.submit_pool = ThreadPoolExecutor(1)
+        self.lock = threading.Lock()
+
+    def _memory_map(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for group, weights in enumerate(self.host_weights):
+            path = os.path.join(directory, f'layer-group-{group}.pt')
+            torch.save([list(shards) for shards in weights], path)
+            mapped = torch.load(path, mmap=True)
+            for shards, mapped_shards in zip(weights, mapped):
+                # Layers reference the same lists so that the in-memory copies are released
+                shards[:] = mapped_shards
+
+    def acquire(self, group):
+        """
+        Prefetch the groups following `group` and wait until `group` is resident.
+
+        Returns:
+            slot: The index of the device slot holding the weights of `group`.
+        """
+        num_groups = len(self.host_weights)
+        upcoming = [(group + offset) % num_groups for offset in range(len(self.slots))]
+        for next_group in upcoming:
+            if next_group not in self.resident:
+                self._write(next_group, self._free_slot(upcoming))
+        slot = self.resident.index(group)
+        pending = self.pending[slot]
+        if pending is not None:
+            pending.result()
+            self.pending[slot] = None
+        return slot
+
+    def _free_slot(self, upcoming):
+        for slot, group in enumerate(self.resident):
+            if group not in upcoming:
+                return slot
+        raise ValueError(f'No free slot for groups {upcoming} in {self.resident}')
+
+    def _write(self, group, slot):
+        self.resident[slot] = group
+        self.pending[slot] = self.write_pool.submit(self._copy, group, slot)
+
+    def _copy(self, group, slot):
+        for tensor, shards in zip(self.slots[slot], self.host_weights[group]):
+            ops.parallel_write(tensor, list(shards))
+
+
+class DecoderProgramStreamedMultiLayer(DecoderProgramMultiLayer):
+    """
+    A multi-layer program whose layer groups execute on weights streamed by a `LayerWeightStream`.
+
+    Each layer group has a memory per device slot so that the group can run
+    on whichever slot its weights were written to.
+    """
+
+    def __init__(self, layers, hlo_modules, ln_lm_head_hlo_module, num_inputs, num_layers, unroll, tp_degree,
+                 weight_stream, prefixed_length=0, num_pre_layer_params=0):
+        super().__init__(layers, hlo_modules, ln_lm_head_hlo_module, num_inputs, num_layers, unroll, tp_degree,
+                         prefixed_length, num_pre_layer_params=num_pre_layer_params)
+        self.weight_stream = weight_stream
+        num_slots = len(weight_stream.slots)
+        self.multi_layers_memories = [
+            [[kernel.build_memory() for kernel in self.kernels] for _ in range(num_slots)]
+            for _ in range(num_layers // unroll)
+        ]
+        self.io_ring_cache_size = num_slots * (num_layers // unroll)
+
+    def _setup_layer_group(self, slots_memories, multi_layer, pre_layer_params, weights=None):
+        for memories, slot_weights in zip(slots_memories, self.weight_stream.slots):
+            super()._setup_layer_group(memories, multi_layer, pre_layer_params, slot_weights)
+
+    def run(self, bucket_id):
+        with self.weight_stream.lock:
+            for group, slots_memories in enumerate(self.multi_layers_memories):
+                weight_slot = self.weight_stream.acquire(group)
+                self.kernels[bucket_id](slots_memories[weight_slot][bucket_id])
+        self.ln_lm_head_kernel(self.ln_lm_head_memory)
+
+    def enable_executor(self):
+        # Weight writes are interleaved with the layer groups on host so steps always go through `run`
+        pass
+
+    def execute(self, bucket_id, *inputs, return_ranks=-1):
+        self.inputs_host_to_device(inputs)
+        self.run(bucket_id)
+        return self.logits_device_to_host()
+
+    def submit(self, bucket_id, *inputs, return_ranks=-1):
+        return self.weight_stream.submit_pool.submit(self.execute, bucket_id, *inputs, return_ranks=return_ranks)
 
 
 class FastCacheBroadcaster:
@@ -1132,3 +2033,344 @@ class FastCacheBroadcaster:
 
     def run_broadcast(self):
         self.cache_broadcast_kernel(self.cache_broadcast_memory)
+
+
+class CacheSwapper:
+    """
+    Copy the KV cache rows of sequences between device and a pool of host buffers.
+
+    A sequence is swapped out by copying the valid prefix of its row in the
+    caches of every layer to host, which frees the row for another sequence.
+    It is later swapped into any free row without encoding its context again.
+    Copies run in order on a background thread. A swapped out row may only be
+    reused, and a swapped in row only executed, once its future completes.
+
+    A row is strided in the caches, so it is copied on device through a
+    contiguous single row staging cache and only the staging prefix is
+    transferred to or from host. The logits processor state of the row (token
+    counts, penalties, logit bias and token mask) is swapped with its caches
+    through the same kind of single row staging buffers.
+
+    Arguments:
+        network: The network owning the caches.
+        max_bytes: The maximum host bytes held by swapped out sequences.
+    """
+
+    def __init__(self, network, max_bytes=None):
+        self.network = network
+        layers = network.layers
+        tp_degree = network.tp_degree
+        self.caches = [cache for layer in layers for cache in (layer.attn_k_cache, layer.attn_v_cache)]
+        first_layer, *_ = layers
+        self.n_positions, self.batch_size, n_heads_tp, d_head = first_layer.cache_shape
+        element_size = torch.empty((), dtype=first_layer.cache_dtype).element_size()
+        self.position_bytes = len(self.caches) * tp_degree * n_heads_tp * d_head * element_size
+        self.manipulator = parallel.ParallelTensorManipulator(tp_degree)
+        staging = torch.zeros([self.n_positions, 1, n_heads_tp, d_head], dtype=first_layer.cache_dtype)
+        self.staging = [self.manipulator.duplicate(staging) for _ in self.caches]
+        self.gather = FastCacheFanout(self.n_positions, self.batch_size, 1, n_heads_tp, d_head, network.amp,
+                                      tp_degree, network.num_layers)
+        self.gather.setup(self.caches, self.staging)
+        self.scatter = FastCacheScatter(self.n_positions, 1, self.batch_size, n_heads_tp, d_head, network.amp,
+                                        tp_degree, network.num_layers)
+        self.scatter.setup(self.staging, self.caches)
+        self.states = []
+        if network.logits_processors is not None:
+            self.states = network.logits_processors.row_buffers()
+        self.state_staging = []
+        self.state_bytes = 0
+        if self.states:
+            for state in self.states:
+                rows, _ = state.shape
+                self.state_staging.append(self.manipulator.duplicate(torch.zeros([rows, 1], dtype=state.dtype)))
+                element_size = torch.empty((), dtype=state.dtype).element_size()
+                self.state_bytes += tp_degree * rows * element_size
+            row_id = torch.zeros([1], dtype=torch.int64)
+            self.state_row_buffer = self.manipulator.duplicate(row_id)
+            self.state_row_replicas = self.manipulator.duplicate_on_cpu(row_id)
+            self.state_gather = compiler.HLOKernel(self._gather_states, tp_degree)
+            self.state_gather.build()
+            self.state_gather.load()
+            self.state_gather.setup([self.state_row_buffer, *self.states], self.state_staging)
+            self.state_scatter = compiler.HLOKernel(self._scatter_states, tp_degree)
+            self.state_scatter.build()
+            self.state_scatter.load()
+            # The state is updated in place (aliasing)
+            self.state_scatter.setup([self.state_row_buffer, *self.states, *self.state_staging], self.states)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = {}
+        self.next_handle = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(1)
+
+    def _gather_states(self, scribe):
+        row_id = scribe.s64[1].Parameter(parameter_number=0)
+        param_builder = DecoderParameterBuilder(scribe, 1)
+        outputs = [hlo.index_select(param_builder.from_tensor(state), 1, row_id) for state in self.states]
+        root_shapes = [tensor.dtype[tensor.sizes] for tensor in outputs]
+        return scribe.tuple(*root_shapes).Tuple(*outputs)
+
+    def _scatter_states(self, scribe):
+        row_id = scribe.s64[1].Parameter(parameter_number=0)
+        param_builder = DecoderParameterBuilder(scribe, 1)
+        targets = [param_builder.from_tensor(state) for state in self.states]
+        sources = [param_builder.from_tensor(staging) for staging in self.state_staging]
+        outputs = [hlo.scatter_rows(target, row_id, source) for target, source in zip(targets, sources)]
+        root_shapes = [tensor.dtype[tensor.sizes] for tensor in outputs]
+        return scribe.tuple(*root_shapes).Tuple(*outputs)
+
+    def _write_state_row(self, row):
+        self.state_row_replicas[0].copy_(torch.tensor([row]))
+        ops.parallel_write(self.state_row_buffer, self.state_row_replicas)
+
+    def _staging_prefixes(self, length):
+        return [self.manipulator.slice_on_nc(cache, 0, start=0, end=length, step=1) for cache in self.staging]
+
+    def _flush_reorder_cache(self):
+        # A pending reorder moves rows, so it is applied in order with the
+        # queued copies and before the copy being submitted
+        if self.network.caches_owner.program.pending_reorder_ids is not None:
+            self.executor.submit(self.network.flush_reorder_cache).result()
+
+    def _check_row(self, row):
+        if not 0 <= row < self.batch_size:
+            raise ValueError(f'row={row} is out of range for batch_size={self.batch_size}')
+
+    def swap_out(self, row, length):
+        """
+        Copy the first `length` positions of `row` in every cache to host.
+
+        Returns:
+            future: A `concurrent.futures.Future` for the handle of the swapped out sequence.
+        """
+        self._check_row(row)
+        if not 0 < length <= self.n_positions:
+            raise ValueError(f'length={length} must be in [1, {self.n_positions}]')
+        self._flush_reorder_cache()
+        nbytes = length * self.position_bytes + self.state_bytes
+        with self.lock:
+            if self.max_bytes is not None and self.nbytes + nbytes > self.max_bytes:
+                raise ValueError(f'Swapping out {nbytes} bytes exceeds max_bytes={self.max_bytes} '
+                                 f'with {self.nbytes} bytes in use')
+            self.nbytes += nbytes
+            handle = self.next_handle
+            self.next_handle += 1
+            self.entries[handle] = length, None, None
+
+        def copy():
+            try:
+                self.gather.run_fanout(torch.tensor([row]))
+                host_caches = [ops.parallel_cpu(prefix) for prefix in self._staging_prefixes(length)]
+                host_states = []
+                if self.states:
+                    self._write_state_row(row)
+                    self.state_gather.run()
+                    host_states = [ops.parallel_cpu(staging) for staging in self.state_staging]
+            except Exception:
+                # A failed copy holds no host buffers, so its handle is dropped
+                self._discard(handle)
+                raise
+            with self.lock:
+                # The sequence may have been released before the copy ran
+                if handle in self.entries:
+                    self.entries[handle] = length, host_caches, host_states
+            return handle
+
+        return self.executor.submit(copy)
+
+    def swap_in(self, handle, row, release=True):
+        """
+        Copy a swapped out sequence into the first positions of `row` in every cache.
+
+        Arguments:
+            handle: The handle returned by `swap_out`.
+            row: The batch row to restore the sequence into.
+            release: Whether to free the host buffers once restored.
+
+        Returns:
+            future: A `concurrent.futures.Future` which completes once the row is restored.
+        """
+        self._check_row(row)
+        with self.lock:
+            if handle not in self.entries:
+                raise ValueError(f'Unknown swapped out sequence handle={handle}')
+        self._flush_reorder_cache()
+
+        def copy():
+            with self.lock:
+                if handle not in self.entries:
+                    raise ValueError(f'Swapped out sequence handle={handle} was released or failed to copy')
+                length, host_caches, host_states = self.entries[handle]
+            for prefix, host_cache in zip(self._staging_prefixes(length), host_caches):
+                ops.parallel_write(prefix, host_cache)
+            self.scatter.run_scatter(torch.tensor([row]))
+            if self.states:
+                for staging, host_state in zip(self.state_staging, host_states):
+                    ops.parallel_write(staging, host_state)
+                self._write_state_row(row)
+                self.state_scatter.run()
+            if release:
+                self.release(handle)
+
+        return self.executor.submit(copy)
+
+    def release(self, handle):
+        """
+        Free the host buffers of a swapped out sequence which will not be restored.
+        """
+        with self.lock:
+            if handle not in self.entries:
+                raise ValueError(f'Unknown swapped out sequence handle={handle}')
+            length, *_ = self.entries.pop(handle)
+            self.nbytes -= length * self.position_bytes + self.state_bytes
+
+    def _discard(self, handle):
+        with self.lock:
+            if handle in self.entries:
+                length, *_ = self.entries.pop(handle)
+                self.nbytes -= length * self.position_bytes + self.state_bytes
+
+    def length(self, handle):
+        with self.lock:
+            if handle not in self.entries:
+                raise ValueError(f'Unknown swapped out sequence handle={handle}')
+            length, *_ = self.entries[handle]
+        return length
+
+
+class FastCacheFanout:
+
+    def __init__(self, n_positions, from_batch_size, to_batch_size, n_heads_tp, d_head, amp,
+                 tp_degree, n_layer):
+        cache_fanout_impl = hlo.cache_fanout(n_positions, from_batch_size, to_batch_size,
+                                             n_heads_tp, d_head, amp, n_layer)
+        cache_fanout_hlo_module = compiler.compile_py_func(cache_fanout_impl)
+        self.cache_fanout_kernel = compiler.ParallelKernel(cache_fanout_hlo_module, tp_degree)
+        self.cache_fanout_memory = self.cache_fanout_kernel.build_memory()
+        self.cache_fanout_kernel.build()
+        self.cache_fanout_kernel.load()
+        self.manipulator = parallel.ParallelTensorManipulator(tp_degree)
+        row_ids = torch.zeros(to_batch_size, dtype=torch.int64)
+        self.row_ids_buffer = self.manipulator.duplicate(row_ids)
+        self.row_ids_replicas = self.manipulator.duplicate_on_cpu(row_ids)
+
+    def setup(self, source_caches, target_caches):
+        self.cache_fanout_memory.setup([self.row_ids_buffer, *source_caches], target_caches)
+
+    def run_fanout(self, row_ids):
+        """
+        Copy source row `row_ids[i]` of the source caches into row `i` of the target caches.
+        """
+        self.row_ids_replicas[0].copy_(row_ids)
+        ops.parallel_write(self.row_ids_buffer, self.row_ids_replicas)
+        self.cache_fanout_kernel(self.cache_fanout_memory)
+
+
+class FastCacheScatter:
+
+    def __init__(self, n_positions, from_batch_size, to_batch_size, n_heads_tp, d_head, amp,
+                 tp_degree, n_layer):
+        cache_scatter_impl = hlo.cache_scatter(n_positions, from_batch_size, to_batch_size,
+                                               n_heads_tp, d_head, amp, n_layer)
+        cache_scatter_hlo_module = compiler.compile_py_func(cache_scatter_impl)
+        self.cache_scatter_kernel = compiler.ParallelKernel(cache_scatter_hlo_module, tp_degree)
+        self.cache_scatter_memory = self.cache_scatter_kernel.build_memory()
+        self.cache_scatter_kernel.build()
+        self.cache_scatter_kernel.load()
+        self.manipulator = parallel.ParallelTensorManipulator(tp_degree)
+        row_ids = torch.zeros(from_batch_size, dtype=torch.int64)
+        self.row_ids_buffer = self.manipulator.duplicate(row_ids)
+        self.row_ids_replicas = self.manipulator.duplicate_on_cpu(row_ids)
+
+    def setup(self, source_caches, target_caches):
+        # The target caches are updated in place (aliasing)
+        self.cache_scatter_memory.setup([self.row_ids_buffer, *target_caches, *source_caches], target_caches)
+
+    def run_scatter(self, row_ids):
+        """
+        Copy row `i` of the source caches into row `row_ids[i]` of the target caches.
+        """
+        self.row_ids_replicas[0].copy_(row_ids)
+        ops.parallel_write(self.row_ids_buffer, self.row_ids_replicas)
+        self.cache_scatter_kernel(self.cache_scatter_memory)
+
+
+class PromptFanout:
+    """
+    Encode the unique prompts of a batch once and fan their caches out on device.
+
+    Rows with the same prompt and start id (e.g. identical requests or several
+    samples of one prompt) have identical context caches. Each unique prompt
+    is encoded by a weight-shared network with small caches of its own, and a
+    `FastCacheFanout` copies the prompt caches to every row which shares it.
+    One prompt network is built per batch size of `bucket.batch_sizes`. The
+    prompt caches are scratch space: every encoding overwrites all of their
+    positions before the fanout, so they never hold live rows and are not
+    reset.
+
+    Arguments:
+        network: The network whose caches receive the prompts.
+        n_positions: The context length encoded by the prompt networks.
+        prompt_batch_size: The maximum number of unique prompts (or a list of batch sizes).
+        unroll: The number of layers unrolled in the prompt networks.
+    """
+
+    def __init__(self, network, n_positions, prompt_batch_size, unroll=None):
+        self.network = network
+        self.n_positions = n_positions
+        self.batch_sizes = [size for size in bucket.batch_sizes(prompt_batch_size) if size < network.batch_size]
+        self.prompt_networks = {}
+        for batch_size in self.batch_sizes:
+            model = network.build_weight_shared(
+                n_positions_list=[n_positions],
+                n_active_tokens=n_positions,
+                batch_size=batch_size,
+                unroll=unroll,
+            )
+            if network.use_executor:
+                model.enable_executor()
+            fanout = network.build_cache_fanout(model, n_positions)
+            self.prompt_networks[batch_size] = model, fanout
+
+    def unique_prompts(self, input_ids, start_ids):
+        """
+        Find the rows of the batch which share the same prompt.
+
+        Returns:
+            prompts: A representative row of each unique prompt and the unique
+                prompt index of each row. None when deduplication cannot be used.
+        """
+        batch_size, _ = input_ids.shape
+        keys = torch.cat([start_ids.unsqueeze(1).to(input_ids.dtype), input_ids], dim=1)
+        unique, row_ids = torch.unique(keys, dim=0, return_inverse=True)
+        n_unique, _ = unique.shape
+        if n_unique == batch_size or not self.batch_sizes or n_unique > self.batch_sizes[-1]:
+            return None
+        unique_rows = torch.zeros(n_unique, dtype=torch.int64)
+        unique_rows[row_ids] = torch.arange(batch_size)
+        return unique_rows, row_ids
+
+    def __call__(self, hidden, cache_ids, start_ids, prompts):
+        """
+        Encode the unique prompts and copy their caches to every row.
+
+        Arguments:
+            hidden: The context hidden states of every row with the batch in dimension 2.
+            cache_ids: The cache ids of the context.
+            start_ids: The start ids of every row.
+            prompts: The result of `unique_prompts`.
+
+        Returns:
+            logits: The logits of every row.
+        """
+        unique_rows, row_ids = prompts
+        prompt_batch_size = bucket.find(self.batch_sizes, len(unique_rows))
+        unique_rows = utils.pad(unique_rows, 0, prompt_batch_size)
+        model, fanout = self.prompt_networks[prompt_batch_size]
+        logits = model(hidden[:, :, unique_rows].contiguous(), cache_ids, start_ids[unique_rows])
+        self.network.flush_reorder_cache()
+        fanout.run_fanout(utils.pad(row_ids, 0, self.network.batch_size))
+        if isinstance(logits, tuple):
+            return tuple(part[:, :, row_ids] for part in logits)
+        return logits[:, :, row_ids]
@@ -22,6 +22,7 @@ from transformers_neuronx import dtypes
 from transformers_neuronx import hlo
 from transformers_neuronx import module
 from transformers_neuronx import ops
+from transformers_neuronx import quantize
 from transformers_neuronx import parallel
 from transformers_neuronx import sampling
 from transformers_neuronx import utils
@@ -64,6 +65,8 @@ class GPT2ForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronModel
         ops.init()
         self.chkpt_model.transformer.wte.materialize()
         self.chkpt_model.transformer.wpe.materialize()
+        quant = self.neuron_config.quant if self.neuron_config else None
+        self.chkpt_model.transformer.wte = quantize.maybe_quantize_embedding(self.chkpt_model.transformer.wte, quant)
         n_embd = self.config.n_embd
         for layer in self.chkpt_model.transformer.h:
             layer.materialize()
@@ -509,6 +512,7 @@ class GPT2ForSamplingWithContextBroadcasting(module.WrappingCheckpointCompatible
                 offset = estimate - context_length
             
             if not self.share_caches:
+                self.decoder_lm_head.flush_reorder_cache()
                 self.broadcaster[estimate].run_broadcast()
 
             if start_ids is None:
@@ -551,6 +555,7 @@ class GPT2ForSamplingWithContextBroadcasting(module.WrappingCheckpointCompatible
                 input_ids, cache_ids, start_ids, is_context_encode=True
             )
             if not self.share_caches:
+                self.decoder_lm_head.flush_reorder_cache()
                 self.broadcaster[estimate].run_broadcast()
             repeat_factor = batch_size // runtime_batch_size
             input_ids = input_ids.repeat([repeat_factor, 1])
@@ -202,10 +202,13 @@ def dot01(lhs, rhs):
 
 
 def canonicalize_lhs_rhs_dtype(lhs, rhs, neuron_config):
+    """
+    Convert a quantized operand to the dtype of the other operand.
+    """
     enable_quantize = neuron_config is not None \
                         and neuron_config.quant is not None
     scribe = lhs.scribe
-    if enable_quantize:
+    if enable_quantize and not neuron_config.quant.group_wise:
         if lhs.dtype == getattr(scribe, neuron_config.quant.quant_dtype):
             lhs = rhs.dtype[lhs.sizes].Convert(lhs)
         if rhs.dtype == getattr(scribe, neuron_config.quant.quant_dtype):
@@ -222,10 +225,15 @@ def mmadd(
     rhs_contracting_dimension=0,
     bias_dimension=0,
     scales=None,
-    neuron_config=None
+    neuron_config=None,
+    layer_type=None,
 ):
     """
     Matrix-matrix multiplication and optional addition
+
+    When `layer_type` is one of `neuron_config.quant.quantize_activations` the
+    lhs is quantized per token and the s8 dot accumulates in s32 before
+    rescaling by the token and output channel scales (W8A8).
     """
     assert len(lhs.sizes) == 2, f"Expected rank 2 LHS. Found shape={lhs.sizes}"
     assert len(rhs.sizes) == 2, f"Expected rank 2 RHS. Found shape={rhs.sizes}"
@@ -237,9 +245,21 @@ def mmadd(
         f" RHS (dim={rhs_contracting_dimension} shape={rhs.sizes})"
     )
 
-    lhs, rhs, dtype = canonicalize_lhs_rhs_dtype(lhs, rhs, neuron_config)
+    # Weights left unquantized (e.g. `quantize_attn=False`) have no scales
     enable_quantize = neuron_config is not None \
-                        and neuron_config.quant is not None
+                        and neuron_config.quant is not None \
+                        and scales is not None
+    if enable_quantize and neuron_config.quant.group_wise:
+        # Group scales vary along the contraction so they are applied to the weight
+        rhs = dequantize_weight(rhs, scales, neuron_config, rhs_contracting_dimension)
+        rhs = lhs.dtype[rhs.sizes].Convert(rhs)
+        enable_quantize = False
+    quantize_lhs = enable_quantize and neuron_config.quant.quantizes_activations(layer_type)
+    if quantize_lhs:
+        dtype = lhs.dtype
+        lhs, lhs_scales = quantize(lhs, neuron_config, lhs_contracting_dimension)
+    else:
+        lhs, rhs, dtype = canonicalize_lhs_rhs_dtype(lhs, rhs, neuron_config)
 
     lhs_size = lhs.sizes[1 if lhs_contracting_dimension == 0 else 0]
     rhs_size = rhs.sizes[1 if rhs_contracting_dimension == 0 else 0]
@@ -247,29 +267,35 @@ def mmadd(
         lhs_contracting_dimensions=[lhs_contracting_dimension],
         rhs_contracting_dimensions=[rhs_contracting_dimension]
     )
-    dot = dtype[lhs_size, rhs_size].Dot(lhs, rhs, dot_dimension_numbers=dot_dims)
-    if enable_quantize:
-        dot = dequantize(dot, scales, neuron_config, bias_dimension)
+    if quantize_lhs:
+        s32 = lhs.scribe.s32
+        dot = s32[lhs_size, rhs_size].Dot(lhs, rhs, dot_dimension_numbers=dot_dims)
+        dot = dequantize(dot, scales, neuron_config, 1, token_scales=lhs_scales)
+        dot = dtype[dot.sizes].Convert(dot)
+    else:
+        dot = dtype[lhs_size, rhs_size].Dot(lhs, rhs, dot_dimension_numbers=dot_dims)
+        if enable_quantize:
+            dot = dequantize(dot, scales, neuron_config, bias_dimension)
     if bias is None:
         return dot
     bias = dtype[lhs_size, rhs_size].Broadcast(bias, dimensions=[bias_dimension])
     return dtype[lhs_size, rhs_size].Add(dot, bias)
 
 
-def dot00_add0(lhs, rhs, bias, scales=None, neuron_config=None):
-    return mmadd(lhs, rhs, bias, 0, 0, 0, scales, neuron_config)
+def dot00_add0(lhs, rhs, bias, scales=None, neuron_config=None, layer_type=None):
+    return mmadd(lhs, rhs, bias, 0, 0, 0, scales, neuron_config, layer_type)
 
 
-def dot00_add1(lhs, rhs, bias, scales=None, neuron_config=None):
-    return mmadd(lhs, rhs, bias, 0, 0, 1, scales, neuron_config)
+def dot00_add1(lhs, rhs, bias, scales=None, neuron_config=None, layer_type=None):
+    return mmadd(lhs, rhs, bias, 0, 0, 1, scales, neuron_config, layer_type)
 
 
-def dot10_add1(lhs, rhs, bias, scales=None, neuron_config=None):
-    return mmadd(lhs, rhs, bias, 1, 0, 1, scales, neuron_config)
+def dot10_add1(lhs, rhs, bias, scales=None, neuron_config=None, layer_type=None):
+    return mmadd(lhs, rhs, bias, 1, 0, 1, scales, neuron_config, layer_type)
 
 
-def dot11_add1(lhs, rhs, bias, scales=None, neuron_config=None):
-    return mmadd(lhs, rhs, bias, 1, 1, 1, scales, neuron_config)
+def dot11_add1(lhs, rhs, bias, scales=None, neuron_config=None, layer_type=None):
+    return mmadd(lhs, rhs, bias, 1, 1, 1, scales, neuron_config, layer_type)
 
 
 def gen_add_func(dtype):
@@ -325,9 +351,9 @@ def mlp(hidden, in_weight, in_bias, out_weight, out_bias, activation_function, t
     hidden_size, n_active_tokens, batch_size = hidden_sizes = hidden.sizes
     hidden_r_sizes = hidden_size, n_active_tokens * batch_size
     hidden = hidden.dtype[hidden_r_sizes].Reshape(hidden)
-    hidden = dot00_add1(hidden, in_weight, in_bias, in_scales, neuron_config)
+    hidden = dot00_add1(hidden, in_weight, in_bias, in_scales, neuron_config, layer_type='mlp')
     hidden = getattr(activations, activation_function)(hidden)
-    hidden = dot10_add1(hidden, out_weight, out_bias, out_scales, neuron_config)
+    hidden = dot10_add1(hidden, out_weight, out_bias, out_scales, neuron_config, layer_type='mlp')
     hidden = dtype[hidden_r_sizes].Transpose(hidden, dimensions=[1, 0])
     hidden = dtype[hidden_sizes].Reshape(hidden)
     if tp_degree == 1:
@@ -361,9 +387,9 @@ def mlp_bsh(hidden, in_weight, in_bias, out_weight, out_bias, activation_functio
     batch_size, n_active_tokens, hidden_size = hidden_sizes = hidden.sizes
     hidden_r_sizes = batch_size * n_active_tokens, hidden_size
     hidden = hidden.dtype[hidden_r_sizes].Reshape(hidden)
-    hidden = dot10_add1(hidden, in_weight, in_bias, in_scales, neuron_config)
+    hidden = dot10_add1(hidden, in_weight, in_bias, in_scales, neuron_config, layer_type='mlp')
     hidden = getattr(activations, activation_function)(hidden)
-    hidden = dot10_add1(hidden, out_weight, out_bias, out_scales, neuron_config)
+    hidden = dot10_add1(hidden, out_weight, out_bias, out_scales, neuron_config, layer_type='mlp')
     hidden = dtype[hidden_sizes].Reshape(hidden)
     if tp_degree == 1:
         return hidden
@@ -413,14 +439,17 @@ def gated_mlp_bsh(
     hidden = hidden.dtype[hidden_r_sizes].Reshape(hidden)
 
     hidden_active = dot10_add1(hidden, in0_weight, in0_bias,
-                               scales=in0_scales, neuron_config=neuron_config)
+                               scales=in0_scales, neuron_config=neuron_config,
+                               layer_type='mlp')
     hidden_active = getattr(activations, activation_function)(hidden_active)
     hidden_linear = dot10_add1(hidden, in1_weight, in1_bias,
-                               scales=in1_scales, neuron_config=neuron_config)
+                               scales=in1_scales, neuron_config=neuron_config,
+                               layer_type='mlp')
     hidden_states = dtype[hidden_linear.sizes].Multiply(hidden_active, hidden_linear)
 
     result = dot10_add1(hidden_states, out_weight, out_bias,
-                        scales=out_scales, neuron_config=neuron_config)
+                        scales=out_scales, neuron_config=neuron_config,
+                        layer_type='mlp')
     result = dtype[hidden_sizes].Reshape(result)
 
     if tp_degree != 1:
@@ -469,15 +498,18 @@ def gated_mlp(
     hidden = hidden.dtype[hidden_r_sizes].Reshape(hidden)
 
     # (h, b * s) @ (h, i) contract=(0, 0) => (b * s, i)
-    hidden_active = dot00_add1(hidden, in0_weight, in0_bias, scales=in0_scales, neuron_config=neuron_config)
+    hidden_active = dot00_add1(hidden, in0_weight, in0_bias, scales=in0_scales, neuron_config=neuron_config,
+                               layer_type='mlp')
     hidden_active = getattr(activations, activation_function)(hidden_active)
 
     # (h, b * s) @ (h, i) contract=(0, 0) => (b * s, i)
-    hidden_linear = dot00_add1(hidden, in1_weight, in1_bias, scales=in1_scales, neuron_config=neuron_config)
+    hidden_linear = dot00_add1(hidden, in1_weight, in1_bias, scales=in1_scales, neuron_config=neuron_config,
+                               layer_type='mlp')
     hidden_states = dtype[hidden_linear.sizes].Multiply(hidden_active, hidden_linear)
 
     # (b * s, i) @ (h, i) contract=(1, 1) => (b * s, h)
-    result = dot11_add1(hidden_states, out_weight, out_bias, scales=out_scales, neuron_config=neuron_config)
+    result = dot11_add1(hidden_states, out_weight, out_bias, scales=out_scales, neuron_config=neuron_config,
+                        layer_type='mlp')
 
     # (b * s, h) = > (h, s, b)
     result = transpose(result, 0, 1)
@@ -531,6 +563,23 @@ def softmax(logits, dim=None):
     return dtype[logits.sizes].Divide(exp, broadcast_17)
 
 
+def log_softmax(logits, dim=None):
+    rank = len(logits.sizes)
+    if dim is None:
+        dim = rank - 1
+    br_dims = [di for di in range(rank) if di != dim]
+    dtype = logits.dtype
+    reduce_sizes = [logits.sizes[di] for di in br_dims]
+    maximum = reduce_max(logits, dim)
+    maximum = dtype[logits.sizes].Broadcast(maximum, dimensions=br_dims)
+    shifted = dtype[logits.sizes].Subtract(logits, maximum)
+    exp = dtype[logits.sizes].Exp(shifted)
+    summation = reduce_sum(exp, dim)
+    log_summation = dtype[reduce_sizes].Log(summation)
+    log_summation = dtype[logits.sizes].Broadcast(log_summation, dimensions=br_dims)
+    return dtype[logits.sizes].Subtract(shifted, log_summation)
+
+
 def transfer_with_static_ring(shape):
     custom_call_target = 'AwsNeuronTransferWithStaticRing'
     return shape.dtype[shape.sizes].CustomCall(shape, custom_call_target=custom_call_target)
@@ -1013,37 +1062,217 @@ def cache_broadcast(n_positions, from_batch_size, to_batch_size, n_heads_tp, d_h
     return cache_broadcast_impl
 
 
+def cache_fanout(n_positions, from_batch_size, to_batch_size, n_heads_tp, d_head, amp, n_layer):
+    """
+    Copy KV cache rows into a larger batch where each target row selects a source row.
+
+    Unlike `cache_broadcast`, the source row of each target row is an input
+    (s64[to_batch_size]) so that any deduplicated set of prompts can be fanned
+    out to the rows that share them.
+    """
+
+    def cache_fanout_impl(scribe):
+        dtype = getattr(scribe, amp)
+        row_ids = scribe.s64[to_batch_size].Parameter(parameter_number=0)
+        sizes = n_positions, from_batch_size, n_heads_tp, d_head
+        sources = [dtype[sizes].Parameter(parameter_number=pn) for pn in range(1, n_layer * 2 + 1)]
+        outputs = [index_select(source, 1, row_ids) for source in sources]
+        root_shapes = [shape.dtype[shape.sizes] for shape in outputs]
+        return scribe.tuple(*root_shapes).Tuple(*outputs)
+
+    return cache_fanout_impl
+
+
+def cache_scatter(n_positions, from_batch_size, to_batch_size, n_heads_tp, d_head, amp, n_layer):
+    """
+    Copy every KV cache row of a source batch into a selected row of a target batch.
+
+    This is the inverse of `cache_fanout`: source row `i` is written to
+    target row `row_ids[i]` (s64[from_batch_size]) and every other target row
+    is left unchanged. Rows with an out of range id are dropped.
+    """
+
+    def cache_scatter_impl(scribe):
+        dtype = getattr(scribe, amp)
+        row_ids = scribe.s64[from_batch_size].Parameter(parameter_number=0)
+        target_sizes = n_positions, to_batch_size, n_heads_tp, d_head
+        targets = [dtype[target_sizes].Parameter(parameter_number=pn) for pn in range(1, n_layer * 2 + 1)]
+        source_sizes = n_positions, from_batch_size, n_heads_tp, d_head
+        sources = [dtype[source_sizes].Parameter(parameter_number=pn)
+                   for pn in range(n_layer * 2 + 1, n_layer * 4 + 1)]
+        scatter_dims = dict(update_window_dims=[0, 2, 3],
+                            inserted_window_dims=[1],
+                            scatter_dims_to_operand_dims=[1],
+                            index_vector_dim=1)
+        assign_func = gen_assign_func(dtype)
+        outputs = []
+        for target, source in zip(targets, sources):
+            outputs.append(dtype[target_sizes].Scatter(
+                target, row_ids, source, scatter_dimension_numbers=scatter_dims, to_apply=assign_func))
+        root_shapes = [shape.dtype[shape.sizes] for shape in outputs]
+        return scribe.tuple(*root_shapes).Tuple(*outputs)
+
+    return cache_scatter_impl
+
+
+def scatter_rows(target, row_ids, source):
+    """
+    Write row `i` of `source` into row `row_ids[i]` of `target` where rows are dimension 1.
+
+    All other rows of `target` are left unchanged and rows with an out of
+    range id are dropped.
+    """
+    dtype = target.dtype
+    rank = len(target.sizes)
+    scatter_dims = dict(update_window_dims=[dim for dim in range(rank) if dim != 1],
+                        inserted_window_dims=[1],
+                        scatter_dims_to_operand_dims=[1],
+                        index_vector_dim=1)
+    assign_func = gen_assign_func(dtype)
+    return dtype[target.sizes].Scatter(
+        target, row_ids, source, scatter_dimension_numbers=scatter_dims, to_apply=assign_func)
+
+
 def quantize(tensor, neuron_config: NeuronConfig, scales_dim):
+    """
+    Symmetrically quantize `tensor` with one scale per slice along `scales_dim`.
+
+    The abs-max is reduced over `scales_dim` (the contraction dimension for
+    activations) so the scales have the remaining dimensions. Values are
+    rounded to nearest (half away from zero) in float32.
+    """
     scribe = tensor.scribe
+    f32 = scribe.f32
     quant_dtype = getattr(scribe, neuron_config.quant.quant_dtype)
-    dtype = tensor.dtype
-    abs_tensor = dtype[tensor.sizes].Abs(tensor)
+    tensor = f32[tensor.sizes].Convert(tensor)
+    abs_tensor = f32[tensor.sizes].Abs(tensor)
     max_vals = reduce_max(abs_tensor, dim=scales_dim)
-    constant = dtype.Constant(constant_value=127.0)
-    broadcast0 = dtype[max_vals.sizes].Broadcast(constant, dimensions=[])
-    scales = dtype[max_vals.sizes].Divide(max_vals, broadcast0)
+    scales = f32[max_vals.sizes].Divide(max_vals, full(127.0, f32, max_vals.sizes))
+    # All-zero slices would otherwise divide by zero
+    scales = f32[max_vals.sizes].Maximum(scales, full(1e-12, f32, max_vals.sizes))
     bdim = list(range(0, len(tensor.sizes)))
     bdim.remove(scales_dim)
-    broadcast1 = dtype[tensor.sizes].Broadcast(scales, dimensions=bdim)
-    quantized_tensor = dtype[tensor.sizes].Divide(tensor, broadcast1)
-    clamp_upper_bound = dtype[tensor.sizes].Broadcast(dtype.Constant(constant_value=127.0), dimensions=[])
-    clamp_lower_bound = dtype[tensor.sizes].Broadcast(dtype.Constant(constant_value=-128.0), dimensions=[])
-    quantized_tensor = dtype[tensor.sizes].Clamp(clamp_lower_bound, quantized_tensor, clamp_upper_bound)
+    broadcast1 = f32[tensor.sizes].Broadcast(scales, dimensions=bdim)
+    quantized_tensor = f32[tensor.sizes].Divide(tensor, broadcast1)
+    half = f32[tensor.sizes].Multiply(f32[tensor.sizes].Sign(quantized_tensor), full(0.5, f32, tensor.sizes))
+    quantized_tensor = f32[tensor.sizes].Add(quantized_tensor, half)
+    clamp_upper_bound = full(127.0, f32, tensor.sizes)
+    clamp_lower_bound = full(-128.0, f32, tensor.sizes)
+    quantized_tensor = f32[tensor.sizes].Clamp(clamp_lower_bound, quantized_tensor, clamp_upper_bound)
     quantized_tensor = quant_dtype[tensor.sizes].Convert(quantized_tensor)
     return quantized_tensor, scales
 
 
-def dequantize(tensor, scales, neuron_config: NeuronConfig, scales_dim):
+def dequantize(tensor, scales, neuron_config: NeuronConfig, scales_dim, token_scales=None):
+    """
+    Rescale the result of a quantized dot by the output channel `scales`
+    (and, for W8A8, the per-token `token_scales` of the other dimension).
+    """
     scribe = tensor.scribe
     f32 = scribe.f32
     dtype = getattr(scribe, neuron_config.quant.dequant_dtype)
     tensor = f32[tensor.sizes].Convert(tensor)
     scales = f32[tensor.sizes].Broadcast(scales, dimensions=[scales_dim])
     tensor = f32[tensor.sizes].Multiply(tensor, scales)
+    if token_scales is not None:
+        token_scales = f32[tensor.sizes].Broadcast(token_scales, dimensions=[1 - scales_dim])
+        tensor = f32[tensor.sizes].Multiply(tensor, token_scales)
     tensor = dtype[tensor.sizes].Convert(tensor)
     return tensor
 
 
+def unpack_int4(tensor, dim):
+    """
+    Unpack a uint8 tensor holding two 4-bit values per element along `dim`.
+
+    Element `2i` is stored in the low nibble and element `2i + 1` in the high
+    nibble of packed element `i`.
+    """
+    scribe = tensor.scribe
+    u8 = scribe.u8
+    sizes = tensor.sizes
+    low = u8[sizes].And(tensor, full(15, u8, sizes))
+    high = u8[sizes].ShiftRightLogical(tensor, full(4, u8, sizes))
+    # Interleave the nibbles through a new minor dimension
+    pair_sizes = [*sizes[:dim + 1], 1, *sizes[dim + 1:]]
+    low = u8[pair_sizes].Reshape(low)
+    high = u8[pair_sizes].Reshape(high)
+    pair_sizes[dim + 1] = 2
+    unpacked = u8[pair_sizes].Concatenate(low, high, dimensions=[dim + 1])
+    unpacked_sizes = list(sizes)
+    unpacked_sizes[dim] *= 2
+    return u8[unpacked_sizes].Reshape(unpacked)
+
+
+def dequantize_weight(weight, scales, neuron_config: NeuronConfig, contracting_dim):
+    """
+    Dequantize a quantized weight.
+
+    Per-channel weights use `W_f = W_q * scale` and group-wise weights use
+    `W_f = W_q * scale + offset`.
+
+    Arguments:
+        weight: The quantized weight (packed along `contracting_dim` for s4).
+        scales: The per-channel scales vector or, for group-wise weights, the
+            scales and offsets with the shape of the weight, where the
+            contraction dimension counts groups, and a trailing [scale, offset]
+            dimension.
+        neuron_config: The config holding the quantization settings.
+        contracting_dim: The input feature dimension of the weight.
+
+    Returns:
+        weight: The weight in the dequantization dtype.
+    """
+    scribe = weight.scribe
+    f32 = scribe.f32
+    dtype = getattr(scribe, neuron_config.quant.dequant_dtype)
+    if not neuron_config.quant.group_wise:
+        sizes = weight.sizes
+        weight = f32[sizes].Convert(weight)
+        scales = f32[sizes].Broadcast(scales, dimensions=[1 - contracting_dim])
+        weight = f32[sizes].Multiply(weight, scales)
+        return dtype[sizes].Convert(weight)
+    if neuron_config.quant.quant_dtype == 's4':
+        weight = unpack_int4(weight, contracting_dim)
+    weight = dequantize_groups(weight, scales, contracting_dim, f32)
+    return dtype[weight.sizes].Convert(weight)
+
+
+def dequantize_groups(weight, scales, contracting_dim, compute_dtype):
+    """
+    Compute `W_f = W_q * scale + offset` in `compute_dtype` where each
+    [scale, offset] pair covers a group of consecutive input features of one
+    output channel.
+
+    Arguments:
+        weight: The unpacked integer weight.
+        scales: The scales and offsets with the shape of the weight, where the
+            contraction dimension counts groups, and a trailing [scale, offset]
+            dimension.
+        contracting_dim: The input feature dimension of the weight.
+        compute_dtype: The dtype of the computation and of the result.
+    """
+    sizes = weight.sizes
+    n_groups = scales.sizes[contracting_dim]
+    grouped_sizes = list(sizes)
+    grouped_sizes[contracting_dim:contracting_dim + 1] = [n_groups, sizes[contracting_dim] // n_groups]
+    scale_dims = [0, 2] if contracting_dim == 0 else [0, 1]
+
+    scale_sizes = scales.sizes[:2]
+    scale = scales.dtype[scale_sizes].Reshape(slice_along(scales, 2, limit=1))
+    offset = scales.dtype[scale_sizes].Reshape(slice_along(scales, 2, limit=2, start=1))
+    scale = compute_dtype[scale_sizes].Convert(scale)
+    offset = compute_dtype[scale_sizes].Convert(offset)
+    scale = compute_dtype[grouped_sizes].Broadcast(scale, dimensions=scale_dims)
+    offset = compute_dtype[grouped_sizes].Broadcast(offset, dimensions=scale_dims)
+
+    weight = compute_dtype[sizes].Convert(weight)
+    weight = compute_dtype[grouped_sizes].Reshape(weight)
+    weight = compute_dtype[grouped_sizes].Multiply(weight, scale)
+    weight = compute_dtype[grouped_sizes].Add(weight, offset)
+    return compute_dtype[sizes].Reshape(weight)
+
+
 def reduce_mean(tensor, dims, keepdim=False):
 
     dtype = tensor.dtype
@@ -1215,6 +1444,17 @@ def dynamic_slice_along(tensor, dim, start, size):
     )
 
 
+def update_along(tensor, dim, update, start):
+    """
+    Write `update` into `tensor` starting at a constant offset along a dimension.
+    """
+    s32 = tensor.scribe.s32
+    zero = s32.Constant(constant_value=0)
+    starts = [zero] * len(tensor.sizes)
+    starts[dim] = s32.Constant(constant_value=start)
+    return tensor.dtype[tensor.sizes].DynamicUpdateSlice(tensor, update, *starts)
+
+
 def pad(tensor, dim, size, value=0):
     rank = len(tensor.sizes)
     dtype = tensor.dtype
@@ -1401,6 +1641,261 @@ def topk(tensor, dim, k=50, tp_degree=1):
     return output(value, index)
 
 
+def compact_logits(logits, vocab_size, tp_degree, dtype=None, k=None):
+    """
+    Gather vocab-sharded logits so that every rank holds the compacted result.
+
+    This allows the host to read the logits from a single rank rather than
+    concatenating the shards from every rank.
+
+    Arguments:
+        logits: The rank-local logits of shape [vocab_shard, n_active_tokens, batch_size].
+        vocab_size: The unpadded vocabulary size. Padding is trimmed on device.
+        tp_degree: The tensor parallel degree.
+        dtype: The output dtype. Default: The logits dtype.
+        k: When set, return only the top-k candidates.
+
+    Returns:
+        logits: The logits of shape [vocab_size, n_active_tokens, batch_size].
+            When `k` is set, an f32 tensor of shape [2 * k, n_active_tokens, batch_size]
+            holding the top-k values followed by their vocabulary indices.
+    """
+    if k is not None:
+        f32 = logits.scribe.f32
+        value, index = topk(logits, dim=0, k=k, tp_degree=tp_degree)
+        value = cast(value, f32)
+        index = cast(index, f32)
+        sizes = list(value.sizes)
+        sizes[0] *= 2
+        return f32[sizes].Concatenate(value, index, dimensions=[0])
+    logits = all_gather(logits, dim=0, tp_degree=tp_degree)
+    logits = slice_along(logits, dim=0, limit=vocab_size)
+    if dtype is not None:
+        logits = cast(logits, dtype)
+    return logits
+
+
+def _beam_topk(scores, k):
+    """
+    Top-k of f32 scores along the last dimension which never selects padding.
+
+    The top-k size must be a multiple of 8. The scores are padded with -inf
+    rather than the dtype minimum used by `_topk` since log-probabilities may
+    themselves be -inf. Indices of padding (only selected when fewer than `k`
+    scores are finite) are clamped to the last real index.
+    """
+    size = scores.sizes[-1]
+    padded_size = utils.round_up_to_divisor(size, 8)
+    if padded_size != size:
+        scores = pad(scores, -1, padded_size - size, value=float('-inf'))
+    values, index = topk(scores, dim=1, k=k)
+    index = index.dtype[index.sizes].Minimum(index, full(size - 1, index.dtype, index.sizes))
+    return values, index
+
+
+def beam_search_step(logits, beam_scores, vocab_size, num_beams, tp_degree):
+    """
+    Select the next beam candidates from the logits of every beam.
+
+    Each beam accumulates its log-probabilities onto its running score. The
+    best `2 * num_beams` candidates of each batch line are then selected
+    across all of its beams. Twice as many candidates as beams are returned
+    so that the caller can set aside finished hypotheses and still continue
+    `num_beams` beams.
+
+    Arguments:
+        logits: The rank-local logits of shape [vocab_shard, 1, batch_size * num_beams].
+        beam_scores: The f32 running beam scores of shape [batch_size * num_beams].
+        vocab_size: The unpadded vocabulary size.
+        num_beams: The number of beams of each batch line.
+        tp_degree: The tensor parallel degree.
+
+    Returns:
+        candidates: An f32 tensor of shape [batch_size, 3 * 2 * num_beams] holding
+            the candidate scores, token ids and source beams (within the batch line).
+    """
+    f32 = logits.scribe.f32
+    _, n_active_tokens, n_rows = logits.sizes
+    assert n_active_tokens == 1, 'Beam search is only supported for single token generation'
+    batch_size = n_rows // num_beams
+    k = 2 * num_beams
+
+    # Compute log-probabilities over the full unpadded vocabulary
+    logits = all_gather(logits, dim=0, tp_degree=tp_degree)
+    logits = slice_along(logits, dim=0, limit=vocab_size)
+    logits = cast(logits, f32)
+    logits = reshape(logits, [vocab_size, n_rows])
+    logits = transpose(logits, 0, 1)
+    scores = log_softmax(logits, dim=1)
+
+    # Accumulate beam scores
+    beam_scores = f32[scores.sizes].Broadcast(beam_scores, dimensions=[0])
+    scores = f32[scores.sizes].Add(scores, beam_scores)
+
+    # The best candidates of a batch line are always within the best candidates of each beam
+    scores, tokens = _beam_topk(scores, k)
+    scores = reshape(scores, [batch_size, num_beams * k])
+    tokens = reshape(tokens, [batch_size, num_beams * k])
+    scores, index = _beam_topk(scores, k)
+    tokens = gather(tokens, 1, index)
+
+    # Source beam of each candidate. Note: Use f32 computation to avoid compiler issue
+    sizes = index.sizes
+    index = cast(index, f32)
+    k_size = f32[sizes].Broadcast(f32.Constant(constant_value=k), dimensions=[])
+    beams = f32[sizes].Divide(index, k_size)
+    beams = f32[sizes].Floor(beams)
+
+    tokens = cast(tokens, f32)
+    return f32[batch_size, 3 * k].Concatenate(scores, tokens, beams, dimensions=[1])
+
+
+def _scatter_add_ids(dense, vocab_ids, ids, values=None):
+    """
+    Add `values` at the rank-local position of each of `ids` in its batch row.
+
+    The ids are offset by the first vocabulary id held by this rank. Ids of
+    other ranks and negative ids fall outside of the shard and the scatter
+    drops them, so no [vocab_shard, m, batch_size] one-hot tensor is built.
+
+    Arguments:
+        dense: The f32 tensor to add to of shape [vocab_shard, batch_size].
+        vocab_ids: The s32 vocabulary ids held by this rank of shape [vocab_shard].
+        ids: The s32 ids of shape [m, batch_size]. Negative ids are ignored.
+        values: The f32 weight of each id of shape [m, batch_size]. Default: 1.
+
+    Returns:
+        dense: The updated tensor of shape [vocab_shard, batch_size].
+    """
+    scribe = ids.scribe
+    f32 = scribe.f32
+    s32 = scribe.s32
+    m, batch_size = ids.sizes
+    sizes = m, batch_size
+    first_id = s32.Reshape(slice_along(vocab_ids, 0, limit=1))
+    local_ids = s32[sizes].Subtract(ids, s32[sizes].Broadcast(first_id, dimensions=[]))
+    rows = s32[sizes].Iota(dimensions=[1])
+    n_updates = m * batch_size
+    indices = s32[n_updates, 2].Concatenate(reshape(local_ids, [n_updates, 1]), reshape(rows, [n_updates, 1]),
+                                             dimensions=[1])
+    if values is None:
+        updates = full(1, f32, [n_updates])
+    else:
+        updates = reshape(values, [n_updates])
+    scatter_dims = dict(update_window_dims=[],
+                        inserted_window_dims=[0, 1],
+                        scatter_dims_to_operand_dims=[0, 1],
+                        index_vector_dim=1)
+    return f32[dense.sizes].Scatter(dense, indices, updates, scatter_dimension_numbers=scatter_dims,
+                                    to_apply=gen_add_func(f32))
+
+
+def update_token_counts(token_counts, vocab_ids, token_ids):
+    """
+    Add the occurrences of `token_ids` to a per-row token count histogram.
+
+    Arguments:
+        token_counts: The f32 rank-local counts of shape [vocab_shard, batch_size].
+        vocab_ids: The s32 vocabulary ids held by this rank of shape [vocab_shard].
+        token_ids: The s32 ids of the active tokens of shape [n_active_tokens, batch_size].
+            Negative ids (e.g. padding) are not counted.
+
+    Returns:
+        token_counts: The updated counts.
+    """
+    return _scatter_add_ids(token_counts, vocab_ids, token_ids)
+
+
+def apply_logits_processors(logits, token_counts, penalties, vocab_ids=None, bias_ids=None, bias_values=None):
+    """
+    Apply repetition, presence and frequency penalties and a sparse logit bias.
+
+    This operates on rank-local vocab shards so that the full logits never
+    need to be gathered. Penalties follow the HuggingFace (repetition) and
+    OpenAI (presence/frequency) definitions:
+
+        logit = logit / repetition if logit > 0 else logit * repetition   (if count > 0)
+        logit -= presence * (count > 0) + frequency * count
+        logit += bias
+
+    Arguments:
+        logits: The rank-local logits of shape [vocab_shard, n_active_tokens, batch_size].
+        token_counts: The f32 rank-local counts of shape [vocab_shard, batch_size].
+        penalties: The f32 repetition, presence and frequency penalties of shape [3, batch_size].
+        vocab_ids: The s32 vocabulary ids held by this rank of shape [vocab_shard].
+        bias_ids: The s32 biased token ids of shape [max_logit_bias, batch_size]. Negative ids are ignored.
+        bias_values: The f32 bias of each id of shape [max_logit_bias, batch_size].
+
+    Returns:
+        logits: The processed logits in the original dtype.
+    """
+    scribe = logits.scribe
+    f32 = scribe.f32
+    pred = scribe.pred
+    dtype = logits.dtype
+    sizes = logits.sizes
+    vocab_shard, _, batch_size = sizes
+
+    def row_param(index):
+        param = slice_along(penalties, 0, limit=index + 1, start=index)
+        param = reshape(param, [batch_size])
+        return f32[sizes].Broadcast(param, dimensions=[2])
+
+    logits = cast(logits, f32)
+    counts = f32[sizes].Broadcast(token_counts, dimensions=[0, 2])
+    zero = full(0, f32, sizes)
+    seen = pred[sizes].Compare(counts, zero, comparison_direction='GT')
+
+    repetition = row_param(0)
+    positive = pred[sizes].Compare(logits, zero, comparison_direction='GT')
+    penalized = f32[sizes].Select(positive, f32[sizes].Divide(logits, repetition),
+                                  f32[sizes].Multiply(logits, repetition))
+    logits = f32[sizes].Select(seen, penalized, logits)
+
+    presence = f32[sizes].Select(seen, row_param(1), zero)
+    frequency = f32[sizes].Multiply(row_param(2), counts)
+    logits = f32[sizes].Subtract(logits, f32[sizes].Add(presence, frequency))
+
+    if bias_ids is not None:
+        bias = _scatter_add_ids(full(0, f32, [vocab_shard, batch_size]), vocab_ids, bias_ids, bias_values)
+        bias = f32[sizes].Broadcast(bias, dimensions=[0, 2])
+        logits = f32[sizes].Add(logits, bias)
+
+    return cast(logits, dtype)
+
+
+def apply_token_mask(logits, token_mask, vocab_ids):
+    """
+    Set the logits of tokens which are not allowed by a packed bitmask to -inf.
+
+    Arguments:
+        logits: The rank-local logits of shape [vocab_shard, n_active_tokens, batch_size].
+        token_mask: The s32 packed mask of shape [ceil(vocab_size / 32), batch_size]
+            where bit `v % 32` of word `v // 32` allows token `v`.
+        vocab_ids: The s32 vocabulary ids held by this rank of shape [vocab_shard].
+
+    Returns:
+        logits: The masked logits.
+    """
+    scribe = logits.scribe
+    s32 = scribe.s32
+    pred = scribe.pred
+    vocab_shard, _, batch_size = logits.sizes
+    five = full(5, s32, vocab_ids.sizes)
+    thirty_one = full(31, s32, vocab_ids.sizes)
+    word_ids = s32[vocab_ids.sizes].ShiftRightLogical(vocab_ids, five)
+    bit_ids = s32[vocab_ids.sizes].And(vocab_ids, thirty_one)
+    sizes = vocab_shard, batch_size
+    words = index_select(token_mask, 0, word_ids)
+    bit_ids = s32[sizes].Broadcast(bit_ids, dimensions=[0])
+    bits = s32[sizes].ShiftRightLogical(words, bit_ids)
+    bits = s32[sizes].And(bits, full(1, s32, sizes))
+    allowed = pred[sizes].Compare(bits, full(0, s32, sizes), comparison_direction='NE')
+    allowed = pred[logits.sizes].Broadcast(allowed, dimensions=[0, 2])
+    minimum = full(float('-inf'), logits.dtype, logits.sizes)
+    return logits.dtype[logits.sizes].Select(allowed, logits, minimum)
+
+
 def multinomial(probabilities, dim):
     """
     Single sample multinomial selection along a dimension
@@ -49,13 +49,13 @@ def query_key_value(
     hidden_r = dtype[hidden_r_sizes].Reshape(hidden)
 
     # Q = (hidden @ wQ) + bQ
-    active_q = hlo.dot00_add1(hidden_r, q_weight, q_bias, q_scales, neuron_config)
+    active_q = hlo.dot00_add1(hidden_r, q_weight, q_bias, q_scales, neuron_config, layer_type='attn')
 
     # K = (hidden @ wK) + bK
-    active_k = hlo.dot00_add1(hidden_r, k_weight, k_bias, k_scales, neuron_config)
+    active_k = hlo.dot00_add1(hidden_r, k_weight, k_bias, k_scales, neuron_config, layer_type='attn')
 
     # V = (hidden @ wV) + bV
-    active_v = hlo.dot00_add1(hidden_r, v_weight, v_bias, v_scales, neuron_config)
+    active_v = hlo.dot00_add1(hidden_r, v_weight, v_bias, v_scales, neuron_config, layer_type='attn')
 
 
     if n_groups == 0:
@@ -381,21 +381,9 @@ def output(
     hidden_sizes = n_seqs, n_active_tokens, hidden_size
     hidden_r_sizes = n_seqs * n_active_tokens, hidden_size
 
-    enable_quantize = neuron_config and neuron_config.quant
-    if enable_quantize:
-        out_weight = dtype[out_weight.sizes].Convert(out_weight)
-
     result_sizes_2d = n_seqs * n_active_tokens, n_heads_tp * d_head
     result = dtype[result_sizes_2d].Reshape(context)
-    dot_dims = dict(lhs_contracting_dimensions=[1], rhs_contracting_dimensions=[0])
-    result = dtype[hidden_r_sizes].Dot(result, out_weight, dot_dimension_numbers=dot_dims)
-    if enable_quantize:
-        result = hlo.dequantize(result, out_scales, neuron_config, 1)
-
-    if out_bias is not None:
-        out_bias = dtype[hidden_r_sizes].Broadcast(out_bias, dimensions=[1])
-        result = dtype[hidden_r_sizes].Add(result, out_bias)
-
+    result = hlo.dot10_add1(result, out_weight, out_bias, out_scales, neuron_config, layer_type='attn')
     result = dtype[hidden_sizes].Reshape(result)
 
     if tp_degree == 1:
@@ -48,13 +48,13 @@ def query_key_value(
     hidden_r = dtype[hidden_r_sizes].Reshape(hidden)
 
     # Q = (hidden @ wQ) + bQ
-    active_q = hlo.dot00_add1(hidden_r, q_weight, q_bias, q_scales, neuron_config)
+    active_q = hlo.dot00_add1(hidden_r, q_weight, q_bias, q_scales, neuron_config, layer_type='attn')
 
     # K = (hidden @ wK) + bK
-    active_k = hlo.dot00_add1(hidden_r, k_weight, k_bias, k_scales, neuron_config)
+    active_k = hlo.dot00_add1(hidden_r, k_weight, k_bias, k_scales, neuron_config, layer_type='attn')
 
     # V = (hidden @ wV) + bV
-    active_v = hlo.dot00_add1(hidden_r, v_weight, v_bias, v_scales, neuron_config)
+    active_v = hlo.dot00_add1(hidden_r, v_weight, v_bias, v_scales, neuron_config, layer_type='attn')
 
 
     if n_groups == 0:
@@ -365,15 +365,12 @@ def output(
     hidden_size, _ = out_weight.sizes
     hidden_sizes = hidden_size, n_active_tokens, n_seqs
 
-    enable_quantize = neuron_config and neuron_config.quant
-    if enable_quantize:
-        out_weight = dtype[out_weight.sizes].Convert(out_weight)
-
     result_sizes_2d = n_active_tokens * n_seqs, n_heads_tp * d_head
     result = dtype[result_sizes_2d].Reshape(context)
 
     # (b * s, padded_h) @ (h, padded_h) contract=(1, 1) => (b * s, h)
-    result = hlo.dot11_add1(result, out_weight, out_bias, out_scales, neuron_config=neuron_config)
+    result = hlo.dot11_add1(result, out_weight, out_bias, out_scales, neuron_config=neuron_config,
+                            layer_type='attn')
 
     # (b * s, h) => (h, s, b)
     result = hlo.transpose(result, 0, 1)
@@ -22,6 +22,7 @@ def generate(logits, config: config.GenerationConfig, tp_degree=1):
             logits,
             k=config.top_k,
             temperature=config.temperature,
+            top_p=config.top_p,
             tp_degree=tp_degree
         )
     else:
@@ -35,21 +36,93 @@ def greedy_search(logits, *, tp_degree=1):
     return result.dtype[batch_size, 1].Reshape(result)
 
 
-def sample(logits, *, k=50, temperature=None, tp_degree=1):
+def is_per_row(value):
+    """
+    Check if a sampling parameter is a runtime tensor with one value per row.
+    """
+    return hasattr(value, 'sizes')
+
+
+def sample(logits, *, k=50, temperature=None, top_k=None, top_p=None, token_mask=None, vocab_ids=None,
+           tp_degree=1):
+    """
+    Sample one token per row from the top-k logits.
+
+    Each of `temperature`, `top_k` and `top_p` may either be a python scalar
+    applied to every row, or a `[batch_size]` tensor (f32 for `temperature`
+    and `top_p`, s32 for `top_k`) to use heterogeneous parameters in one
+    batch. The static `k` bounds the per-row `top_k`.
+
+    Arguments:
+        logits: The `[vocab_size, 1, batch_size]` logits.
+        k: The static number of candidates to consider.
+        temperature: The temperature(s) to divide the logits by.
+        top_k: The per-row number of candidates to keep (at most `k`).
+        top_p: The nucleus probability mass to keep.
+        token_mask: An s32 packed mask of allowed tokens of shape
+            [ceil(vocab_size / 32), batch_size] (see `constraints.pack_token_mask`).
+        vocab_ids: The s32 vocabulary ids of the rank-local logits of shape
+            [vocab_shard]. Required for `token_mask` when `tp_degree > 1`.
+        tp_degree: The tensor parallel degree of the vocabulary.
+
+    Returns:
+        tokens: The `[batch_size, 1]` sampled token ids.
+    """
     vocab_size, n_active_tokens, batch_size = logits.sizes
     assert n_active_tokens == 1
 
-    if k == 1:
+    if token_mask is not None:
+        if vocab_ids is None:
+            assert tp_degree == 1, 'vocab_ids are required to mask vocab-sharded logits'
+            vocab_ids = logits.scribe.s32[vocab_size].Iota(dimensions=[0])
+        logits = hlo.apply_token_mask(logits, token_mask, vocab_ids)
+
+    per_row = any(is_per_row(value) for value in (temperature, top_k, top_p))
+    if k == 1 and not per_row:
         return greedy_search(logits, tp_degree=tp_degree)
 
     logits = hlo.reshape(logits, (batch_size, vocab_size))
     topk_logits, topk_indices = hlo.topk(logits, k=k, dim=1, tp_degree=tp_degree)
+    dtype = topk_logits.dtype
+    sizes = topk_logits.sizes
+    pred = topk_logits.scribe.pred
 
-    if temperature is not None and temperature != 1.0:
+    if is_per_row(temperature):
+        temperature = hlo.cast(temperature, dtype)
+        temperature = dtype[sizes].Broadcast(temperature, dimensions=[0])
+        topk_logits = hlo.divide(topk_logits, temperature)
+    elif temperature is not None and temperature != 1.0:
         temperature = hlo.full_like(topk_logits, temperature)
         topk_logits = hlo.divide(topk_logits, temperature)
 
+    if is_per_row(top_k):
+        # Mask candidates ranked at or beyond each row's top_k. Candidates are sorted
+        s32 = topk_logits.scribe.s32
+        ranks = s32[sizes].Iota(dimensions=[1])
+        top_k = s32[sizes].Broadcast(hlo.cast(top_k, s32), dimensions=[0])
+        keep = pred[sizes].Compare(ranks, top_k, comparison_direction='LT')
+        minimum = hlo.full(float('-inf'), dtype, sizes)
+        topk_logits = dtype[sizes].Select(keep, topk_logits, minimum)
+    elif top_k is not None and top_k < k:
+        topk_logits, topk_indices = hlo.slice_along(topk_logits, 1, top_k), hlo.slice_along(topk_indices, 1, top_k)
+        sizes = topk_logits.sizes
+
     probs = hlo.softmax(topk_logits, dim=1)
+
+    if top_p is not None and (is_per_row(top_p) or top_p < 1.0):
+        # Keep a candidate when the mass strictly before it is below top_p, so
+        # that at least the most likely candidate always remains
+        preceding = dtype[sizes].Subtract(hlo.cumsum(probs, 1), probs)
+        if is_per_row(top_p):
+            top_p = dtype[sizes].Broadcast(hlo.cast(top_p, dtype), dimensions=[0])
+        else:
+            top_p = hlo.full_like(probs, top_p)
+        keep = pred[sizes].Compare(preceding, top_p, comparison_direction='LT')
+        probs = dtype[sizes].Select(keep, probs, hlo.full_like(probs, 0))
+        total = hlo.reduce_sum(probs, 1, keepdim=True)
+        total = dtype[sizes].Broadcast(hlo.reshape(total, (batch_size,)), dimensions=[0])
+        probs = hlo.divide(probs, total)
+
     samples = hlo.multinomial(probs, dim=1)
     result = hlo.select(topk_indices, dim=1, index=samples)
     return hlo.reshape(result, (batch_size, 1))
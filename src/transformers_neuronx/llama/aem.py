@@ -46,7 +46,7 @@ class AEMLlamaForSampling(LlamaForSampling):
         # Run LLM HEAD  <<---------------
         return hidden
         
-    def forward(self, input_ids, cache_ids=None, start_ids=None):
+    def forward(self, input_ids, cache_ids=None, start_ids=None, position=None):
 
         batch_size, context_length = input_ids.shape
         if start_ids is None:
@@ -60,7 +60,7 @@ class AEMLlamaForSampling(LlamaForSampling):
         if context_length > 1:
             hidden = self.context(hidden, cache_ids, start_ids)
         else:
-            hidden = self.decoder_lm_head(hidden, cache_ids, start_ids)
+            hidden = self.decoder_lm_head(hidden, cache_ids, start_ids, position=position)
 
         # Apply AEMs to hidden here <<----------------------
         aems = self.run_aems(hidden)
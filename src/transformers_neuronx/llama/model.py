@@ -17,10 +17,12 @@ import os
 from transformers_neuronx import decoder
 from transformers_neuronx import module
 from transformers_neuronx import ops
+from transformers_neuronx import quantize
 from transformers_neuronx import sampling
 from transformers_neuronx import utils
 from transformers_neuronx import bucket
 from transformers_neuronx import base
+from transformers_neuronx import constraints as constraints_module
 from transformers_neuronx.llama.config import LlamaConfig
 from transformers_neuronx.llama.modules import LlamaForCausalLM
 from transformers_neuronx.llama.hlo import LlamaForSamplingNoEmbeddingHlo
@@ -30,11 +32,24 @@ class LlamaForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronMode
 
     def __init__(self, config, *, n_positions=2048, batch_size=1, amp='f32', tp_degree=2,
                  context_length_estimate=None, context_unroll=None, unroll=None,
-                 neuron_config=None, prefixed_length=0, **kwargs):
+                 neuron_config=None, prefixed_length=0, ping_pong=False, num_beams=None,
+                 prompt_batch_size=None, **kwargs):
+        self.batch_sizes = bucket.batch_sizes(batch_size)
+        *_, batch_size = self.batch_sizes
+        if ping_pong and batch_size % 2:
+            raise ValueError(f'ping_pong requires an even batch_size, got batch_size={batch_size}')
+        self.ping_pong = ping_pong
+        if num_beams is not None and batch_size % num_beams:
+            raise ValueError(f'batch_size={batch_size} is not a multiple of num_beams={num_beams}')
+        self.num_beams = num_beams
+        # The maximum number of unique prompts encoded before fanning out the caches
+        self.prompt_batch_size = prompt_batch_size
         config = LlamaConfig(config, n_positions, batch_size, amp, tp_degree)
         super().__init__(LlamaForCausalLM, config)
         self.config = config
         self.neuron_config = neuron_config
+        # Penalties and logit bias are applied on device from the token ids of every step
+        self.logits_processing = neuron_config is not None and neuron_config.logits_processors is not None
         self.prefixed_length = prefixed_length
         if context_unroll is None:
             context_unroll = config.num_hidden_layers
@@ -60,6 +75,12 @@ class LlamaForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronMode
         self.decoder_lm_head.add_inputs_builder(hlo_builder.inputs)
         self.decoder_lm_head.add_layer_builder(hlo_builder.layer)
         self.decoder_lm_head.add_ln_lm_head_builder(hlo_builder.ln_lm_head)
+        # With `LogitsConfig.top_k` the sampler selects from the returned candidates
+        self.decoder_lm_head.return_candidates = True
+        self.decoder_lm_head_for_batch = None
+        self.decoder_lm_head_for_micro_batch = None
+        self.decoder_lm_head_for_beam = None
+        self.decoder_lm_head_for_prompt = None
         self.decoder_lm_head_for_context = None
 
     def _save_compiled_artifacts(self, directory):
@@ -82,6 +103,8 @@ class LlamaForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronMode
 
         # Materialize the embedding to CPU
         self.chkpt_model.model.embed_tokens.materialize()
+        quant = self.neuron_config.quant if self.neuron_config else None
+        self.chkpt_model.model.embed_tokens = quantize.maybe_quantize_embedding(self.chkpt_model.model.embed_tokens, quant)
 
         ops.init()
 
@@ -116,37 +139,74 @@ class LlamaForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronMode
         self.decoder_lm_head.to_neuron()
         self.decoder_lm_head.enable_executor()
 
+        # Smaller batch networks run on a prefix of the rows of the full batch caches
+        self.decoder_lm_head_for_batch = {}
+        for batch_size in self.batch_sizes:
+            model = self.decoder_lm_head
+            if batch_size != self.config.batch_size:
+                model = self.decoder_lm_head.build_weight_shared(batch_size=batch_size, share_caches=True)
+                model.enable_executor()
+            self.decoder_lm_head_for_batch[batch_size] = model
+
+        # Each half of the batch runs on its own rows of the caches so that the halves can alternate on device
+        if self.ping_pong:
+            micro_batch_size = self.config.batch_size // 2
+            self.decoder_lm_head_for_micro_batch = []
+            for micro_batch in range(2):
+                model = self.decoder_lm_head.build_weight_shared(
+                    batch_size=micro_batch_size, share_caches=True, batch_offset=micro_batch * micro_batch_size)
+                model.enable_executor()
+                self.decoder_lm_head_for_micro_batch.append(model)
+
+        # Beam search selects candidates and reorders the caches inside the token generation network
+        if self.num_beams is not None:
+            self.decoder_lm_head_for_beam = self.decoder_lm_head.build_weight_shared(
+                share_caches=True, num_beams=self.num_beams)
+            self.decoder_lm_head_for_beam.enable_executor()
+
         if self.context_buckets:
             self.decoder_lm_head_for_context = {}
             for context_length_estimate in self.context_buckets:
-                model = self.decoder_lm_head.build_weight_shared(
-                    n_positions_list=[context_length_estimate],
-                    n_active_tokens=context_length_estimate,
-                    unroll=self.context_unroll,
-                    share_caches=True,
-                )
-                # PERF: No latency improvement seen in multi-layer models from executor
-                if self.context_unroll == self.config.num_hidden_layers:
+                for batch_size in self.batch_sizes:
+                    model = self.decoder_lm_head_for_batch[batch_size].build_weight_shared(
+                        n_positions_list=[context_length_estimate],
+                        n_active_tokens=context_length_estimate,
+                        unroll=self.context_unroll,
+                        share_caches=True,
+                    )
                     model.enable_executor()
-                self.decoder_lm_head_for_context[context_length_estimate] = model
+                    self.decoder_lm_head_for_context[context_length_estimate, batch_size] = model
+
+        # Prompt networks own small caches which are fanned out into the token generation caches
+        if self.context_buckets and self.prompt_batch_size is not None:
+            self.decoder_lm_head_for_prompt = {}
+            for context_length_estimate in self.context_buckets:
+                self.decoder_lm_head_for_prompt[context_length_estimate] = self.decoder_lm_head.build_prompt_fanout(
+                    context_length_estimate, self.prompt_batch_size, unroll=self.context_unroll)
 
     def reset(self):
+        # Every network shares the caches and logits processor state of the full batch network
         self.decoder_lm_head.reset()
 
-    def context(self, hidden, cache_ids, start_ids):
+    def context(self, hidden, cache_ids, start_ids, prompts=None, token_ids=None):
         context_length = hidden.shape[1]
+        batch_size = hidden.shape[2]
         current = 0
         estimate = bucket.find(self.context_buckets, context_length)
+        decoder_lm_head = self.decoder_lm_head_for_batch[batch_size]
+        extras = [] if token_ids is None else [token_ids]
 
         if estimate is not None:
             hidden_context = hidden
             cache_context = cache_ids
+            extras_context = extras
 
             # Slice context that when it is too large
             if context_length > estimate:
                 current = estimate
                 hidden_context = hidden[:, :estimate]
                 cache_context = cache_ids[:estimate]
+                extras_context = [extra[:estimate] for extra in extras]
 
             # Cannot use context encoding for a context that is too small. This
             # is because the caller must be aware of the cache-ids/start-ids
@@ -158,17 +218,49 @@ class LlamaForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronMode
             else:
                 current = estimate
 
-            if current == estimate:
-                model = self.decoder_lm_head_for_context[estimate]
-                logits = model(hidden_context, cache_context, start_ids)
+            if current == estimate and prompts is not None:
+                logits = self._context_fanout(hidden_context, cache_context, start_ids, estimate, prompts)
+            elif current == estimate:
+                model = self.decoder_lm_head_for_context[estimate, batch_size]
+                logits = model(hidden_context, cache_context, start_ids, *extras_context)
 
         for i in range(current, context_length):
             cache_ids = torch.as_tensor([i], dtype=torch.int32)
             hidden_slice = hidden[:, i:i+1].contiguous()
-            logits = self.decoder_lm_head(hidden_slice, cache_ids, start_ids)
+            extras_slice = [extra[i:i+1].contiguous() for extra in extras]
+            logits = decoder_lm_head(hidden_slice, cache_ids, start_ids, *extras_slice, position=i)
 
         return logits
 
+    def _network_for_rows(self, batch_size):
+        """
+        Find the smallest network which fits `batch_size` rows.
+        """
+        model_batch_size = bucket.find(self.batch_sizes, batch_size)
+        if batch_size > model_batch_size:
+            raise ValueError(f'batch_size={batch_size} exceeds the largest compiled batch size '
+                             f'{model_batch_size}')
+        return self.decoder_lm_head_for_batch[model_batch_size]
+
+    def _token_ids(self, input_ids, cache_ids, start_ids):
+        """
+        Build the token ids which update the on-device token counts.
+
+        Returns:
+            token_ids: The s32 ids of shape [context_length, batch_size] where
+                left padding (positions before `start_ids`) is -1. None when
+                logits processing is disabled.
+        """
+        if not self.logits_processing:
+            return None
+        token_ids = input_ids.to(torch.int32)
+        padding = cache_ids.unsqueeze(0) < start_ids.unsqueeze(1)
+        token_ids = token_ids.masked_fill(padding, -1)
+        return token_ids.transpose(0, 1).contiguous()
+
+    def _context_fanout(self, hidden, cache_ids, start_ids, estimate, prompts):
+        return self.decoder_lm_head_for_prompt[estimate](hidden, cache_ids, start_ids, prompts)
+
     def set_prefixed(self, input_ids):
         self.prefixed_input_ids = input_ids[:, :self.prefixed_length]
         prefixed_length = self.prefixed_length
@@ -176,31 +268,158 @@ class LlamaForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronMode
         self.forward(self.prefixed_input_ids)
         self.prefixed_length = prefixed_length
 
-    def forward(self, input_ids, cache_ids=None, start_ids=None):
-
+    def forward(self, input_ids, cache_ids=None, start_ids=None, position=None):
+        """
+        Arguments:
+            position: The cache id of a single token step if it is known by
+                the caller, which avoids reading it back from `cache_ids`.
+        """
         batch_size, context_length = input_ids.shape
         if start_ids is None:
             start_ids = torch.zeros(batch_size, dtype=torch.int32)
         if cache_ids is None:
             cache_ids = torch.arange(context_length, dtype=torch.int32)
         if self.prefixed_length:
-            cache_ids += self.prefixed_length
+            cache_ids = cache_ids + self.prefixed_length
+            if position is not None:
+                position += self.prefixed_length
+
+        # Dispatch to the smallest network which fits the live batch
+        model_batch_size = self._network_for_rows(batch_size).batch_size
+        if batch_size < model_batch_size:
+            input_ids = utils.pad(input_ids, 0, model_batch_size)
+            start_ids = utils.pad(start_ids, 0, model_batch_size)
+
+        # Deduplicated prompts do not maintain the token counts of each row
+        context_kwargs = {}
+        if context_length > 1 and self.decoder_lm_head_for_prompt is not None and not self.prefixed_length \
+                and not self.logits_processing:
+            prompt_fanout = self.decoder_lm_head_for_prompt[bucket.find(self.context_buckets, context_length)]
+            prompts = prompt_fanout.unique_prompts(input_ids, start_ids)
+            if prompts is not None:
+                context_kwargs['prompts'] = prompts
+
+        token_ids = self._token_ids(input_ids, cache_ids, start_ids)
+        extras = []
+        if token_ids is not None:
+            context_kwargs['token_ids'] = token_ids
+            extras.append(token_ids)
 
         hidden = self.chkpt_model.model.embed_tokens(input_ids)
         hidden = hidden.transpose(0, -1).contiguous()
 
         if context_length > 1:
-            logits = self.context(hidden, cache_ids, start_ids)
+            logits = self.context(hidden, cache_ids, start_ids, **context_kwargs)
         else:
-            logits = self.decoder_lm_head(hidden, cache_ids, start_ids)
+            logits = self.decoder_lm_head_for_batch[model_batch_size](hidden, cache_ids, start_ids, *extras,
+                                                                      position=position)
 
+        return self.scores(logits, batch_size)
+
+    def forward_async(self, micro_batch, input_ids, cache_ids, start_ids, position=None):
+        """
+        Submit a single token step for one half of the batch without blocking.
+
+        Requires `ping_pong=True`. The returned future resolves to the raw
+        device logits which are converted with `scores`.
+
+        Arguments:
+            micro_batch: The batch half (0 or 1) to execute.
+            input_ids: The next token of each sequence in the half.
+            cache_ids: The single cache id being written.
+            start_ids: The start ids of each sequence in the half.
+            position: The cache id if it is known by the caller.
+
+        Returns:
+            future: A `concurrent.futures.Future` for the logits.
+        """
+        model = self.decoder_lm_head_for_micro_batch[micro_batch]
+        if position is None:
+            position, = cache_ids.tolist()
+        if self.prefixed_length:
+            position += self.prefixed_length
+            cache_ids = cache_ids + self.prefixed_length
+        extras = []
+        if self.logits_processing:
+            extras.append(input_ids.to(torch.int32).transpose(0, 1).contiguous())
+        hidden = self.chkpt_model.model.embed_tokens(input_ids)
+        hidden = hidden.transpose(0, -1).contiguous()
+        return model.forward_async(hidden, cache_ids, start_ids, *extras, position=position)
+
+    @property
+    def device_token_mask(self):
+        return self.logits_processing and self.neuron_config.logits_processors.token_mask
+
+    def set_token_mask(self, constraints):
+        """
+        Apply the allowed tokens of a `constraints.ConstrainedBatch` on device from the next step on.
+
+        This is a no-op unless the model is built with `LogitsProcessorConfig(token_mask=True)`.
+        """
+        if self.device_token_mask:
+            mask = constraints.mask(self.config.vocab_size)
+            self.decoder_lm_head.set_token_mask(constraints_module.pack_token_mask(mask))
+
+    def scores(self, logits, batch_size):
+        """
+        Get the scores of the last token of the first `batch_size` rows.
+
+        Returns:
+            scores: The [batch_size, vocab_size] scores, or with
+                `LogitsConfig.top_k` the tuple of the [batch_size, k]
+                candidate scores and their token ids.
+        """
+        if isinstance(logits, tuple):
+            values, indices = logits
+            values = values[:, -1, :batch_size].to(torch.float32).transpose(0, 1)
+            return values, indices[:, -1, :batch_size].transpose(0, 1)
         logits = logits.to(torch.float32)
-        logits = logits[:self.config.vocab_size, -1, :]
+        logits = logits[:self.config.vocab_size, -1, :batch_size]
         logits = logits.transpose(0, 1)
         return logits
 
     def sample(self, input_ids, sequence_length, start_ids=None,
-               top_k=50, top_p=1.0, eos_token_override=None, temperature=1.0, streamer=None):
+               top_k=50, top_p=1.0, eos_token_override=None, temperature=1.0, streamer=None,
+               num_return_sequences=1, seed=None, max_new_tokens=None,
+               repetition_penalty=1.0, presence_penalty=0.0, frequency_penalty=0.0, logit_bias=None,
+               constraints=None, stopping=None):
+        """
+        Sample `sequence_length` tokens (including the prompt).
+
+        The `top_k`, `top_p`, `temperature`, `eos_token_override`, `seed`,
+        `max_new_tokens` and penalty arguments accept either a single value or
+        one value per row, where rows are counted after `num_return_sequences`
+        expansion. The `logit_bias` is a {token_id: bias} dict or one dict per
+        row.
+
+        Penalties and logit bias are applied on device and require
+        `NeuronConfig(logits_processors=LogitsProcessorConfig(...))`. Token
+        counts include the prompt tokens.
+
+        The `constraints` (a `constraints.ConstrainedBatch`) restrict the
+        tokens of each row. The mask is applied to the host scores and, with
+        `LogitsProcessorConfig(token_mask=True)`, on device before any logits
+        compaction. Constraints are not supported when the full batch runs the
+        ping-pong loop (`ping_pong=True`).
+
+        With `stopping` (a `stopping.StopSequences`) a row finishes as soon as
+        it generates one of its stop sequences.
+        """
+        if not self.logits_processing and (repetition_penalty != 1.0 or presence_penalty != 0.0
+                                           or frequency_penalty != 0.0 or logit_bias is not None):
+            raise ValueError('Penalties and logit_bias require NeuronConfig.logits_processors to be set')
+
+        # Identical prompts are encoded once when the model is built with `prompt_batch_size`
+        if num_return_sequences > 1:
+            input_ids = input_ids.repeat_interleave(num_return_sequences, dim=0)
+            if start_ids is not None:
+                start_ids = start_ids.repeat_interleave(num_return_sequences, dim=0)
+
+        # Every batch size shares the logits processor state of the full batch
+        decoder_lm_head = self._network_for_rows(input_ids.shape[0])
+        if self.logits_processing:
+            decoder_lm_head.set_logits_processors(repetition_penalty, presence_penalty, frequency_penalty,
+                                                  logit_bias)
 
         # To enable optimized context encoding network, we must pad
         # up to the context length estimate or we will not correctly
@@ -229,16 +448,118 @@ class LlamaForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronMode
                 # Sequence length cannot be greater than n_positions
                 sequence_length = min(sequence_length, self.max_positions)
 
-        result = sampling.sample_llama(
+        kwargs = {}
+        sample_fn = sampling.sample_llama
+        if self.ping_pong and batch_size == self.config.batch_size:
+            if constraints is not None:
+                raise ValueError('constraints are not supported by the ping_pong sampling loop; '
+                                 'sample fewer than batch_size rows or build the model with ping_pong=False')
+            sample_fn = sampling.sample_llama_ping_pong
+        elif constraints is not None:
+            kwargs['constraints'] = constraints
+
+        # Every network reads the token mask of the shared logits processor state
+        if self.device_token_mask:
+            self.decoder_lm_head.set_token_mask(None)
+        result = sample_fn(
             self, input_ids, start_ids, sequence_length,
             eos_token_id=self.config.eos_token_id if eos_token_override is None else eos_token_override,
-            top_k=top_k, top_p=top_p, temperature=temperature, streamer=streamer
+            top_k=top_k, top_p=top_p, temperature=temperature, streamer=streamer,
+            seed=seed, max_new_tokens=max_new_tokens, stopping=stopping, **kwargs
         )
 
+        if self.device_token_mask and constraints is not None:
+            self.decoder_lm_head.set_token_mask(None)
+
         if offset != 0:
             result = result[:, offset:]
         return result
 
+    def beam_search(self, input_ids, num_beams, sequence_length, start_ids=None, eos_token_override=None,
+                    length_penalty=1.0, early_stopping=False):
+        """
+        Beam search where the beam step runs on device.
+
+        The model must be constructed with `num_beams` and a `batch_size` of
+        `input_ids.shape[0] * num_beams`. Each step only transfers the best
+        candidates of each batch line to the host.
+
+        A candidate ending with the eos token finishes a hypothesis, which is
+        ranked by its score divided by the number of generated tokens to the
+        power `length_penalty` (see `sampling.BeamHypotheses`). A batch line is
+        done once no running beam can improve its `num_beams` best hypotheses
+        (or as soon as it has them, with `early_stopping`), and generation
+        stops when every batch line is done.
+
+        Returns:
+            tokens: The best hypotheses of every batch line, best first, of
+                shape [batch_size, num_beams, sequence_length] and padded with
+                the eos token.
+        """
+        if num_beams != self.num_beams:
+            raise ValueError(f'num_beams={num_beams} does not match the compiled num_beams={self.num_beams}')
+        batch_size, start = input_ids.shape
+        bn = batch_size * num_beams
+        if bn != self.config.batch_size:
+            raise ValueError(f'batch_size={batch_size} with num_beams={num_beams} does not match the '
+                             f'compiled batch_size={self.config.batch_size}')
+        b_n_input_ids = input_ids.unsqueeze(1).repeat(1, num_beams, 1)
+        bn_input_ids = b_n_input_ids.reshape([bn, start])
+        if start_ids is None:
+            start_ids = torch.zeros(batch_size, dtype=torch.int32)
+        start_ids = start_ids.unsqueeze(1).repeat(1, num_beams).reshape([bn])
+
+        eos_token_id = self.config.eos_token_id if eos_token_override is None else eos_token_override
+        hypotheses = [sampling.BeamHypotheses(num_beams, start, length_penalty, early_stopping)
+                      for _ in range(batch_size)]
+
+        def advance(tokens, scores, candidate_tokens, beams):
+            beam_scores, inputs, beams = sampling.select_beams(
+                hypotheses, tokens, scores, candidate_tokens, beams, eos_token_id)
+            tokens = tokens.gather(1, beams.unsqueeze(-1).expand(-1, -1, tokens.shape[-1]))
+            tokens = torch.cat([tokens, inputs.unsqueeze(-1)], dim=-1)
+            return tokens, beam_scores, inputs, beams
+
+        # All beams are identical after the prompt so the first candidates come from a single beam
+        cache_ids = torch.arange(start, dtype=torch.int32)
+        next_token_scores = self(bn_input_ids, cache_ids, start_ids)
+        k = 2 * num_beams
+        if isinstance(next_token_scores, tuple):
+            # Normalizing over the candidates only offsets every beam of a batch line equally
+            values, candidates = next_token_scores
+            values = torch.log_softmax(values[::num_beams], dim=-1)
+            scores, candidate_tokens = torch.topk(values, min(k, values.shape[-1]))  # [b, 2n]
+            candidate_tokens = candidates[::num_beams].gather(1, candidate_tokens)
+        else:
+            next_token_scores = torch.log_softmax(next_token_scores[::num_beams], dim=-1)
+            scores, candidate_tokens = torch.topk(next_token_scores, k)  # [b, 2n]
+        tokens, beam_scores, inputs, beams = advance(
+            b_n_input_ids, scores, candidate_tokens, torch.zeros_like(candidate_tokens))
+        reorder_ids = torch.arange(bn, dtype=torch.int64)
+        row_offsets = torch.arange(0, bn, num_beams).unsqueeze(1)
+
+        for cur_len in range(start, sequence_length - 1):
+            if all(hypothesis.done for hypothesis in hypotheses):
+                break
+            position = cur_len + self.prefixed_length
+            cache_ids = torch.as_tensor([position], dtype=torch.int32)
+            hidden = self.chkpt_model.model.embed_tokens(inputs.reshape([bn, 1]))
+            hidden = hidden.transpose(0, -1).contiguous()
+            extras = []
+            if self.logits_processing:
+                extras.append(inputs.reshape([1, bn]).to(torch.int32))
+            candidates = self.decoder_lm_head_for_beam(
+                hidden, cache_ids, start_ids, beam_scores.reshape([bn]), reorder_ids, *extras, position=position)
+            scores, candidate_tokens, beams = candidates.split(k, dim=1)
+
+            # Continue with the best candidates which did not finish
+            tokens, beam_scores, inputs, beams = advance(
+                tokens, scores, candidate_tokens.to(torch.int64), beams.to(torch.int64))
+            reorder_ids = (row_offsets + beams).reshape([bn])
+
+        return sampling.finalize_beams(hypotheses, tokens, beam_scores, sequence_length, eos_token_id)
+
+
 class FIDLlamaForSampling(LlamaForSampling):
 
     def __init__(self, config, *, n_positions=2048, batch_size=1, amp='f32', tp_degree=2,
@@ -251,9 +572,18 @@ class FIDLlamaForSampling(LlamaForSampling):
                         **kwargs)
         self.batch_size = batch_size
         self.bos_token_id = self.config.bos_token_id
-
-    def context(self, hidden, cache_ids, start_ids):
+        # The fused contexts are encoded one after another into a single row
+        if self.prompt_batch_size is not None:
+            raise NotImplementedError('FIDLlamaForSampling does not support prompt_batch_size')
+        if self.logits_processing:
+            raise NotImplementedError('FIDLlamaForSampling does not support NeuronConfig.logits_processors')
+        # The context logits are replaced with dense logits which select the bos token
+        self.decoder_lm_head.return_candidates = False
+
+    def context(self, hidden, cache_ids, start_ids, prompts=None, token_ids=None):
         # Fusion-In-Decoder context encoding
+        if prompts is not None or token_ids is not None:
+            raise NotImplementedError('FIDLlamaForSampling does not support prompt deduplication or logits processors')
         fused_context_length = hidden.shape[1]
         context_length = fused_context_length // self.batch_size
 
@@ -281,7 +611,7 @@ class FIDLlamaForSampling(LlamaForSampling):
                 current = estimate
 
             if current == estimate:
-                model = self.decoder_lm_head_for_context[estimate]
+                model = self.decoder_lm_head_for_context[estimate, 1]
 
                 # Run each context separately in-place
                 for j in range(self.batch_size):
@@ -292,7 +622,7 @@ class FIDLlamaForSampling(LlamaForSampling):
         for i in range(current, context_length):
             cache_ids = torch.as_tensor([i], dtype=torch.int32)
             hidden_slice = hidden[:, i:i+1].contiguous()
-            logits = self.decoder_lm_head(hidden_slice, cache_ids, start_ids)
+            logits = self.decoder_lm_head(hidden_slice, cache_ids, start_ids, position=i)
 
         logits[:] = float('-inf')
         logits[self.bos_token_id] = 1.0
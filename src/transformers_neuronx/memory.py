@@ -0,0 +1,637 @@
+# Copyright Amazon Web Services and its Affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Device memory accounting.
+
+Estimates the bytes held by each NeuronCore for a decoder model from its
+shapes alone, following the padding, quantization and sharding applied by
+`DecoderLmHeadForSamplingNoEmbedding.to_neuron` and `DecoderLayer.to_neuron`.
+This allows a (model, tp_degree, batch_size, n_positions, amp, quant)
+combination to be checked before a long compilation and the largest batch
+size or smallest tensor parallel degree which fits to be planned.
+"""
+import math
+import os
+import torch
+from transformers_neuronx import bucket
+from transformers_neuronx import dtypes
+from transformers_neuronx import utils
+from transformers_neuronx.config import U8EncodingConfig
+
+
+# The device memory of a single NeuronCore (trn1 and inf2)
+CORE_BYTES = 16 * 2 ** 30
+
+
+def dtype_bytes(dtype):
+    """
+    The number of bytes per element of a dtype name (e.g. 'bf16') or torch dtype.
+    """
+    if isinstance(dtype, str):
+        dtype = dtypes.to_torch_dtype(dtype)
+    return torch.empty((), dtype=dtype).element_size()
+
+
+class DecoderShapes:
+    """
+    The shapes of a decoder model which determine its device memory.
+
+    Arguments:
+        hidden_size: The model hidden size.
+        num_layers: The number of decoder layers.
+        num_heads: The number of attention heads.
+        intermediate_size: The MLP intermediate size.
+        vocab_size: The vocabulary size of the language model head.
+        num_kv_heads: The number of key/value heads (defaults to `num_heads`).
+        gated_mlp: Whether the MLP has gate, up and down projections without
+            biases (added as padded and quantizable extra layer parameters).
+        bias: Whether attention, MLP and layer norms have biases.
+        allow_pad: Whether attention heads are padded to a multiple of the
+            tensor parallel degree (the `allow_pad` of the decoder).
+        num_pre_layer_heads: The number of heads of an f32 pre-layer parameter
+            sharded across cores (e.g. the BLOOM ALiBi slopes).
+    """
+
+    def __init__(self, hidden_size, num_layers, num_heads, intermediate_size, vocab_size,
+                 num_kv_heads=None, gated_mlp=False, bias=True, allow_pad=False, num_pre_layer_heads=0):
+        if num_kv_heads is None:
+            num_kv_heads = num_heads
+        if hidden_size % num_heads:
+            raise ValueError(f'hidden_size={hidden_size} is not divisible by num_heads={num_heads}')
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.num_heads = num_heads
+        self.num_kv_heads = num_kv_heads
+        self.attention_head_size = hidden_size // num_heads
+        self.intermediate_size = intermediate_size
+        self.vocab_size = vocab_size
+        self.gated_mlp = gated_mlp
+        self.bias = bias
+        self.allow_pad = allow_pad
+        self.num_pre_layer_heads = num_pre_layer_heads
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build the shapes of a HuggingFace LLaMA, OPT, BLOOM or GPT2 config.
+        """
+        model_type = getattr(config, 'model_type', None)
+        if model_type == 'llama':
+            return cls(config.hidden_size, config.num_hidden_layers, config.num_attention_heads,
+                       config.intermediate_size, config.vocab_size, gated_mlp=True, bias=False, allow_pad=True)
+        if model_type == 'opt':
+            return cls(config.hidden_size, config.num_hidden_layers, config.num_attention_heads,
+                       config.ffn_dim, config.vocab_size)
+        if model_type == 'bloom':
+            return cls(config.hidden_size, config.num_hidden_layers, config.n_head,
+                       4 * config.hidden_size, config.vocab_size, allow_pad=True,
+                       num_pre_layer_heads=config.n_head)
+        if model_type == 'gpt2':
+            num_kv_heads = 1 if getattr(config, 'multi_query', False) else None
+            return cls(config.n_embd, config.n_layer, config.n_head, 4 * config.n_embd, config.vocab_size,
+                       num_kv_heads=num_kv_heads)
+        raise NotImplementedError(f'Memory accounting of {model_type} is not implemented. '
+                                  f'Available options are llama,opt,bloom,gpt2')
+
+    def supports(self, tp_degree):
+        """
+        Whether the weights can be sharded across `tp_degree` cores.
+        """
+        if not self.allow_pad:
+            if self.num_heads % tp_degree or self.num_kv_heads % tp_degree:
+                return False
+            if not self.gated_mlp and self.intermediate_size % tp_degree:
+                return False
+        return True
+
+
+class MemoryUsage:
+    """
+    The bytes held by a single NeuronCore.
+
+    Arguments:
+        weights: Sharded and duplicated weights, scales and u8 ranges.
+        caches: The KV caches of every layer (and the cache swap staging rows).
+        io: The input and logits buffers of every network.
+        scratch: An estimate of the largest intermediate activations.
+        states: The logits processor state buffers.
+    """
+
+    def __init__(self, weights=0, caches=0, io=0, scratch=0, states=0):
+        self.weights = weights
+        self.caches = caches
+        self.io = io
+        self.scratch = scratch
+        self.states = states
+
+    @property
+    def total(self):
+        return self.weights + self.caches + self.io + self.scratch + self.states
+
+    def fits(self, core_bytes=CORE_BYTES):
+        return self.total <= core_bytes
+
+    def __repr__(self):
+        gib = 2 ** 30
+        return (f'MemoryUsage(weights={self.weights / gib:.3f}GiB, caches={self.caches / gib:.3f}GiB, '
+                f'io={self.io / gib:.3f}GiB, scratch={self.scratch / gib:.3f}GiB, '
+                f'states={self.states / gib:.3f}GiB, '
+                f'total={self.total / gib:.3f}GiB)')
+
+
+class _WeightAccountant:
+    """
+    Accumulates the per-core bytes of weights with the storage format chosen by `to_neuron`.
+    """
+
+    def __init__(self, tp_degree, amp, neuron_config):
+        self.tp_degree = tp_degree
+        self.amp = amp
+        compute_dtype, _, _ = utils.parse_amp(amp)
+        self.element_bytes = dtype_bytes(compute_dtype)
+        self.quant = neuron_config.quant if neuron_config else None
+        self.u8_encoding = None
+        if utils.amp_is_u8(amp):
+            self.u8_encoding = U8EncodingConfig()
+            if neuron_config and neuron_config.u8_encoding:
+                self.u8_encoding = neuron_config.u8_encoding
+        self.total = 0
+
+    def _sharded(self, nbytes, sharded):
+        return nbytes // self.tp_degree if sharded else nbytes
+
+    def vector(self, size, sharded=False, element_bytes=None):
+        if element_bytes is None:
+            element_bytes = self.element_bytes
+        self.total += self._sharded(size * element_bytes, sharded)
+
+    def matrix(self, in_features, out_features, sharding, quantize=False, u8=False):
+        """
+        Account for a weight sharded along its input (`sharding=0`) or output
+        (`sharding=1`) features, or duplicated when `sharding` is None.
+        """
+        sharded = sharding is not None
+        numel = in_features * out_features
+        out_sharded = sharding == 1
+        if quantize and self.quant is not None:
+            if self.quant.group_wise:
+                bits = 4 if self.quant.quant_dtype == 's4' else 8
+                self.total += self._sharded(numel * bits // 8, sharded)
+                n_groups = in_features // self.quant.group_size
+                self.total += self._sharded(n_groups * out_features * 2 * 4, sharded)
+            else:
+                self.total += self._sharded(numel, sharded)
+                self.total += self._sharded(out_features * 4, out_sharded)
+            return
+        if u8 and self.u8_encoding is not None:
+            self.total += self._sharded(numel, sharded)
+            group_wise = self.u8_encoding.granularity == 'group'
+            n_groups = in_features // self.u8_encoding.group_size if group_wise else 1
+            self.total += self._sharded(n_groups * out_features * 2 * 4, out_sharded or (sharded and group_wise))
+            return
+        self.total += self._sharded(numel * self.element_bytes, sharded)
+
+
+def _pad_divisor(tp_degree, amp, neuron_config):
+    # Mirrors `DecoderLayer._pad_divisor`
+    quant = neuron_config.quant if neuron_config else None
+    if quant and quant.group_wise:
+        return tp_degree * quant.group_size
+    if utils.amp_is_u8(amp):
+        u8_encoding = neuron_config.u8_encoding if neuron_config and neuron_config.u8_encoding else U8EncodingConfig()
+        if u8_encoding.granularity == 'group':
+            return tp_degree * u8_encoding.group_size
+    return tp_degree
+
+
+def _attention_sizes(shapes, tp_degree):
+    """
+    Returns:
+        q_size: The (padded) query output features.
+        kv_size: The (padded) key and value output features.
+    """
+    n_heads = shapes.num_heads
+    if shapes.allow_pad:
+        n_heads = utils.round_up_to_divisor(n_heads, tp_degree)
+    q_size = n_heads * shapes.attention_head_size
+    kv_size = q_size * shapes.num_kv_heads // shapes.num_heads
+    return q_size, kv_size
+
+
+def _intermediate_size(shapes, tp_degree, amp, neuron_config):
+    if shapes.allow_pad or shapes.gated_mlp:
+        return utils.round_up_to_divisor(shapes.intermediate_size, _pad_divisor(tp_degree, amp, neuron_config))
+    return shapes.intermediate_size
+
+
+def _padded_vocab_size(shapes, tp_degree):
+    divisor = int(os.environ.get('NEURON_VOCAB_PAD_DIVISOR', str(tp_degree)))
+    return shapes.vocab_size + utils.pad_vocab_size(shapes.vocab_size, divisor)
+
+
+def weight_bytes(shapes, tp_degree, amp='f32', neuron_config=None, num_layers=None):
+    """
+    Compute the per-core bytes of the layer, final layer norm and lm_head weights.
+
+    The embedding is excluded since it is evaluated on CPU for every family.
+
+    Arguments:
+        shapes: The `DecoderShapes` of the model.
+        tp_degree: The tensor parallel degree.
+        amp: The amp dtype (e.g. 'bf16' or 'f16-u8-f32').
+        neuron_config: The `NeuronConfig` which may enable quantization.
+        num_layers: The number of layers whose weights are resident on device
+            (defaults to every layer, see `WeightStreamingConfig`).
+
+    Returns:
+        nbytes: The bytes held by each NeuronCore.
+    """
+    hidden = shapes.hidden_size
+    q_size, kv_size = _attention_sizes(shapes, tp_degree)
+    intermediate = _intermediate_size(shapes, tp_degree, amp, neuron_config)
+    quant = neuron_config.quant if neuron_config else None
+    quantize_attn = quant is not None and quant.quantize_attn
+
+    layer = _WeightAccountant(tp_degree, amp, neuron_config)
+    norms = 2 if shapes.bias else 1
+    layer.vector(hidden * norms)  # pre-attention layer norm
+    layer.vector(hidden * norms)  # pre-mlp layer norm
+    layer.matrix(hidden, q_size, 1, quantize=quantize_attn, u8=True)
+    layer.matrix(hidden, kv_size, 1, quantize=quantize_attn, u8=True)
+    layer.matrix(hidden, kv_size, 1, quantize=quantize_attn, u8=True)
+    layer.matrix(q_size, hidden, 0, quantize=quantize_attn, u8=True)
+    if shapes.bias:
+        layer.vector(q_size + 2 * kv_size, sharded=True)
+        layer.vector(hidden)
+    if shapes.gated_mlp:
+        layer.matrix(hidden, intermediate, 1, quantize=True)
+        layer.matrix(hidden, intermediate, 1, quantize=True)
+        layer.matrix(intermediate, hidden, 0, quantize=True)
+    else:
+        layer.matrix(hidden, intermediate, 1, quantize=True, u8=True)
+        layer.matrix(intermediate, hidden, 0, quantize=True, u8=True)
+        if shapes.bias:
+            layer.vector(intermediate, sharded=True)
+            layer.vector(hidden)
+
+    head = _WeightAccountant(tp_degree, amp, neuron_config)
+    head.vector(hidden * norms)
+    if shapes.num_pre_layer_heads:
+        head.vector(utils.round_up_to_divisor(shapes.num_pre_layer_heads, tp_degree), sharded=True,
+                    element_bytes=4)
+    quantize_lm_head = quant is not None and quant.quantize_lm_head
+    head.matrix(hidden, _padded_vocab_size(shapes, tp_degree), 1, quantize=quantize_lm_head)
+    if num_layers is None:
+        num_layers = shapes.num_layers
+    return layer.total * num_layers + head.total
+
+
+def cache_shape(shapes, tp_degree, batch_size, n_positions):
+    """
+    Compute the per-core shape of one KV cache (the `cache_shape` of `DecoderLayer.init_caches`).
+
+    Returns:
+        shape: The [n_positions, batch_size, n_heads_tp, d_head] cache shape.
+    """
+    q_size, kv_size = _attention_sizes(shapes, tp_degree)
+    n_heads = q_size // shapes.attention_head_size
+    n_heads_kv_cache = n_heads * kv_size // q_size
+    return [n_positions, batch_size, n_heads_kv_cache // tp_degree, shapes.attention_head_size]
+
+
+def cache_bytes(shapes, tp_degree, batch_size, n_positions, amp='f32'):
+    """
+    Compute the per-core bytes of the KV caches allocated by `DecoderLayer.init_caches`.
+
+    Arguments:
+        shapes: The `DecoderShapes` of the model.
+        tp_degree: The tensor parallel degree.
+        batch_size: The batch size of the caches.
+        n_positions: The largest token generation bucket.
+        amp: The amp dtype.
+
+    Returns:
+        nbytes: The bytes held by each NeuronCore.
+    """
+    compute_dtype, _, _ = utils.parse_amp(amp)
+    cache = 1
+    for size in cache_shape(shapes, tp_degree, batch_size, n_positions):
+        cache *= size
+    return 2 * shapes.num_layers * cache * dtype_bytes(compute_dtype)
+
+
+def logits_processor_shapes(shapes, tp_degree, batch_size, logits_processors):
+    """
+    Compute the per-core buffer shapes of a `decoder.LogitsProcessorState`.
+
+    Arguments:
+        shapes: The `DecoderShapes` of the model.
+        tp_degree: The tensor parallel degree.
+        batch_size: The number of rows of the state.
+        logits_processors: The `LogitsProcessorConfig`.
+
+    Returns:
+        buffers: A dict from buffer name to its (shape, dtype).
+    """
+    vocab_size = _padded_vocab_size(shapes, tp_degree)
+    buffers = {
+        'vocab_ids': ([vocab_size // tp_degree], torch.int32),
+        'token_counts': ([vocab_size // tp_degree, batch_size], torch.float32),
+        'penalties': ([3, batch_size], torch.float32),
+    }
+    if logits_processors.max_logit_bias:
+        buffers['bias_ids'] = ([logits_processors.max_logit_bias, batch_size], torch.int32)
+        buffers['bias_values'] = ([logits_processors.max_logit_bias, batch_size], torch.float32)
+    if logits_processors.token_mask:
+        buffers['token_mask'] = ([(vocab_size + 31) // 32, batch_size], torch.int32)
+    return buffers
+
+
+def logits_processor_bytes(shapes, tp_degree, batch_size, logits_processors, rows_only=False):
+    """
+    Compute the per-core bytes of a `decoder.LogitsProcessorState`.
+
+    With `rows_only`, the vocabulary ids (which do not hold a value per row)
+    are left out, as in the single row staging buffers of a `CacheSwapper`.
+
+    Returns:
+        nbytes: The bytes held by each NeuronCore.
+    """
+    nbytes = 0
+    for name, (shape, dtype) in logits_processor_shapes(shapes, tp_degree, batch_size, logits_processors).items():
+        if rows_only and name == 'vocab_ids':
+            continue
+        numel = 1
+        for size in shape:
+            numel *= size
+        nbytes += numel * dtype_bytes(dtype)
+    return nbytes
+
+
+def check_shapes(network, shapes):
+    """
+    Check the buffers of a built `DecoderLmHeadForSamplingNoEmbedding` against the shapes planned here.
+
+    This compares the cache shape of every layer and the logits processor
+    state buffers, so that a change to `init_caches` or `to_neuron` which is
+    not mirrored by the estimates fails loudly instead of silently skewing
+    `estimate`.
+
+    Arguments:
+        network: A network after `to_neuron`.
+        shapes: The `DecoderShapes` of the model.
+
+    Raises:
+        ValueError: When an actual shape differs from the planned one.
+    """
+    *_, n_positions = network.n_positions_list
+    expected_cache = cache_shape(shapes, network.tp_degree, network.batch_size, n_positions)
+    checks = [(f'layers[{index}].cache_shape', expected_cache, layer.cache_shape)
+              for index, layer in enumerate(network.layers)]
+    state = network.logits_processors
+    if state is not None:
+        config = network.neuron_config.logits_processors
+        expected = logits_processor_shapes(shapes, network.tp_degree, state.batch_size, config)
+        for name, (shape, _) in expected.items():
+            buffer = getattr(state, name)
+            checks.append((f'logits_processors.{name}', shape, None if buffer is None else list(buffer.shape)))
+    mismatches = [f'{name}: expected {expected} but got {actual}'
+                  for name, expected, actual in checks if list(expected) != list(actual or [])]
+    if mismatches:
+        raise ValueError('Memory planning does not match the built network: ' + '; '.join(mismatches))
+
+
+def io_bytes(shapes, tp_degree, batch_size, n_active_tokens, amp='f32'):
+    """
+    Compute the per-core bytes of the input and logits buffers of one network.
+
+    Every core holds a copy of the hidden state, cache ids and start ids
+    inputs and of the gathered logits of the last token.
+
+    Returns:
+        nbytes: The bytes held by each NeuronCore.
+    """
+    compute_dtype, _, _ = utils.parse_amp(amp)
+    element_bytes = dtype_bytes(compute_dtype)
+    hidden = shapes.hidden_size * n_active_tokens * batch_size * element_bytes
+    ids = (n_active_tokens + batch_size) * 4
+    logits = _padded_vocab_size(shapes, tp_degree) * batch_size * element_bytes
+    return hidden + ids + logits
+
+
+def scratch_bytes(shapes, tp_degree, batch_size, n_active_tokens, n_positions, amp='f32', neuron_config=None):
+    """
+    Estimate the per-core bytes of the largest intermediate activations of one layer.
+
+    This counts the f32 attention scores and their probabilities, the query,
+    key and value projections, the MLP intermediate activations, two f32
+    copies of the residual hidden state and, for quantized or u8 weights, the
+    largest weight shard dequantized to the compute dtype. The compiler may
+    fuse or tile these so the estimate is an upper bound rather than exact.
+
+    Returns:
+        nbytes: The estimated bytes of each NeuronCore.
+    """
+    compute_dtype, _, _ = utils.parse_amp(amp)
+    element_bytes = dtype_bytes(compute_dtype)
+    q_size, kv_size = _attention_sizes(shapes, tp_degree)
+    n_heads_tp = q_size // shapes.attention_head_size // tp_degree
+    intermediate = _intermediate_size(shapes, tp_degree, amp, neuron_config)
+    tokens = n_active_tokens * batch_size
+    scores = batch_size * n_heads_tp * n_active_tokens * n_positions * (4 + element_bytes)
+    qkv = tokens * (q_size + 2 * kv_size) // tp_degree * element_bytes
+    n_mlp = 2 if shapes.gated_mlp else 1
+    mlp = tokens * n_mlp * intermediate // tp_degree * element_bytes
+    residual = 2 * tokens * shapes.hidden_size * 4
+    dequantized = 0
+    quant = neuron_config.quant if neuron_config else None
+    if quant is not None or utils.amp_is_u8(amp):
+        dequantized = shapes.hidden_size * max(q_size, intermediate) // tp_degree * element_bytes
+    return scores + qkv + mlp + residual + dequantized
+
+
+def lm_head_scratch_bytes(shapes, tp_degree, amp='f32', neuron_config=None):
+    """
+    Estimate the per-core bytes of the quantized lm_head weight converted in graph.
+
+    Per-vocab (vector_dynamic) weights are converted to the compute dtype and
+    the logits are rescaled. Group-wise weights are dequantized through f32
+    before the conversion.
+
+    Returns:
+        nbytes: The estimated bytes of each NeuronCore.
+    """
+    quant = neuron_config.quant if neuron_config else None
+    if quant is None or not quant.quantize_lm_head:
+        return 0
+    compute_dtype, _, _ = utils.parse_amp(amp)
+    element_bytes = dtype_bytes(compute_dtype)
+    if quant.group_wise:
+        element_bytes += 4
+    return shapes.hidden_size * _padded_vocab_size(shapes, tp_degree) // tp_degree * element_bytes
+
+
+def estimate(shapes, tp_degree, batch_size, n_positions, amp='f32', neuron_config=None,
+             context_length_estimate=None, unroll=None, ping_pong=False, num_beams=None,
+             prompt_batch_size=None, cache_swapper=False):
+    """
+    Estimate the per-core device memory of a model built as `<Family>ForSampling` does.
+
+    Weights are shared by every network. With `NeuronConfig.weight_streaming`
+    only `window` groups of `unroll` layers are resident. Every network
+    shares the KV caches of the largest batch size except the prompt
+    networks, which own caches of the context bucket length. Each token
+    generation batch size and each (context bucket, batch size) pair adds a
+    network with its own IO buffers, as do the beam search network and the
+    two ping-pong micro-batch networks. The scratch estimate is the largest
+    of any network's largest bucket, including the rows a smaller batch
+    slices out of one layer's shared caches, plus the lm_head converted in
+    graph when it is quantized. With `NeuronConfig.logits_processors`, the
+    networks sharing the caches also share one logits processor state of
+    the largest batch size, while each prompt network owns one. A cache
+    swapper adds single row staging buffers for every cache and state.
+
+    Arguments:
+        shapes: The `DecoderShapes` of the model.
+        tp_degree: The tensor parallel degree.
+        batch_size: The batch size or list of batch sizes.
+        n_positions: The token generation buckets or maximum sequence length.
+        amp: The amp dtype.
+        neuron_config: The `NeuronConfig` which may enable quantization or weight streaming.
+        context_length_estimate: The context encoding buckets (see `bucket.context_sizes`).
+        unroll: The number of layers per token generation network group.
+        ping_pong: Whether each half of the largest batch has its own network.
+        num_beams: The number of beams of the on-device beam search network.
+        prompt_batch_size: The maximum number of unique prompts (or a list of batch sizes).
+        cache_swapper: Whether a `CacheSwapper` is built (see `build_cache_swapper`).
+
+    Returns:
+        usage: The `MemoryUsage` of each NeuronCore.
+    """
+    if not shapes.supports(tp_degree):
+        raise ValueError(f'tp_degree={tp_degree} does not divide num_heads={shapes.num_heads}, '
+                         f'num_kv_heads={shapes.num_kv_heads} or intermediate_size={shapes.intermediate_size}')
+    batch_sizes = bucket.batch_sizes(batch_size)
+    *_, full_batch_size = batch_sizes
+    token_buckets = bucket.token_sizes(n_positions)
+    context_buckets = bucket.context_sizes(context_length_estimate, token_buckets)
+    *_, max_positions = token_buckets
+    num_layers = None
+    weight_streaming = neuron_config.weight_streaming if neuron_config else None
+    if weight_streaming is not None:
+        if unroll is None:
+            unroll = shapes.num_layers
+        num_layers = min(shapes.num_layers, weight_streaming.window * unroll)
+    usage = MemoryUsage(weights=weight_bytes(shapes, tp_degree, amp, neuron_config, num_layers))
+
+    def add_network(size, n_active_tokens, n_positions, shared=True):
+        usage.io += io_bytes(shapes, tp_degree, size, n_active_tokens, amp)
+        scratch = scratch_bytes(shapes, tp_degree, size, n_active_tokens, n_positions, amp, neuron_config)
+        if shared and size < full_batch_size:
+            scratch += cache_bytes(shapes, tp_degree, size, n_positions, amp) // shapes.num_layers
+        usage.scratch = max(usage.scratch, scratch)
+
+    logits_processors = neuron_config.logits_processors if neuron_config else None
+
+    def add_state(size, rows_only=False):
+        if logits_processors is not None:
+            usage.states += logits_processor_bytes(shapes, tp_degree, size, logits_processors, rows_only)
+
+    usage.caches += cache_bytes(shapes, tp_degree, full_batch_size, max_positions, amp)
+    add_state(full_batch_size)
+    if cache_swapper:
+        usage.caches += cache_bytes(shapes, tp_degree, 1, max_positions, amp)
+        add_state(1, rows_only=True)
+    for size in batch_sizes:
+        add_network(size, 1, max_positions)
+        for context_bucket in context_buckets:
+            add_network(size, context_bucket, context_bucket)
+    if ping_pong:
+        for _ in range(2):
+            add_network(full_batch_size // 2, 1, max_positions)
+    if num_beams is not None:
+        # The beam network shares the caches of the full batch and returns fewer values than logits
+        add_network(full_batch_size, 1, max_positions)
+    if prompt_batch_size is not None:
+        for size in bucket.batch_sizes(prompt_batch_size):
+            if size >= full_batch_size:
+                continue
+            for context_bucket in context_buckets:
+                usage.caches += cache_bytes(shapes, tp_degree, size, context_bucket, amp)
+                add_state(size)
+                add_network(size, context_bucket, context_bucket, shared=False)
+    usage.scratch += lm_head_scratch_bytes(shapes, tp_degree, amp, neuron_config)
+    return usage
+
+
+def max_batch_size(shapes, tp_degree, n_positions, amp='f32', neuron_config=None,
+                   context_length_estimate=None, core_bytes=CORE_BYTES, **kwargs):
+    """
+    Find the largest batch size which fits in `core_bytes` per NeuronCore.
+
+    The `kwargs` are the network options of `estimate` (e.g. `unroll`). Only
+    batch sizes which the model accepts are returned: multiples of two with
+    `ping_pong` and multiples of `num_beams` with beam search.
+
+    Returns:
+        batch_size: The largest batch size, or 0 when not even the smallest one fits.
+    """
+    unit = 1
+    if kwargs.get('ping_pong'):
+        unit = 2
+    num_beams = kwargs.get('num_beams')
+    if num_beams is not None:
+        unit = unit * num_beams // math.gcd(unit, num_beams)
+
+    def fits(units):
+        usage = estimate(shapes, tp_degree, units * unit, n_positions, amp, neuron_config,
+                         context_length_estimate, **kwargs)
+        return usage.fits(core_bytes)
+
+    if not fits(1):
+        return 0
+    # Memory grows monotonically with the batch size
+    low, high = 1, 2
+    while fits(high):
+        low, high = high, high * 2
+    while high - low > 1:
+        middle = (low + high) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle
+    return low * unit
+
+
+def min_tp_degree(shapes, batch_size, n_positions, amp='f32', neuron_config=None,
+                  context_length_estimate=None, core_bytes=CORE_BYTES, tp_degrees=(1, 2, 4, 8, 16, 24, 32),
+                  **kwargs):
+    """
+    Find the smallest tensor parallel degree which fits in `core_bytes` per NeuronCore.
+
+    Degrees which cannot shard the model's heads are skipped. The `kwargs`
+    are the network options of `estimate` (e.g. `unroll`).
+
+    Returns:
+        tp_degree: The smallest degree of `tp_degrees`, or None when none fits.
+    """
+    for tp_degree in sorted(tp_degrees):
+        if not shapes.supports(tp_degree):
+            continue
+        usage = estimate(shapes, tp_degree, batch_size, n_positions, amp, neuron_config, context_length_estimate,
+                         **kwargs)
+        if usage.fits(core_bytes):
+            return tp_degree
+    return None
@@ -20,6 +20,7 @@ from transformers_neuronx import dtypes
 from transformers_neuronx import hlo
 from transformers_neuronx import module
 from transformers_neuronx import ops
+from transformers_neuronx import quantize
 from transformers_neuronx import parallel
 from transformers_neuronx import sampling
 from transformers_neuronx import utils
@@ -32,7 +33,8 @@ from transformers_neuronx.layers import attention
 class OPTForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronModelBase):
 
     def __init__(self, config, batch_size=1, amp=None, tp_degree=2, n_positions=2048,
-                 unroll=None, context_length_estimate=None, context_unroll=1, neuron_config=None, **kwargs):
+                 unroll=None, context_length_estimate=None, context_unroll=1, neuron_config=None,
+                 prompt_batch_size=None, **kwargs):
         if amp is None:
             amp = dtypes.to_amp(config.torch_dtype)
         else:
@@ -69,11 +71,16 @@ class OPTForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronModelB
         self.context_length_estimate = context_length_estimate
         self.context_unroll = context_unroll
         self.neuron_config = neuron_config
+        # The maximum number of unique prompts encoded before fanning out the caches
+        self.prompt_batch_size = prompt_batch_size
+        self.prompt_fanout = None
 
     def to_neuron(self):
         ops.init()
         self.chkpt_model.model.decoder.embed_tokens.materialize()
         self.chkpt_model.model.decoder.embed_positions.materialize()
+        quant = self.neuron_config.quant if self.neuron_config else None
+        self.chkpt_model.model.decoder.embed_tokens = quantize.maybe_quantize_embedding(self.chkpt_model.model.decoder.embed_tokens, quant)
         for layer in self.chkpt_model.model.decoder.layers:
             layer.materialize()
             attn = layer.self_attn
@@ -105,6 +112,9 @@ class OPTForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronModelB
                 unroll=self.context_unroll,
                 share_caches=True,
             )
+            if self.prompt_batch_size is not None:
+                self.prompt_fanout = self.decoder_lm_head.build_prompt_fanout(
+                    self.context_length_estimate, self.prompt_batch_size, unroll=self.context_unroll)
 
     def reset(self):
         self.decoder_lm_head.reset()
@@ -113,15 +123,23 @@ class OPTForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronModelB
         return self._forward(self.decoder_lm_head, input_ids, cache_ids, start_ids)
 
     def forward_for_context(self, input_ids, cache_ids, start_ids=None):
-        return self._forward(self.decoder_lm_head_for_context, input_ids, cache_ids, start_ids)
+        return self._forward(self.decoder_lm_head_for_context, input_ids, cache_ids, start_ids,
+                             prompt_fanout=self.prompt_fanout)
 
-    def _forward(self, decoder_lm_head, input_ids, cache_ids, start_ids):
+    def _forward(self, decoder_lm_head, input_ids, cache_ids, start_ids, prompt_fanout=None):
         inputs_embeds = self.chkpt_model.model.decoder.embed_tokens(input_ids)
         position_ids, start_ids = decoder_lm_head.embed_positions_ids(cache_ids, start_ids)
         position_embeds = self.chkpt_model.model.decoder.embed_positions(position_ids)
         hidden = inputs_embeds + position_embeds
         hidden = hidden.transpose(0, 2).contiguous()
-        logits = decoder_lm_head(hidden, cache_ids, start_ids)
+        # Identical prompts are encoded once when the model is built with `prompt_batch_size`
+        prompts = None
+        if prompt_fanout is not None:
+            prompts = prompt_fanout.unique_prompts(input_ids, start_ids)
+        if prompts is not None:
+            logits = prompt_fanout(hidden, cache_ids, start_ids, prompts)
+        else:
+            logits = decoder_lm_head(hidden, cache_ids, start_ids)
         logits = logits.to(torch.float32)
         logits = logits[:self.config.vocab_size, -1, :]
         logits = logits.transpose(0, 1)
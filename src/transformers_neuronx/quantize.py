@@ -12,37 +12,250 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 from transformers_neuronx.config import QuantizationConfig
 
-def maybe_quantize_weights(tensor, quantize_config: QuantizationConfig, out_feature_dim=1):
+# The float32 scratch of each worker is bounded by this many bytes
+_CHUNK_BYTES = int(os.environ.get('NEURON_QUANTIZE_CHUNK_BYTES', str(64 * 1024 * 1024)))
+
+
+def _column_blocks(in_features, out_features, chunk_bytes, align=1):
+    """
+    Split the output features into blocks of at most `chunk_bytes` float32 scratch.
+    """
+    block_size = max(1, chunk_bytes // (4 * in_features))
+    block_size = max(align, block_size // align * align)
+    return [(start, min(start + block_size, out_features)) for start in range(0, out_features, block_size)]
+
+
+def _run_blocks(function, blocks, max_workers):
+    # torch releases the GIL in its kernels so blocks quantize concurrently
+    if max_workers is None:
+        max_workers = min(8, os.cpu_count() or 1)
+    if max_workers <= 1 or len(blocks) <= 1:
+        for start, end in blocks:
+            function(start, end)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(function, start, end) for start, end in blocks]:
+            future.result()
+
+
+def maybe_quantize_weights(tensor, quantize_config: QuantizationConfig, out_feature_dim=1,
+                           chunk_bytes=None, max_workers=None):
+    """
+    Quantize a weight in blocks of output features.
+
+    Each block is converted to float32 in a scratch buffer of at most
+    `chunk_bytes`, quantized in place and written directly into the output
+    buffer, so the host memory needed beyond the output is bounded by
+    `chunk_bytes` per worker rather than several float32 copies of the
+    whole weight.
+
+    Arguments:
+        tensor: The weight of shape [in_features, out_features] (or
+            [out_features, in_features] when `out_feature_dim` is 0).
+        quantize_config: The quantization settings.
+        out_feature_dim: The dimension of the output features.
+        chunk_bytes: The float32 scratch size per worker. Defaults to
+            `NEURON_QUANTIZE_CHUNK_BYTES` (64MiB).
+        max_workers: The number of quantization threads.
+
+    Returns:
+        quantized_weights: The quantized weight.
+        scales: The scales of the weight.
+    """
     if tensor is None:
         return None, None
 
     assert tensor.dim() == 2, \
         f"Only support 2-D dimension weight quantization, but got dim={tensor.dim()}"
 
-    tensor = tensor.to(torch.float32)
+    if chunk_bytes is None:
+        chunk_bytes = _CHUNK_BYTES
     if quantize_config.quantize_method == 'vector_dynamic':
-        reduce_dim = 0 if out_feature_dim == 1 else 1
         if quantize_config.quant_dtype == "s8":
-             # Use W_f = W_q * scales
-            int8_min = torch.iinfo(torch.int8).min
-            int8_max = torch.iinfo(torch.int8).max
-            max_values, _ = torch.max(torch.abs(tensor), dim=reduce_dim, keepdim=(out_feature_dim==0))
-            scales = max_values / int8_max
-            if scales.count_nonzero() == 0:
-                # If the scales is all zeros, the weight tensor are zeros
-                quantized_weights = tensor.to(torch.int8)
-            else:
-                quantized_weights = tensor / scales
-                quantized_weights = torch.round(quantized_weights)
-                quantized_weights = torch.clamp(quantized_weights, int8_min, int8_max)
-                quantized_weights = quantized_weights.to(torch.int8)
-                scales = scales.flatten()
+            quantized_weights, scales = quantize_vector_wise(tensor, out_feature_dim, chunk_bytes, max_workers)
         else:
             raise NotImplementedError(f"{quantize_config.quant_dtype} for {quantize_config.quantize_method}")
+    elif quantize_config.quantize_method == 'group_dynamic':
+        quantized_weights, scales = quantize_group_wise(tensor, quantize_config, out_feature_dim,
+                                                        chunk_bytes, max_workers)
     else:
         raise NotImplementedError(f"{quantize_config.quantize_method} not implemented")
     
     return quantized_weights, scales
+
+
+def quantize_vector_wise(tensor, out_feature_dim=1, chunk_bytes=_CHUNK_BYTES, max_workers=None):
+    """
+    Quantize a weight to s8 with one scale per output channel: `W_f = W_q * scales`.
+
+    Channels which are all zeros get a zero scale and zero weights.
+    """
+    # Work on an [in_features, out_features] view of the weight
+    weight = tensor if out_feature_dim == 1 else tensor.T
+    in_features, out_features = weight.shape
+    int8_max = torch.iinfo(torch.int8).max
+    int8_min = torch.iinfo(torch.int8).min
+    quantized_weights = torch.empty(tensor.shape, dtype=torch.int8)
+    scales = torch.empty(out_features, dtype=torch.float32)
+    output = quantized_weights if out_feature_dim == 1 else quantized_weights.T
+
+    def quantize_block(start, end):
+        block = weight[:, start:end].to(dtype=torch.float32, copy=True)
+        max_values = torch.maximum(block.amax(dim=0), -block.amin(dim=0))
+        block_scales = max_values / int8_max
+        scales[start:end] = block_scales
+        block.div_(torch.where(block_scales == 0, torch.ones_like(block_scales), block_scales))
+        block.round_().clamp_(int8_min, int8_max)
+        output[:, start:end].copy_(block)
+
+    _run_blocks(quantize_block, _column_blocks(in_features, out_features, chunk_bytes), max_workers)
+    return quantized_weights, scales
+
+
+def quantize_group_wise(tensor, quantize_config: QuantizationConfig, out_feature_dim=1,
+                        chunk_bytes=_CHUNK_BYTES, max_workers=None):
+    """
+    Quantize a weight with one scale per `group_size` consecutive input features.
+
+    Every group is encoded as unsigned integers `W_q` with `W_f = W_q * scale + offset`.
+    Symmetric quantization uses `offset = -2 ** (bits - 1) * scale` while
+    `zero_point=True` fits the group minimum and maximum with
+    `offset = -zero_point * scale`. For s4 two values are packed per byte along
+    the input feature dimension: element `2i` in the low nibble and `2i + 1` in
+    the high nibble.
+
+    Arguments:
+        tensor: The weight of shape [in_features, out_features] (or
+            [out_features, in_features] when `out_feature_dim` is 0).
+        quantize_config: The quantization settings.
+        out_feature_dim: The dimension of the output features.
+        chunk_bytes: The float32 scratch size per worker.
+        max_workers: The number of quantization threads.
+
+    Returns:
+        quantized_weights: The uint8 weight. For s4 the input feature
+            dimension is halved.
+        scales: The float32 scales and offsets which have the shape of the
+            weight with the input feature dimension divided by `group_size`
+            and a trailing dimension of size 2 holding [scale, offset].
+    """
+    bits = 4 if quantize_config.quant_dtype == 's4' else 8
+    group_size = quantize_config.group_size
+    # Work on an [in_features, out_features] view of the weight
+    weight = tensor if out_feature_dim == 1 else tensor.T
+    in_features, out_features = weight.shape
+    if in_features % group_size:
+        raise ValueError(f"Input features ({in_features}) must be divisible by group_size ({group_size})")
+    n_groups = in_features // group_size
+    packed_features = in_features // 2 if bits == 4 else in_features
+
+    if out_feature_dim == 1:
+        quantized_weights = torch.empty(packed_features, out_features, dtype=torch.uint8)
+        scales = torch.empty(n_groups, out_features, 2, dtype=torch.float32)
+        output, output_scales = quantized_weights, scales
+    else:
+        quantized_weights = torch.empty(out_features, packed_features, dtype=torch.uint8)
+        scales = torch.empty(out_features, n_groups, 2, dtype=torch.float32)
+        output, output_scales = quantized_weights.T, scales.transpose(0, 1)
+    q_max = 2 ** bits - 1
+
+    def quantize_block(start, end):
+        block = weight[:, start:end].to(dtype=torch.float32, copy=True)
+        grouped = block.view(n_groups, group_size, end - start)
+        if quantize_config.zero_point:
+            min_values = grouped.amin(dim=1).clamp_(max=0)
+            max_values = grouped.amax(dim=1).clamp_(min=0)
+            block_scales = (max_values - min_values) / q_max
+            block_scales[block_scales == 0] = 1
+            zero_points = torch.round(-min_values / block_scales)
+        else:
+            max_values = torch.maximum(grouped.amax(dim=1), -grouped.amin(dim=1))
+            block_scales = max_values / (2 ** (bits - 1) - 1)
+            block_scales[block_scales == 0] = 1
+            zero_points = torch.full_like(block_scales, 2 ** (bits - 1))
+        grouped.div_(block_scales[:, None, :]).round_().add_(zero_points[:, None, :]).clamp_(0, q_max)
+        output_scales[:, start:end, 0] = block_scales
+        output_scales[:, start:end, 1] = -zero_points * block_scales
+        if bits == 4:
+            block = block.to(torch.uint8)
+            block = block[0::2] | (block[1::2] << 4)
+        output[:, start:end].copy_(block)
+
+    _run_blocks(quantize_block, _column_blocks(in_features, out_features, chunk_bytes), max_workers)
+    return quantized_weights, scales
+
+
+def dequantize_weights(quantized_weights, scales, quantize_config: QuantizationConfig, out_feature_dim=1):
+    """
+    Reconstruct a float32 weight from the output of `maybe_quantize_weights`.
+
+    This is the host reference of the on-device dequantization, used to
+    measure quantization error during calibration.
+    """
+    if quantize_config.quantize_method == 'vector_dynamic':
+        scales = scales.unsqueeze(1 - out_feature_dim)
+        return quantized_weights.to(torch.float32) * scales
+    if out_feature_dim == 0:
+        quantized_weights = quantized_weights.T
+        scales = scales.transpose(0, 1)
+    if quantize_config.quant_dtype == 's4':
+        low = quantized_weights & 15
+        high = quantized_weights >> 4
+        quantized_weights = torch.stack([low, high], dim=1).reshape(-1, quantized_weights.shape[1])
+    in_features, out_features = quantized_weights.shape
+    n_groups = scales.shape[0]
+    grouped = quantized_weights.to(torch.float32).reshape(n_groups, in_features // n_groups, out_features)
+    tensor = grouped * scales[:, None, :, 0] + scales[:, None, :, 1]
+    tensor = tensor.reshape(in_features, out_features)
+    if out_feature_dim == 0:
+        tensor = tensor.T
+    return tensor
+
+
+class QuantizedEmbedding(torch.nn.Module):
+    """
+    A host-resident embedding table stored quantized, one scale per token row
+    (or per group of each row), which only dequantizes the looked up rows.
+
+    Arguments:
+        weight: The quantized table.
+        scales: The scales of the table.
+        quantize_config: The quantization settings the table was quantized with.
+        dtype: The dtype of the returned embeddings.
+    """
+
+    def __init__(self, weight, scales, quantize_config: QuantizationConfig, dtype):
+        super().__init__()
+        self.register_buffer('weight', weight)
+        self.register_buffer('scales', scales)
+        self.quantize_config = quantize_config
+        self.dtype = dtype
+
+    @classmethod
+    def from_embedding(cls, embedding, quantize_config: QuantizationConfig):
+        weight = embedding.weight.detach()
+        quantized_weights, scales = maybe_quantize_weights(weight, quantize_config, out_feature_dim=0)
+        return cls(quantized_weights, scales.reshape(weight.shape[0], *scales.shape[1:]), quantize_config,
+                   weight.dtype)
+
+    def forward(self, input_ids):
+        index = input_ids.reshape(-1)
+        rows = dequantize_weights(self.weight[index], self.scales[index], self.quantize_config, out_feature_dim=0)
+        return rows.to(self.dtype).reshape(*input_ids.shape, rows.shape[-1])
+
+
+def maybe_quantize_embedding(embedding, quantize_config: QuantizationConfig):
+    """
+    Returns:
+        embedding: A `QuantizedEmbedding` when `quantize_config` enables
+            embedding quantization, otherwise `embedding` itself.
+    """
+    if quantize_config is None or not quantize_config.quantize_embedding:
+        return embedding
+    return QuantizedEmbedding.from_embedding(embedding, quantize_config)
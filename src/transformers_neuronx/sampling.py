@@ -16,13 +16,14 @@ import torch
 
 
 @torch.no_grad()
-def simple_sample(model, input_ids, start_ids, sequence_length, eos_token_id=2, top_k=50, streamer=None, output_scores=False):
+def simple_sample(model, input_ids, start_ids, sequence_length, eos_token_id=2, top_k=50, streamer=None, output_scores=False,
+                  stopping=None):
     # populate key/value caches according to the prompt text
     _, start = input_ids.shape
     cache_ids = torch.arange(start, dtype=torch.int32)
     next_token_scores = model(input_ids, cache_ids, start_ids)
     return sample_loop(model, input_ids, start_ids, next_token_scores, sequence_length,
-                       eos_token_id, top_k, streamer, output_scores=output_scores)
+                       eos_token_id, top_k, streamer, output_scores=output_scores, stopping=stopping)
 
 
 @torch.no_grad()
@@ -77,10 +78,18 @@ def sample_greedy(model, input_ids, start_ids=None, sequence_length=128):
 
 
 def sample_loop(model, input_ids, start_ids, next_token_scores, sequence_length, eos_token_id=2,
-                top_k=50, streamer=None, output_scores=False):
+                top_k=50, streamer=None, output_scores=False, stopping=None):
+    """
+    Sample until `sequence_length` without ever sampling `eos_token_id`.
+
+    When `stopping` (a `stopping.StopSequences`) is given, a row is done as
+    soon as it generates one of its stop sequences and is then filled with
+    `eos_token_id`. Sampling ends once every row is done.
+    """
     tokens = [input_ids]
-    _, start = input_ids.shape
+    batch_size, start = input_ids.shape
     scores = []
+    done_flags = torch.full((batch_size, 1), False)
     for cur_len in range(start, sequence_length):
         next_len = cur_len + 1
 
@@ -96,12 +105,15 @@ def sample_loop(model, input_ids, start_ids, next_token_scores, sequence_length,
         probs = torch.nn.functional.softmax(topk_values, dim=-1)
         inputs_in_topk = torch.multinomial(probs, num_samples=1, replacement=True)
         inputs = torch.gather(topk_indices, 1, inputs_in_topk)
+        if stopping is not None:
+            inputs = torch.where(done_flags, eos_token_id, inputs)
+            done_flags = torch.logical_or(done_flags, stopping.update(inputs))
         tokens.append(inputs)
 
         if streamer:
             streamer.put(inputs)
 
-        if next_len >= sequence_length:
+        if next_len >= sequence_length or done_flags.all():
             break
 
         # forward pass to get next token
@@ -117,20 +129,97 @@ def sample_loop(model, input_ids, start_ids, next_token_scores, sequence_length,
     return torch.cat(tokens, dim=-1)
 
 
+def is_per_row(value):
+    """
+    Check if a sampling parameter has one value per row of the batch.
+    """
+    return isinstance(value, (list, tuple, torch.Tensor))
+
+
+def per_row(value, dtype):
+    if is_per_row(value):
+        return torch.as_tensor(value, dtype=dtype)
+    return value
+
+
+def rows_of(value, rows):
+    if is_per_row(value):
+        return value[rows]
+    return value
+
+
+def rows_of_scores(scores, rows):
+    # Top-k candidate scores are a tuple of scores and token ids
+    if isinstance(scores, tuple):
+        return tuple(part[rows] for part in scores)
+    return scores[rows]
+
+
 def validate_top_k_top_p_min_tokens_to_keep(top_k, top_p, min_tokens_to_keep):
-    if top_k is not None and (not isinstance(top_k, int) or not (top_k > 0)):
+    if is_per_row(top_k):
+        if not (torch.as_tensor(top_k) > 0).all():
+            raise ValueError('top_k has to be strictly positive for every row.')
+    elif top_k is not None and (not isinstance(top_k, int) or not (top_k > 0)):
         raise ValueError('top_k has to be a strictly positive int.')
 
-    if top_p is not None and (not isinstance(top_p, float) or not (0.0 < top_p <= 1.0)):
+    if is_per_row(top_p):
+        top_p = torch.as_tensor(top_p)
+        if not ((0.0 < top_p) & (top_p <= 1.0)).all():
+            raise ValueError('top_p has to be a strictly positive float that less than or equal to 1.0 for every row.')
+    elif top_p is not None and (not isinstance(top_p, float) or not (0.0 < top_p <= 1.0)):
         raise ValueError('top_p has to be a strictly positive float that less than or equal to 1.0.')
 
     if min_tokens_to_keep is not None and (not isinstance(min_tokens_to_keep, int) or min_tokens_to_keep < 0):
         raise ValueError('min_tokens_to_keep has to be a non-negative int.')
 
 
+def validate_temperature(temperature):
+    if is_per_row(temperature):
+        if not (torch.as_tensor(temperature) > 0).all():
+            raise ValueError('temperature has to be strictly positive for every row.')
+    elif not isinstance(temperature, float) or not (temperature > 0):
+        raise ValueError('temperature has to be a strictly positive float.')
+
+
+def top_k_top_p_filtering_per_row(scores, top_k, top_p, min_tokens_to_keep=1):
+    """
+    Top-k/top-p filtering where `top_k` and `top_p` may hold a value per row.
+
+    Rows without a limit may pass None for `top_k` or `top_p`. As in
+    `top_k_top_p_filtering`, the returned scores are sorted in descending order
+    and filtered entries are set to -inf.
+    """
+    batch_size, input_size = scores.shape
+    if top_k is None:
+        top_k = input_size
+    if top_p is None:
+        top_p = 1.0
+    top_k = torch.as_tensor(top_k, dtype=torch.int64).expand(batch_size)
+    top_p = torch.as_tensor(top_p, dtype=scores.dtype).expand(batch_size)
+    top_k = top_k.clamp(max=input_size)
+
+    # Only the largest requested top-k needs to be sorted
+    max_k = max(int(top_k.max()), min(min_tokens_to_keep, input_size))
+    sorted_scores, indices = torch.topk(scores, max_k)
+
+    ranks = torch.arange(max_k)
+    mask = ranks < top_k.unsqueeze(1)
+    filtered = sorted_scores.masked_fill(~mask, -float('inf'))
+    cumulative_probs = torch.cumsum(torch.nn.functional.softmax(filtered, dim=-1), dim=-1)
+    mask &= (cumulative_probs <= top_p.unsqueeze(1)) | (top_p >= 1.0).unsqueeze(1)
+    mask[:, :min_tokens_to_keep] = True
+
+    n_to_keep = int(mask.sum(dim=-1).max())
+    sorted_scores = sorted_scores[:, :n_to_keep].masked_fill(~mask[:, :n_to_keep], -float('inf'))
+    return sorted_scores, indices[:, :n_to_keep]
+
+
 def top_k_top_p_filtering(scores, top_k, top_p, min_tokens_to_keep=1):
     validate_top_k_top_p_min_tokens_to_keep(top_k, top_p, min_tokens_to_keep)
 
+    if is_per_row(top_k) or is_per_row(top_p):
+        return top_k_top_p_filtering_per_row(scores, top_k, top_p, min_tokens_to_keep)
+
     input_size = scores.size(dim=-1)
 
     def safe_size(size):
@@ -188,30 +277,104 @@ def top_k_top_p_filtering(scores, top_k, top_p, min_tokens_to_keep=1):
     return filter_by_top_p(filter_by_top_k()[1])
 
 
+def select_tokens_llama(next_token_scores, top_k, top_p, temperature, generators=None):
+    """
+    Sample one token per row.
+
+    The `next_token_scores` are either the [batch_size, vocab_size] scores or
+    a tuple of [batch_size, k] candidate scores and their token ids (see
+    `LogitsConfig.top_k`), which are filtered and sampled directly.
+    """
+    candidates = None
+    if isinstance(next_token_scores, tuple):
+        next_token_scores, candidates = next_token_scores
+    if is_per_row(temperature):
+        next_token_scores /= temperature.unsqueeze(1)
+    elif temperature != 1.0:
+        next_token_scores /= temperature
+
+    top_values, top_indices = top_k_top_p_filtering(next_token_scores, top_k=top_k, top_p=top_p)
+
+    # sample
+    probs = torch.nn.functional.softmax(top_values, dim=-1)
+    if generators is None:
+        inputs_in_topk = torch.multinomial(probs, num_samples=1, replacement=True)
+    else:
+        # Each row draws from its own seeded generator so results do not depend on batch composition
+        inputs_in_topk = torch.cat([
+            torch.multinomial(row_probs, num_samples=1, replacement=True, generator=generator)
+            for row_probs, generator in zip(probs.unsqueeze(1), generators)
+        ])
+    inputs = torch.gather(top_indices, 1, inputs_in_topk)
+    if candidates is not None:
+        inputs = torch.gather(candidates, 1, inputs)
+    return inputs
+
+
+def seeded_generators(seed, batch_size):
+    """
+    Create one generator per row from a seed per row.
+
+    A single seed is offset by the row index so that rows (e.g. multiple
+    return sequences of one prompt) draw different samples.
+    """
+    if seed is None:
+        return None
+    if not is_per_row(seed):
+        seed = [seed + row for row in range(batch_size)]
+    return [torch.Generator().manual_seed(int(row_seed)) for row_seed in seed]
+
+
 def sample_loop_llama(model, input_ids, start_ids, next_token_scores, sequence_length, eos_token_id=2,
-                      top_k=50, top_p=1.0, temperature=1.0, streamer=None):
+                      top_k=50, top_p=1.0, temperature=1.0, streamer=None, seed=None, max_new_tokens=None,
+                      constraints=None, stopping=None):
+    """
+    Sample tokens until `sequence_length` or until every row is done.
+
+    The `top_k`, `top_p`, `temperature`, `eos_token_id`, `seed` and
+    `max_new_tokens` parameters may either be a single value for the whole
+    batch or a list/tensor with one value per row. A row is done once it
+    samples its `eos_token_id` or has sampled `max_new_tokens` tokens, after
+    which it is filled with its `eos_token_id`. With `stopping` (a
+    `stopping.StopSequences`) a row is also done on the step which completes
+    one of its stop sequences.
+
+    When `constraints` (a `constraints.ConstrainedBatch`) is given, tokens
+    which violate a row's constraint are masked out of the scores. Models
+    which provide `set_token_mask` also receive the packed mask of the next
+    step so that it can be applied on device.
+
+    The model is called with the `position` of each token step so that it
+    does not need to read it back from the cache ids.
+    """
     validate_top_k_top_p_min_tokens_to_keep(top_k, top_p, None)
-
-    if not isinstance(temperature, float) or not (temperature > 0):
-        raise ValueError('temperature has to be a strictly positive float.')
+    validate_temperature(temperature)
+
+    batch_size, start = input_ids.shape
+    top_k = per_row(top_k, torch.int64)
+    top_p = per_row(top_p, torch.float32)
+    temperature = per_row(temperature, torch.float32)
+    eos_token_id = per_row(eos_token_id, torch.int64)
+    if is_per_row(eos_token_id):
+        eos_token_id = eos_token_id.unsqueeze(1)
+    max_new_tokens = per_row(max_new_tokens, torch.int64)
+    generators = seeded_generators(seed, batch_size)
 
     # Flags, one per sequence in a batch, to indicate if a sequence hit eos_token_id
-    done_flags = torch.full((input_ids.size(dim=0), 1), False)
+    done_flags = torch.full((batch_size, 1), False)
     tokens = [input_ids]
-    _, start = input_ids.shape
+    all_cache_ids = torch.arange(start, max(start, sequence_length), dtype=torch.int32).split(1)
 
-    for cur_len in range(start, sequence_length):
+    for cur_len, cache_ids in zip(range(start, sequence_length), all_cache_ids):
         next_len = cur_len + 1
 
-        if temperature != 1.0:
-            next_token_scores /= temperature
-
-        top_values, top_indices = top_k_top_p_filtering(next_token_scores, top_k=top_k, top_p=top_p)
-
-        # sample
-        probs = torch.nn.functional.softmax(top_values, dim=-1)
-        inputs_in_topk = torch.multinomial(probs, num_samples=1, replacement=True)
-        inputs = torch.gather(top_indices, 1, inputs_in_topk)
+        if constraints is not None:
+            next_token_scores = constraints.apply(next_token_scores)
+        inputs = select_tokens_llama(next_token_scores, top_k, top_p, temperature, generators)
+        if constraints is not None:
+            constraints.advance(inputs)
+            if hasattr(model, 'set_token_mask'):
+                model.set_token_mask(constraints)
 
         # Update done flags.
         done_flags = torch.logical_or(done_flags, inputs == eos_token_id)
@@ -223,6 +386,13 @@ def sample_loop_llama(model, input_ids, start_ids, next_token_scores, sequence_l
         token = torch.where(done_flags.eq(True), eos_token_id, inputs)
         tokens.append(token)
 
+        # Rows which reached their token budget are done after this token
+        if max_new_tokens is not None:
+            n_new_tokens = next_len - start
+            done_flags = torch.logical_or(done_flags, torch.as_tensor(max_new_tokens <= n_new_tokens).reshape(-1, 1))
+        if stopping is not None:
+            done_flags = torch.logical_or(done_flags, stopping.update(token))
+
         if streamer is not None and hasattr(streamer, 'response_with_prefix') and streamer.response_with_prefix:
              streamer.put(torch.cat(tokens, dim=-1))
         elif streamer:
@@ -232,8 +402,7 @@ def sample_loop_llama(model, input_ids, start_ids, next_token_scores, sequence_l
             break
 
         # forward pass to get next token
-        cache_ids = torch.as_tensor([cur_len], dtype=torch.int32)
-        next_token_scores = model(inputs, cache_ids, start_ids)
+        next_token_scores = model(inputs, cache_ids, start_ids, position=cur_len)
 
     if streamer:
         streamer.end()
@@ -242,13 +411,235 @@ def sample_loop_llama(model, input_ids, start_ids, next_token_scores, sequence_l
 
 
 @torch.no_grad()
-def sample_llama(model, input_ids, start_ids, sequence_length, eos_token_id=2, top_k=50, top_p=1.0, temperature=1.0, streamer=None):
+def sample_llama(model, input_ids, start_ids, sequence_length, eos_token_id=2, top_k=50, top_p=1.0, temperature=1.0, streamer=None,
+                 seed=None, max_new_tokens=None, constraints=None, stopping=None):
     validate_top_k_top_p_min_tokens_to_keep(top_k, top_p, None)
 
     # populate key/value caches according to the prompt text
     _, start = input_ids.shape
     cache_ids = torch.arange(start, dtype=torch.int32)
+    if constraints is not None and hasattr(model, 'set_token_mask'):
+        model.set_token_mask(constraints)
     next_token_scores = model(input_ids, cache_ids, start_ids)
     return sample_loop_llama(
-        model, input_ids, start_ids, next_token_scores, sequence_length, eos_token_id, top_k, top_p, temperature, streamer
+        model, input_ids, start_ids, next_token_scores, sequence_length, eos_token_id, top_k, top_p, temperature, streamer,
+        seed, max_new_tokens, constraints, stopping
+    )
+
+
+def sample_loop_llama_ping_pong(model, input_ids, start_ids, next_token_scores, sequence_length, eos_token_id=2,
+                                top_k=50, top_p=1.0, temperature=1.0, streamer=None, seed=None, max_new_tokens=None,
+                                stopping=None):
+    """
+    A sampling loop which alternates two halves of the batch on device.
+
+    While one half executes on the device, the other half is sampled and its
+    next tokens are embedded and submitted on the host. The model must
+    provide `forward_async(micro_batch, input_ids, cache_ids, start_ids, position)`
+    which returns a future for the logits and `scores(logits, batch_size)`.
+    Tokens are identical in distribution to `sample_loop_llama`, including
+    support for per-row sampling parameters.
+    """
+    validate_top_k_top_p_min_tokens_to_keep(top_k, top_p, None)
+    validate_temperature(temperature)
+
+    batch_size, start = input_ids.shape
+    half = batch_size // 2
+    halves = [slice(0, half), slice(half, batch_size)]
+    if start_ids is None:
+        start_ids = torch.zeros(batch_size, dtype=torch.int32)
+
+    top_k = per_row(top_k, torch.int64)
+    top_p = per_row(top_p, torch.float32)
+    temperature = per_row(temperature, torch.float32)
+    eos_token_id = per_row(eos_token_id, torch.int64)
+    if is_per_row(eos_token_id):
+        eos_token_id = eos_token_id.unsqueeze(1)
+    max_new_tokens = per_row(max_new_tokens, torch.int64)
+    generators = seeded_generators(seed, batch_size)
+    params = [
+        (rows_of(top_k, rows), rows_of(top_p, rows), rows_of(temperature, rows), rows_of(eos_token_id, rows),
+         None if generators is None else generators[rows])
+        for rows in halves
+    ]
+
+    done_flags = torch.full((batch_size, 1), False)
+    tokens = [input_ids]
+    scores = [rows_of_scores(next_token_scores, rows) for rows in halves]
+    futures = [None, None]
+    all_cache_ids = torch.arange(start, max(start, sequence_length), dtype=torch.int32).split(1)
+
+    for cur_len, cache_ids in zip(range(start, sequence_length), all_cache_ids):
+        next_len = cur_len + 1
+
+        step = []
+        for micro_batch, rows in enumerate(halves):
+            # Wait for this half only. The other half keeps the device busy
+            future = futures[micro_batch]
+            if future is not None:
+                scores[micro_batch] = model.scores(future.result(), half)
+                futures[micro_batch] = None
+
+            half_top_k, half_top_p, half_temperature, half_eos_token_id, half_generators = params[micro_batch]
+            inputs = select_tokens_llama(scores[micro_batch], half_top_k, half_top_p, half_temperature, half_generators)
+            done_flags[rows] = torch.logical_or(done_flags[rows], inputs == half_eos_token_id)
+            step.append(torch.where(done_flags[rows].eq(True), half_eos_token_id, inputs))
+
+            if next_len < sequence_length:
+                futures[micro_batch] = model.forward_async(micro_batch, inputs, cache_ids, start_ids[rows], cur_len)
+
+        token = torch.cat(step, dim=0)
+        tokens.append(token)
+
+        if max_new_tokens is not None:
+            n_new_tokens = next_len - start
+            done_flags = torch.logical_or(done_flags, torch.as_tensor(max_new_tokens <= n_new_tokens).reshape(-1, 1))
+        if stopping is not None:
+            done_flags = torch.logical_or(done_flags, stopping.update(token))
+
+        if streamer is not None and hasattr(streamer, 'response_with_prefix') and streamer.response_with_prefix:
+             streamer.put(torch.cat(tokens, dim=-1))
+        elif streamer:
+            streamer.put(token)
+
+        if next_len >= sequence_length or done_flags.all():
+            break
+
+    # Drain in-flight steps so that later calls do not race with the caches
+    for future in futures:
+        if future is not None:
+            future.result()
+
+    if streamer:
+        streamer.end()
+
+    return torch.cat(tokens, dim=-1)
+
+
+@torch.no_grad()
+def sample_llama_ping_pong(model, input_ids, start_ids, sequence_length, eos_token_id=2, top_k=50, top_p=1.0,
+                           temperature=1.0, streamer=None, seed=None, max_new_tokens=None, stopping=None):
+    validate_top_k_top_p_min_tokens_to_keep(top_k, top_p, None)
+
+    # populate key/value caches according to the prompt text
+    _, start = input_ids.shape
+    cache_ids = torch.arange(start, dtype=torch.int32)
+    next_token_scores = model(input_ids, cache_ids, start_ids)
+    return sample_loop_llama_ping_pong(
+        model, input_ids, start_ids, next_token_scores, sequence_length, eos_token_id, top_k, top_p, temperature, streamer,
+        seed, max_new_tokens, stopping
     )
+
+
+class BeamHypotheses:
+    """
+    The finished hypotheses of one batch line of a beam search.
+
+    Hypotheses are ranked by their score divided by the number of generated
+    tokens (excluding the eos token) to the power `length_penalty`. Only the
+    best `num_beams` hypotheses are kept.
+    """
+
+    def __init__(self, num_beams, prompt_length, length_penalty=1.0, early_stopping=False):
+        self.num_beams = num_beams
+        self.prompt_length = prompt_length
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+        self.hypotheses = []
+        self.done = False
+
+    def __len__(self):
+        return len(self.hypotheses)
+
+    def normalize(self, score, length):
+        return score / max(length - self.prompt_length, 1) ** self.length_penalty
+
+    def worst_score(self):
+        return min(score for score, _ in self.hypotheses)
+
+    def add(self, tokens, score):
+        score = self.normalize(float(score), tokens.shape[-1])
+        if len(self) < self.num_beams or score > self.worst_score():
+            self.hypotheses.append((score, tokens))
+            self.hypotheses.sort(key=lambda hypothesis: hypothesis[0], reverse=True)
+            del self.hypotheses[self.num_beams:]
+
+    def is_done(self, best_running_score, length):
+        """
+        Whether no running beam of `length` tokens can improve the finished hypotheses.
+        """
+        if len(self) < self.num_beams:
+            return False
+        if self.early_stopping:
+            return True
+        return self.worst_score() >= self.normalize(float(best_running_score), length)
+
+
+def select_beams(hypotheses, tokens, scores, candidate_tokens, beams, eos_token_id):
+    """
+    Set aside the finished candidates of each batch line and continue its best running candidates.
+
+    Candidates must be sorted by descending score. A candidate ending with
+    `eos_token_id` is added to the finished hypotheses of its batch line
+    when it ranks within the best `num_beams` candidates. Batch lines which
+    are done continue their best candidates, whose tokens are ignored.
+
+    Arguments:
+        hypotheses: The `BeamHypotheses` of each batch line.
+        tokens: The tokens of every beam of shape [batch_size, num_beams, length].
+        scores: The candidate scores of shape [batch_size, n_candidates].
+        candidate_tokens: The candidate token ids of shape [batch_size, n_candidates].
+        beams: The source beam (within the batch line) of each candidate.
+        eos_token_id: The token which finishes a hypothesis, or None.
+
+    Returns:
+        beam_scores: The running scores of shape [batch_size, num_beams].
+        inputs: The next tokens of shape [batch_size, num_beams].
+        beams: The source beams of shape [batch_size, num_beams].
+    """
+    batch_size, num_beams, length = tokens.shape
+    next_scores = torch.full([batch_size, num_beams], -float('inf'))
+    next_tokens = torch.zeros([batch_size, num_beams], dtype=torch.int64)
+    next_beams = torch.zeros([batch_size, num_beams], dtype=torch.int64)
+    for line, hypothesis in enumerate(hypotheses):
+        if hypothesis.done:
+            next_scores[line] = scores[line, :num_beams]
+            next_tokens[line] = candidate_tokens[line, :num_beams]
+            next_beams[line] = beams[line, :num_beams]
+            continue
+        count = 0
+        for rank, (score, token, beam) in enumerate(zip(scores[line].tolist(), candidate_tokens[line].tolist(),
+                                                        beams[line].tolist())):
+            if eos_token_id is not None and token == eos_token_id:
+                if rank < num_beams:
+                    hypothesis.add(tokens[line, beam], score)
+                continue
+            next_scores[line, count] = score
+            next_tokens[line, count] = token
+            next_beams[line, count] = beam
+            count += 1
+            if count == num_beams:
+                break
+        hypothesis.done = hypothesis.is_done(next_scores[line].max(), length + 1)
+    return next_scores, next_tokens, next_beams
+
+
+def finalize_beams(hypotheses, tokens, beam_scores, sequence_length, pad_token_id):
+    """
+    Rank the finished hypotheses together with the running beams of each batch line.
+
+    Returns:
+        tokens: The best `num_beams` hypotheses of each batch line of shape
+            [batch_size, num_beams, sequence_length], best first and padded
+            with `pad_token_id`.
+    """
+    batch_size, num_beams, _ = tokens.shape
+    output = torch.full([batch_size, num_beams, sequence_length], pad_token_id, dtype=tokens.dtype)
+    for line, hypothesis in enumerate(hypotheses):
+        if not hypothesis.done:
+            for beam in range(num_beams):
+                hypothesis.add(tokens[line, beam], beam_scores[line, beam])
+        for rank, (_, hypothesis_tokens) in enumerate(hypothesis.hypotheses):
+            length = min(hypothesis_tokens.shape[-1], sequence_length)
+            output[line, rank, :length] = hypothesis_tokens[:length]
+    return output
@@ -0,0 +1,162 @@
+# Copyright Amazon Web Services and its Affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Incremental stop sequence detection.
+
+Stop sequences are matched one generated token at a time so that a row is
+marked done on the step which completes a stop sequence rather than
+overgenerating and trimming afterwards.
+"""
+import collections
+import torch
+
+
+class TokenAutomaton:
+    """
+    An Aho-Corasick automaton over token id sequences.
+
+    Each step consumes one token per row in amortized constant time
+    regardless of the number of sequences.
+
+    Arguments:
+        sequences: The token id sequences to detect.
+    """
+
+    def __init__(self, sequences):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [False]
+        for sequence in sequences:
+            if not sequence:
+                continue
+            state = 0
+            for token_id in sequence:
+                next_state = self.goto[state].get(token_id)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][token_id] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(False)
+                state = next_state
+            self.output[state] = True
+
+        # Breadth-first construction of the failure links
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token_id, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and token_id not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(token_id, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.output[next_state] = self.output[next_state] or self.output[self.fail[next_state]]
+
+    def step(self, state, token_id):
+        """
+        Returns:
+            state: The next state.
+            matched: Whether a sequence ends with `token_id`.
+        """
+        while state and token_id not in self.goto[state]:
+            state = self.fail[state]
+        state = self.goto[state].get(token_id, 0)
+        return state, self.output[state]
+
+
+class StopSequences:
+    """
+    Detect stop strings (or token id sequences) in generated tokens, per row.
+
+    Each stop string is tokenized both on its own and as a continuation of
+    text (with a leading space) and every tokenization is matched with a
+    `TokenAutomaton`. Because generated text may tokenize a stop string
+    differently, a text fallback also decodes the tail of each row (just long
+    enough to contain the longest stop string) and searches it for the stop
+    strings.
+
+    Arguments:
+        stop_sequences: The stop sequences of every row, or a list per row.
+            A stop sequence is a string or a list of token ids.
+        batch_size: The number of rows when the same stop sequences apply to every row.
+        tokenizer: The tokenizer used to encode stop strings and decode the text fallback.
+    """
+
+    def __init__(self, stop_sequences, batch_size=None, tokenizer=None):
+        if batch_size is not None:
+            stop_sequences = [stop_sequences] * batch_size
+        self.tokenizer = tokenizer
+        self.automata = []
+        self.strings = []
+        self.tail_lengths = []
+        cache = {}
+        for row_sequences in stop_sequences:
+            key = tuple(seq if isinstance(seq, str) else tuple(seq) for seq in row_sequences)
+            if key not in cache:
+                cache[key] = self._build(row_sequences)
+            automaton, strings, tail_length = cache[key]
+            self.automata.append(automaton)
+            self.strings.append(strings)
+            self.tail_lengths.append(tail_length)
+        self.states = [0] * len(self.automata)
+        self.history = [[] for _ in self.automata]
+
+    def _build(self, row_sequences):
+        token_sequences = []
+        strings = []
+        for sequence in row_sequences:
+            if isinstance(sequence, str):
+                if self.tokenizer is None:
+                    raise ValueError('A tokenizer is required for stop strings')
+                strings.append(sequence)
+                for text in sequence, ' ' + sequence:
+                    token_sequences.append(self.tokenizer.encode(text, add_special_tokens=False))
+            else:
+                token_sequences.append(list(sequence))
+        tail_length = 0
+        if strings:
+            # Every token decodes to at least one character (or byte) so this many tokens covers any match
+            tail_length = max(len(string.encode('utf-8')) for string in strings) + 1
+        return TokenAutomaton(token_sequences), strings, tail_length
+
+    def update(self, tokens):
+        """
+        Consume the next token of every row.
+
+        Arguments:
+            tokens: The generated tokens of shape [batch_size, 1].
+
+        Returns:
+            done: A boolean tensor of shape [batch_size, 1] which is set for
+                rows whose generated tokens end a stop sequence.
+        """
+        token_ids = tokens.flatten().tolist()
+        done = torch.zeros(len(token_ids), 1, dtype=torch.bool)
+        for row, token_id in enumerate(token_ids):
+            self.states[row], matched = self.automata[row].step(self.states[row], token_id)
+            strings = self.strings[row]
+            if strings:
+                history = self.history[row]
+                history.append(token_id)
+                del history[:-self.tail_lengths[row]]
+                if not matched:
+                    text = self.tokenizer.decode(history)
+                    # Only matches which end in the newest token are new
+                    previous = self.tokenizer.decode(history[:-1])
+                    matched = any(string in text and string not in previous for string in strings)
+            done[row] = matched
+        return done
@@ -104,6 +104,56 @@ def u8_encode(tensor):
     tensor = tensor.round().to(torch.uint8)
     return tensor, tensor_min, tensor_max
 
+def u8_encode_ranges(tensor, out_feature_dim=1, granularity='tensor', group_size=128):
+    """
+    Encode a weight as uint8 with `W_f = W_u8 * scale + minimum`.
+
+    Arguments:
+        tensor: The weight of shape [in_features, out_features] (or
+            [out_features, in_features] when `out_feature_dim` is 0).
+        out_feature_dim: The dimension of the output features.
+        granularity: One range per weight (`'tensor'`), per output channel
+            (`'channel'`) or per `group_size` input features of each output
+            channel (`'group'`).
+        group_size: The number of input features per range for `'group'`.
+
+    Returns:
+        encoded: The uint8 weight.
+        ranges: The float32 ranges with the shape of the weight, where the
+            input feature dimension counts ranges, and a trailing
+            [scale, minimum] dimension.
+    """
+    weight = tensor.to(torch.float32)
+    if out_feature_dim == 0:
+        weight = weight.T
+    in_features, out_features = weight.shape
+    if granularity == 'group':
+        if in_features % group_size:
+            raise ValueError(f'Input features ({in_features}) must be divisible by group_size ({group_size})')
+        n_groups = in_features // group_size
+    elif granularity in ('tensor', 'channel'):
+        n_groups = 1
+    else:
+        raise NotImplementedError(f'u8 granularity {granularity} is not implemented. '
+                                  f'Available options are tensor,channel,group')
+    grouped = weight.reshape(n_groups, in_features // n_groups, out_features)
+    if granularity == 'tensor':
+        minimum = grouped.min().expand(1, out_features)
+        maximum = grouped.max().expand(1, out_features)
+    else:
+        minimum = grouped.amin(dim=1)
+        maximum = grouped.amax(dim=1)
+    scale = (maximum - minimum) / 255.0
+    scale = torch.where(scale == 0, torch.ones_like(scale), scale)
+    encoded = (grouped - minimum[:, None, :]) / scale[:, None, :]
+    encoded = encoded.round().clamp(0, 255).to(torch.uint8).reshape(in_features, out_features)
+    ranges = torch.stack([scale, minimum], dim=-1)
+    if out_feature_dim == 0:
+        encoded = encoded.T.contiguous()
+        ranges = ranges.transpose(0, 1).contiguous()
+    return encoded, ranges
+
+
 # Sparse attention related, put here for now
 def create_blk_mask(blks_q, blks_kv, num_global_blks=0, num_local_blks=1, num_random_blks=0, causal=False):
     """